@@ -0,0 +1,212 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Counters, timers and histograms for long running batch jobs.
+
+Usage:
+    metrics = instrumentation.create_metrics('name', configuration)
+    with metrics.timer('stage'):
+        ...
+    metrics.increment('molecules')
+    metrics.observe('fragments_per_molecule', 10)
+    metrics.tick()
+    ...
+    metrics.close()
+
+The tick method emits the metrics when the emit interval passed. Every
+emission logs the metrics as a JSON object, appends it as a line to the
+optional JSON Lines file and rewrites the optional Prometheus text file,
+that can be collected by the node exporter textfile collector.
+
+This module is shared by the scripts in molecular_features and
+protein_protein_interactions, they add the common directory to sys.path.
+"""
+
+import os
+import contextlib
+import json
+import logging
+import time
+
+__author__ = 'Petr Škoda'
+__license__ = 'X11'
+__email__ = 'skoda@ksi.mff.cuni.cz'
+
+# Default histogram buckets, suitable for latencies in seconds.
+_default_buckets = [0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 60]
+
+
+class Metrics(object):
+    """Collection of counters and histograms.
+
+    :param name: Name of the program, used as prefix of Prometheus metrics.
+    :param interval: Emit interval in seconds, None to emit only on close.
+    :param json_path: Optional path to JSON Lines file.
+    :param prometheus_path: Optional path to Prometheus text file.
+    """
+
+    def __init__(self, name, interval=None, json_path=None,
+                 prometheus_path=None):
+        self.name = name
+        self.interval = interval
+        self.json_path = json_path
+        self.prometheus_path = prometheus_path
+        self.counters = {}
+        self.histograms = {}
+        self.start = time.time()
+        self.last_emit = self.start
+
+    def increment(self, name, value=1):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def observe(self, name, value, buckets=None):
+        """Add value to the histogram of given name.
+
+        :param name:
+        :param value:
+        :param buckets: Upper bounds of buckets, used only when the
+            histogram is created. Default are latency buckets.
+        :return:
+        """
+        if name not in self.histograms:
+            self.histograms[name] = {
+                'buckets': sorted(buckets or _default_buckets),
+                'counts': [0] * len(buckets or _default_buckets),
+                'count': 0,
+                'sum': 0,
+                'min': value,
+                'max': value
+            }
+        histogram = self.histograms[name]
+        for index, bound in enumerate(histogram['buckets']):
+            if value <= bound:
+                histogram['counts'][index] += 1
+                break
+        histogram['count'] += 1
+        histogram['sum'] += value
+        histogram['min'] = min(histogram['min'], value)
+        histogram['max'] = max(histogram['max'], value)
+
+    @contextlib.contextmanager
+    def timer(self, name):
+        """Measure duration of the block into 'name_seconds' histogram."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name + '_seconds', time.perf_counter() - start)
+
+    def snapshot(self):
+        """Return metrics as a JSON serializable object."""
+        elapsed = time.time() - self.start
+        result = {
+            'name': self.name,
+            'elapsed': elapsed,
+            'counters': dict(self.counters),
+            'rates': {},
+            'histograms': {}
+        }
+        for name, value in self.counters.items():
+            result['rates'][name] = value / elapsed if elapsed > 0 else None
+        for name, histogram in self.histograms.items():
+            cumulative = 0
+            buckets = {}
+            for bound, count in zip(histogram['buckets'],
+                                    histogram['counts']):
+                cumulative += count
+                buckets[str(bound)] = cumulative
+            result['histograms'][name] = {
+                'count': histogram['count'],
+                'sum': histogram['sum'],
+                'mean': histogram['sum'] / histogram['count'],
+                'min': histogram['min'],
+                'max': histogram['max'],
+                'buckets': buckets
+            }
+        return result
+
+    def tick(self):
+        """Emit the metrics if the emit interval passed."""
+        if self.interval is None:
+            return
+        if time.time() - self.last_emit >= self.interval:
+            self.emit()
+
+    def emit(self):
+        """Log the metrics and write them into the configured files."""
+        self.last_emit = time.time()
+        snapshot = self.snapshot()
+        text = json.dumps(snapshot, sort_keys=True)
+        logging.info('metrics %s', text)
+        if self.json_path is not None:
+            with open(self.json_path, 'a') as stream:
+                stream.write(text)
+                stream.write('\n')
+        if self.prometheus_path is not None:
+            write_prometheus(self.prometheus_path, snapshot)
+
+    def close(self):
+        """Emit the final metrics."""
+        self.emit()
+
+
+def _format_prometheus(snapshot):
+    prefix = snapshot['name']
+    lines = []
+    for name, value in sorted(snapshot['counters'].items()):
+        lines.append('# TYPE %s_%s_total counter' % (prefix, name))
+        lines.append('%s_%s_total %s' % (prefix, name, value))
+    for name, histogram in sorted(snapshot['histograms'].items()):
+        metric = prefix + '_' + name
+        lines.append('# TYPE %s histogram' % metric)
+        for bound, count in histogram['buckets'].items():
+            lines.append('%s_bucket{le="%s"} %d' % (metric, bound, count))
+        lines.append('%s_bucket{le="+Inf"} %d' % (metric, histogram['count']))
+        lines.append('%s_sum %s' % (metric, histogram['sum']))
+        lines.append('%s_count %d' % (metric, histogram['count']))
+    lines.append('# TYPE %s_elapsed_seconds gauge' % prefix)
+    lines.append('%s_elapsed_seconds %s' % (prefix, snapshot['elapsed']))
+    return '\n'.join(lines) + '\n'
+
+
+def write_prometheus(path, snapshot):
+    """Write metrics snapshot into Prometheus text file.
+
+    The file is replaced atomically, so the collector never reads a partly
+    written file.
+    :param path:
+    :param snapshot: See Metrics.snapshot.
+    :return:
+    """
+    temp_path = path + '.tmp'
+    with open(temp_path, 'w') as stream:
+        stream.write(_format_prometheus(snapshot))
+    os.replace(temp_path, path)
+
+
+def add_arguments(parser):
+    """Add metrics arguments to the argparse parser.
+
+    :param parser:
+    :return:
+    """
+    parser.add_argument('--metrics', type=str, dest='metrics',
+                        help='JSON Lines file to append metrics to',
+                        required=False)
+    parser.add_argument('--metrics-interval', type=float,
+                        dest='metrics_interval', default=60,
+                        help='interval of metrics emission in seconds')
+    parser.add_argument('--prometheus', type=str, dest='prometheus',
+                        help='Prometheus text file to write metrics to',
+                        required=False)
+
+
+def create_metrics(name, configuration):
+    """Create metrics based on arguments added by add_arguments.
+
+    :param name: Name of the program.
+    :param configuration: Parsed arguments as a dictionary.
+    :return:
+    """
+    return Metrics(name, configuration.get('metrics_interval'),
+                   configuration.get('metrics'),
+                   configuration.get('prometheus'))
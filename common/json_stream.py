@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Streaming reader of large JSON files.
+
+The input files, e.g. graphs or extracted fragments, may not fit into
+memory as a whole. Use read_json_array_stream to iterate over the
+objects of a JSON array or JSON Lines file.
+"""
+
+import json
+import re
+
+__author__ = 'Petr Škoda'
+__license__ = 'X11'
+__email__ = 'skoda@ksi.mff.cuni.cz'
+
+# Size of a block read from the input stream.
+_CHUNK_SIZE = 1 << 20
+
+# White spaces and separators between JSON objects.
+_SEPARATORS = re.compile(r'[\s,]*')
+
+
+def read_json_array_stream(stream, chunk_size=_CHUNK_SIZE):
+    """Read JSON objects from array or JSON Lines stream.
+
+    The stream is read in blocks of chunk_size characters and objects are
+    decoded by json.JSONDecoder.raw_decode, so strings may contain any
+    characters and only the decoded object and one block are kept in memory.
+    If the first non-whitespace character is not '[' the input is read as
+    JSON Lines, i.e. objects separated by white spaces.
+    :param stream: Text stream.
+    :param chunk_size: Number of characters to read at once.
+    :return: Generator of decoded objects.
+    """
+    decoder = json.JSONDecoder()
+    buffer = ''
+    position = 0
+    is_array = None
+    while True:
+        # Skip white spaces and separators between objects.
+        position = _SEPARATORS.match(buffer, position).end()
+        if position == len(buffer):
+            buffer = stream.read(chunk_size)
+            position = 0
+            if buffer == '':
+                return
+            continue
+        if is_array is None:
+            is_array = buffer[position] == '['
+            if is_array:
+                position += 1
+                continue
+        if is_array and buffer[position] == ']':
+            return
+        try:
+            item, position = decoder.raw_decode(buffer, position)
+        except ValueError:
+            # The object is not complete, so read more data. We read at least
+            # the size of the incomplete object to keep the number of
+            # decoding attempts logarithmic in the object size.
+            data = stream.read(max(chunk_size, len(buffer) - position))
+            if data == '':
+                raise
+            buffer = buffer[position:] + data
+            position = 0
+            continue
+        yield item
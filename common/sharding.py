@@ -0,0 +1,325 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Deterministic partitioning of work into shards and merge of outputs.
+
+Scripts using add_arguments accept '--shard i/N' and process only
+the shard i of N. Shards are 0-based, so 0 <= i < N, e.g.
+--shard $SLURM_ARRAY_TASK_ID/16 with --array=0-15. Records are assigned
+to shards by a hash of their content or identifier, or by byte ranges
+of the input, so every run assigns the same records to the same shard.
+Every shard writes its own output, see get_shard_path.
+
+Usage:
+    python sharding.py
+        -i {shard outputs to merge, in order}
+        -o {path to the merged output}
+        --unique {optional, key of JSON objects or CSV column, only the
+                  first record with given value is kept}
+        --reference {optional, key of JSON objects, instead of dropping
+                     a duplicate object write it as an object with the
+                     unique key, the reference key and 'duplicate' set
+                     to the reference of the first object}
+
+The format is given by the extension of the output file:
+    - '.csv' : CSV files with the same header
+    - '.npy' : bit-packed fingerprints with '.ids' files written by
+      graph_vertex_pairs.write_packed, --unique
+      removes repeated ids
+    - other : JSON arrays of objects or JSON Lines
+When merging objects with a duplicate reference, e.g. molecules from
+molecular_features/extract_fragments.py, use
+'--unique smiles --reference name', so molecules with the same canonical
+SMILES in different shards are written as duplicates as with
+--deduplicate in a single run.
+
+The module is shared by the script directories, the scripts add
+the common directory to sys.path.
+
+This file can also be used as a python script for import, in such case
+please use the add_arguments, is_in_shard and merge methods.
+"""
+
+import argparse
+import csv
+import hashlib
+import json
+import logging
+import os
+
+import numpy
+import numpy.lib.format
+
+import json_stream
+
+__author__ = 'Petr Škoda'
+__license__ = 'X11'
+__email__ = 'skoda@ksi.mff.cuni.cz'
+
+
+def parse_shard(value):
+    """Parse shard given as 'i/N' into (i, N), check that 0 <= i < N.
+
+    Raise ArgumentTypeError so argparse rejects invalid shard before
+    any work is done.
+
+    :param value:
+    :return:
+    """
+    try:
+        index, count = [int(item) for item in value.split('/')]
+    except ValueError:
+        raise argparse.ArgumentTypeError(
+            'Shard must be given as i/N: ' + value)
+    if not 0 <= index < count:
+        raise argparse.ArgumentTypeError(
+            'Shard index must be in range 0 to N - 1: ' + value)
+    return index, count
+
+
+def add_arguments(parser):
+    """Add the --shard argument to the argparse parser.
+
+    :param parser:
+    :return:
+    """
+    parser.add_argument('--shard', type=parse_shard, dest='shard',
+                        metavar='i/N',
+                        help='process only shard i of N, shards are '
+                             '0-based so i is from 0 to N - 1',
+                        required=False)
+
+
+def shard_of(key, count):
+    """Return shard of a record with given key.
+
+    The hash is stable across processes and Python versions.
+    :param key: String or bytes.
+    :param count: Number of shards.
+    :return:
+    """
+    if isinstance(key, str):
+        key = key.encode('utf-8')
+    digest = hashlib.md5(key).digest()
+    return int.from_bytes(digest[:8], 'little') % count
+
+
+def is_in_shard(key, shard):
+    """Return true if a record with given key belongs to the shard.
+
+    :param key: String or bytes.
+    :param shard: (i, N) or None for all records.
+    :return:
+    """
+    if shard is None:
+        return True
+    return shard_of(key, shard[1]) == shard[0]
+
+
+def get_shard_path(path, shard):
+    """Return output path for given shard.
+
+    The shard is inserted before the extension of the path.
+    :param path:
+    :param shard: (i, N) or None.
+    :return:
+    """
+    if shard is None:
+        return path
+    root, extension = os.path.splitext(path)
+    return '{}.shard-{}-of-{}{}'.format(root, shard[0], shard[1], extension)
+
+
+def create_parent_directory(path):
+    """Create directory if it does not exists.
+
+    :param path:
+    :return:
+    """
+    dir_name = os.path.dirname(path)
+    if not os.path.exists(dir_name) and not dir_name == "":
+        os.makedirs(dir_name)
+
+
+def _read_configuration():
+    """Get and return application settings.
+
+    :return:
+    """
+    parser = argparse.ArgumentParser(
+        description='Merge outputs of shards. '
+                    'See file header for more details.')
+    parser.add_argument('-i', type=str, dest='input', nargs='+',
+                        required=True)
+    parser.add_argument('-o', type=str, dest='output', required=True)
+    parser.add_argument('--unique', type=str, dest='unique',
+                        required=False)
+    parser.add_argument('--reference', type=str, dest='reference',
+                        required=False)
+    return vars(parser.parse_args())
+
+
+def merge_json(input_files, output_file, unique=None, reference=None):
+    """Merge JSON arrays of objects.
+
+    :param input_files:
+    :param output_file:
+    :param unique: Optional key, only the first object with given value
+        is written.
+    :param reference: Optional key, write duplicate objects as references
+        to the first object instead of dropping them.
+    :return: (number of written objects, number of duplicates)
+    """
+    seen = {}
+    counter = 0
+    duplicates = 0
+    with open(output_file, 'w') as output_stream:
+        output_stream.write('[')
+        for path in input_files:
+            with open(path, 'r') as input_stream:
+                for item in json_stream.read_json_array_stream(
+                        input_stream):
+                    if unique is not None:
+                        value = json.dumps(item[unique])
+                        if value in seen:
+                            duplicates += 1
+                            if reference is None:
+                                continue
+                            item = {
+                                reference: item[reference],
+                                unique: item[unique],
+                                'duplicate': seen[value]
+                            }
+                        else:
+                            seen[value] = None if reference is None \
+                                else item[reference]
+                    if counter > 0:
+                        output_stream.write(',\n')
+                    output_stream.write(json.dumps(item))
+                    counter += 1
+        output_stream.write(']')
+    return counter, duplicates
+
+
+def merge_csv(input_files, output_file, unique=None):
+    """Merge CSV files with the same header.
+
+    :param input_files:
+    :param output_file:
+    :param unique: Optional column name, only the first row with given
+        value is written.
+    :return: (number of written rows, number of duplicates)
+    """
+    seen = set()
+    header = None
+    counter = 0
+    duplicates = 0
+    with open(output_file, 'w', newline='') as output_stream:
+        writer = csv.writer(output_stream)
+        for path in input_files:
+            with open(path, 'r', newline='') as input_stream:
+                reader = csv.reader(input_stream)
+                file_header = next(reader, None)
+                if file_header is None:
+                    continue
+                if header is None:
+                    header = file_header
+                    writer.writerow(header)
+                    column = None if unique is None \
+                        else header.index(unique)
+                elif not header == file_header:
+                    raise Exception('Different CSV header in: ' + path)
+                for row in reader:
+                    if column is not None:
+                        if row[column] in seen:
+                            duplicates += 1
+                            continue
+                        seen.add(row[column])
+                    writer.writerow(row)
+                    counter += 1
+    return counter, duplicates
+
+
+def merge_packed(input_files, output_file, unique=False):
+    """Merge bit-packed fingerprints written by write_packed.
+
+    :param input_files:
+    :param output_file:
+    :param unique: If true only the first row with given id is written.
+    :return: (number of written rows, number of duplicates)
+    """
+    parts = []
+    seen = set()
+    columns = None
+    for path in input_files:
+        values = numpy.load(path, mmap_mode='r')
+        with open(path + '.ids', 'r') as stream:
+            ids = [line.rstrip('\n') for line in stream]
+        if len(ids) == 0:
+            continue
+        if columns is None:
+            columns = values.shape[1]
+        elif not columns == values.shape[1]:
+            raise Exception('Different fingerprint size in: ' + path)
+        rows = []
+        for row, id in enumerate(ids):
+            if unique and id in seen:
+                continue
+            seen.add(id)
+            rows.append(row)
+        parts.append((values, ids, rows))
+    counter = sum(len(rows) for _, _, rows in parts)
+    duplicates = sum(len(ids) for _, ids, _ in parts) - counter
+    if counter == 0:
+        numpy.save(output_file, numpy.zeros((0, columns or 0),
+                                            dtype=numpy.uint8))
+        open(output_file + '.ids', 'w').close()
+        return counter, duplicates
+    output = numpy.lib.format.open_memmap(
+        output_file, mode='w+', dtype=numpy.uint8, shape=(counter, columns))
+    position = 0
+    with open(output_file + '.ids', 'w') as ids_stream:
+        for values, ids, rows in parts:
+            output[position:position + len(rows)] = values[rows]
+            position += len(rows)
+            for row in rows:
+                ids_stream.write(ids[row])
+                ids_stream.write('\n')
+    output.flush()
+    return counter, duplicates
+
+
+def merge(input_files, output_file, unique=None, reference=None):
+    """Merge outputs of shards, the format is given by output extension.
+
+    :param input_files: Paths in order of the merged output.
+    :param output_file:
+    :param unique: See merge_json and merge_csv, for packed fingerprints
+        any value removes repeated ids.
+    :param reference: See merge_json.
+    :return: (number of written records, number of duplicates)
+    """
+    create_parent_directory(output_file)
+    extension = os.path.splitext(output_file)[1].lower()
+    if extension == '.csv':
+        return merge_csv(input_files, output_file, unique)
+    elif extension == '.npy':
+        return merge_packed(input_files, output_file, unique is not None)
+    else:
+        return merge_json(input_files, output_file, unique, reference)
+
+
+def _main():
+    logging.basicConfig(
+        level=logging.DEBUG,
+        format='%(asctime)s [%(levelname)s] %(module)s - %(message)s',
+        datefmt='%H:%M:%S')
+    configuration = _read_configuration()
+    counter, duplicates = merge(
+        configuration['input'], configuration['output'],
+        configuration['unique'], configuration['reference'])
+    logging.info('Merged %d files, records: %d, duplicates: %d',
+                 len(configuration['input']), counter, duplicates)
+
+
+if __name__ == '__main__':
+    _main()
@@ -0,0 +1,302 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Benchmark the molecular features pipeline on generated molecules.
+
+Usage:
+    python benchmark.py
+        -o {path to output JSON report}
+        -s {optional, comma separated list of input sizes, default 100,1000}
+        -f {optional, comma separated list of fragment types,
+            default tt.3,tt.4,ecfp.1,ecfp.2}
+        -p {optional, path to the PaDEL directory, if given PaDEL
+            descriptors are benchmarked as well}
+        --keep {optional, directory to keep the generated files in}
+
+Molecules are generated from embedded seed SMILES, so the inputs are the
+same on every machine. For every input size following stages are timed:
+    - load_sdf, load_smi : loading of the generated SDF and SMI files
+    - extract_{type} : extraction of every fragment type on its own
+    - extract_all : extraction of all fragment types together
+    - write_json : writing of the extracted fragments into JSON
+    - rdkit_{family} : RDKit descriptors of fragments per family
+    - padel : PaDEL descriptors of fragments
+    - end_to_end : extract_fragments followed by RDKit descriptors
+The report contains seconds and molecules per second for every stage.
+"""
+
+import os
+import argparse
+import logging
+import json
+import platform
+import shutil
+import tempfile
+import time
+import rdkit
+import rdkit.Chem
+
+import extract_fragments
+import rdkit_descriptors
+import padel_descriptors
+
+__author__ = 'Petr Škoda'
+__license__ = 'X11'
+__email__ = 'skoda@ksi.mff.cuni.cz'
+
+# First atom of every seed has a free valence, so an alkyl chain can be
+# put in front of the SMILES.
+_seed_smiles = [
+    'CC(=O)Oc1ccccc1C(=O)O',
+    'CC(C)Cc1ccc(cc1)C(C)C(=O)O',
+    'CN1C=NC2=C1C(=O)N(C(=O)N2C)C',
+    'CC(=O)Nc1ccc(O)cc1',
+    'COc1ccc2cc(ccc2c1)C(C)C(=O)O',
+    'CN1CCC23C4C1CC5=C2C(=C(C=C5)O)OC3C(C=C4)O',
+    'CN1C(=O)CN=C(c2ccccc2)c2cc(Cl)ccc21',
+    'CCN(CC)CCOC(=O)c1ccc(N)cc1',
+    'CC1=C(C(=O)N(N1C)c1ccccc1)N(C)C',
+    'Nc1nc(=O)c2nc[nH]c2[nH]1',
+    'OCC1OC(O)C(O)C(O)C1O',
+    'CC(C)NCC(O)COc1cccc2ccccc12',
+    'Cc1onc(c1C(=O)NC1C2SC(C)(C)C(N2C1=O)C(=O)O)-c1ccccc1',
+    'CS(=O)(=O)Nc1ccc(cc1)[N+](=O)[O-]',
+    'OC1(CCN(CCCC(=O)c2ccc(F)cc2)CC1)c1ccc(Cl)cc1',
+    'OC(=O)CCc1ccc(O)c(O)c1',
+    'c1ccc2c(c1)ccc1ccccc12',
+    'Oc1ccc(cc1)C1=COc2cc(O)cc(O)c2C1=O',
+    'CC12CCC3C(CCc4cc(O)ccc34)C1CCC2O',
+    'NC(=O)c1cccnc1'
+]
+
+# Substituents of the carbon atoms in the chain put in front of a seed.
+# There is no carbon substituent, as methyl on the first carbon would be
+# the same molecule as a longer chain.
+_substituents = ['', '(O)', '(N)', '(F)', '(Cl)']
+
+_default_fragments = 'tt.3,tt.4,ecfp.1,ecfp.2'
+
+
+def _create_chain(index):
+    """Return alkyl chain SMILES for given index.
+
+    The index is written in bijective numeration with a digit for every
+    substituent, so every index gives a different chain and the length of
+    the chain grows only logarithmically with the index.
+    :param index:
+    :return:
+    """
+    result = ''
+    while index > 0:
+        index -= 1
+        result += 'C' + _substituents[index % len(_substituents)]
+        index //= len(_substituents)
+    return result
+
+
+def generate_smiles(count):
+    """Return list of count (name, SMILES) for reproducible molecules.
+
+    The molecules are seeds prefixed with chains of substituted carbons,
+    the chains are different for every round over the seeds, so all
+    the molecules are unique.
+    :param count:
+    :return:
+    """
+    result = []
+    for index in range(count):
+        seed = _seed_smiles[index % len(_seed_smiles)]
+        chain = _create_chain(index // len(_seed_smiles))
+        result.append(('molecule-' + str(index), chain + seed))
+    return result
+
+
+def write_inputs(molecules, directory):
+    """Write molecules into SDF and SMI file and return paths to them.
+
+    :param molecules: List of (name, SMILES).
+    :param directory:
+    :return: (path to SDF, path to SMI)
+    """
+    sdf_path = os.path.join(directory, 'molecules.sdf')
+    smi_path = os.path.join(directory, 'molecules.smi')
+    writer = rdkit.Chem.SDWriter(sdf_path)
+    with open(smi_path, 'w') as stream:
+        for name, smiles in molecules:
+            molecule = rdkit.Chem.MolFromSmiles(smiles)
+            molecule.SetProp('_Name', name)
+            writer.write(molecule)
+            stream.write(smiles)
+            stream.write('\n')
+    writer.close()
+    return sdf_path, smi_path
+
+
+def _parse_fragments(value):
+    result = []
+    for item in value.split(','):
+        name, size = item.split('.')
+        result.append({'name': name, 'size': int(size)})
+    return result
+
+
+def _get_descriptor_family(name):
+    """Return name of family for RDKit descriptor of given name."""
+    if name.startswith('fr_'):
+        return 'fragment_counts'
+    elif 'VSA' in name:
+        return 'vsa'
+    elif 'EState' in name:
+        return 'estate'
+    elif name.startswith(('Chi', 'Kappa', 'BalabanJ', 'BertzCT', 'Ipc',
+                          'HallKierAlpha')):
+        return 'topological'
+    else:
+        return 'constitutional'
+
+
+def _time(times, name, function, *args):
+    start = time.perf_counter()
+    result = function(*args)
+    times[name] = time.perf_counter() - start
+    return result
+
+
+def run_benchmark(size, fragments, directory, padel_path=None):
+    """Time all stages for given number of molecules.
+
+    :param size: Number of molecules.
+    :param fragments: Fragment types, see extract_fragments.
+    :param directory: Working directory for generated files.
+    :param padel_path: Optional path to PaDEL.
+    :return: Report object.
+    """
+    options = {
+        'kekule': False,
+        'isomeric': False,
+        'fragments': fragments
+    }
+    sdf_path, smi_path = write_inputs(generate_smiles(size), directory)
+    times = {}
+    # Loading.
+    molecules = _time(times, 'load_sdf', list,
+                      extract_fragments.load_sdf(sdf_path))
+    _time(times, 'load_smi', list, extract_fragments.load_smi(smi_path))
+    # Fragments extraction.
+    for fragment_type in fragments:
+        name = 'extract_' + fragment_type['name'] + '.' + \
+               str(fragment_type['size'])
+        _time(times, name, lambda: [
+            extract_fragments.extract_fragments_from_molecule(
+                molecule, [fragment_type], options)
+            for molecule in molecules])
+    items = _time(times, 'extract_all', lambda: [{
+        'name': molecule.GetProp('_Name'),
+        'smiles': rdkit.Chem.MolToSmiles(molecule),
+        'fragments': extract_fragments.extract_fragments_from_molecule(
+            molecule, fragments, options)
+    } for molecule in molecules])
+    # Writing.
+    fragments_path = os.path.join(directory, 'fragments.json')
+
+    def write_json():
+        holder = {'first': True}
+        with open(fragments_path, 'w') as stream:
+            stream.write('[')
+            for item in items:
+                extract_fragments.append_object_to_json(stream, item, holder)
+            stream.write(']')
+
+    _time(times, 'write_json', write_json)
+    # Descriptors.
+    families = {}
+    for name in rdkit_descriptors._names:
+        families.setdefault(_get_descriptor_family(name), []).append(name)
+    descriptors_path = os.path.join(directory, 'descriptors.csv')
+    for family, names in sorted(families.items()):
+        _time(times, 'rdkit_' + family, rdkit_descriptors.compute_descriptors,
+              fragments_path, descriptors_path, True, names)
+    if padel_path is not None:
+        _time(times, 'padel', padel_descriptors.compute_descriptors,
+              fragments_path, descriptors_path, True, padel_path)
+    # End to end.
+
+    def end_to_end():
+        extract_fragments.extract_fragments(
+            [sdf_path], 'sdf', fragments_path, options)
+        return rdkit_descriptors.compute_descriptors(
+            fragments_path, descriptors_path, True)
+
+    summary = _time(times, 'end_to_end', end_to_end)
+    #
+    report = {
+        'molecules': len(molecules),
+        'fragments': sum(len(item['fragments']) for item in items),
+        'unique_fragments': summary['total'],
+        'stages': {}
+    }
+    for name, value in times.items():
+        report['stages'][name] = {
+            'seconds': value,
+            'molecules_per_second': size / value if value > 0 else None
+        }
+    return report
+
+
+def _read_configuration():
+    """Get and return application settings.
+
+    :return:
+    """
+    parser = argparse.ArgumentParser(
+        description='Benchmark molecular features pipeline. '
+                    'See file header for more details.')
+    parser.add_argument('-o', type=str, dest='output', required=True)
+    parser.add_argument('-s', type=str, dest='sizes', default='100,1000')
+    parser.add_argument('-f', type=str, dest='fragments',
+                        default=_default_fragments)
+    parser.add_argument('-p', type=str, dest='padel', required=False)
+    parser.add_argument('--keep', type=str, dest='keep', required=False)
+    configuration = vars(parser.parse_args())
+    configuration['sizes'] = [int(x) for x in
+                              configuration['sizes'].split(',')]
+    return configuration
+
+
+def _main():
+    logging.basicConfig(
+        level=logging.DEBUG,
+        format='%(asctime)s [%(levelname)s] %(module)s - %(message)s',
+        datefmt='%H:%M:%S')
+    configuration = _read_configuration()
+    fragments = _parse_fragments(configuration['fragments'])
+    report = {
+        'python': platform.python_version(),
+        'rdkit': rdkit.__version__,
+        'machine': platform.machine(),
+        'cpu_count': os.cpu_count(),
+        'fragments': configuration['fragments'],
+        'results': []
+    }
+    for size in configuration['sizes']:
+        if configuration['keep'] is None:
+            directory = tempfile.mkdtemp()
+        else:
+            directory = os.path.join(configuration['keep'], str(size))
+            os.makedirs(directory, exist_ok=True)
+        try:
+            result = run_benchmark(size, fragments, directory,
+                                   configuration['padel'])
+        finally:
+            if configuration['keep'] is None:
+                shutil.rmtree(directory)
+        for name, value in sorted(result['stages'].items()):
+            logging.info('%d %s: %.3f s', size, name, value['seconds'])
+        report['results'].append(result)
+    #
+    extract_fragments.create_parent_directory(configuration['output'])
+    with open(configuration['output'], 'w') as stream:
+        json.dump(report, stream, indent=2)
+
+
+if __name__ == '__main__':
+    _main()
@@ -11,8 +11,23 @@ Usage:
         -f {optional, comma separated list of fragment types to extract}
 
         -t {type of input files, 'sdf', 'smi'. Default is 'sdf'}
+        -p {optional, number of processes used to parse input, 0 for
+            the number of CPUs. Default is 1}
+        --deduplicate {optional, 'memory' or 'disk', skip extraction for
+            molecules with already seen canonical SMILES}
+        --aggregate {list every distinct fragment of a molecule once}
+        --representative {write one circular fragment per identifier}
+        --encoder {optional, JSON encoder to use 'json' or 'orjson' if
+            installed. Default is 'json'}
         --kekule {generated kekule form of SMILES for fragments}
         --isomeric {put stereochemistry information into fragments SMILES}
+        --max-path-matches {optional, maximum number of tt fragments of
+            every size in a molecule. Default is 1000}
+        --metrics {optional, JSON Lines file to append metrics to}
+        --metrics-interval {metrics emission interval in seconds}
+        --prometheus {optional, Prometheus text file to write metrics to}
+        --shard {optional, process only shard i of N given as i/N,
+                 0 <= i < N}
 
 Fragments type:
     - tt.{SIZE}
@@ -22,6 +37,34 @@ where {SIZE} should be replaced by required fragment size. Usage example:
 default value:
     tt.3
 
+SMI files contain a SMILES and optionally a name separated by white space
+on every line. If the name is missing the SMILES is used as the name.
+Input files with '.gz' extension are decompressed on the fly.
+Uncompressed SDF files are parsed by RDKit multithreaded supplier when
+more processes are used, so the order of molecules may change.
+
+With --deduplicate fragments are extracted only for the first molecule
+with given canonical SMILES. Every other such molecule is written
+without fragments and with 'duplicate' set to the name of the first one.
+The 'memory' mode keeps the seen SMILES in memory, the 'disk' mode stores
+them in a dbm database next to the output file, use it for libraries
+that do not fit into memory.
+
+With --aggregate every distinct fragment of a molecule is written once
+with 'count' property holding the number of its occurrences.
+With --representative only one environment for every ECFP identifier
+in a molecule is converted into SMILES and the fragment is written with
+'count' of environments with this identifier. Environments with the same
+identifier usually have the same SMILES, so this rarely changes
+the generated fragments and saves most of the ECFP extraction time for
+symmetric molecules.
+
+With --shard only a part of the molecules is processed and the output
+is written into a file with the shard in the name, see common/sharding.py.
+Uncompressed SDF files are split into byte ranges aligned to records,
+SMI lines and records of compressed SDF files are assigned to shards by
+a hash of their content. Use common/sharding.py to merge the outputs.
+
 Kekule smiles form has no aromatic bonds. Use of --kekule option thus may
 reduce the number of generated unique fragments.
 
@@ -31,17 +74,45 @@ use the extract_fragments method.
 
 import os
 import argparse
+import collections
+import dbm
+import gzip
+import io
+import itertools
 import logging
 import json
+import multiprocessing
+import shutil
+import sys
+import tempfile
 import rdkit
 import rdkit.Chem
 from rdkit.Chem import AllChem
 import rdkit.Chem.AtomPairs.Utils
 
+# Modules shared by the script directories.
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             os.pardir, 'common'))
+import instrumentation
+import sharding
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 __author__ = 'Petr Škoda'
 __license__ = 'X11'
 __email__ = 'skoda@ksi.mff.cuni.cz'
 
+# Fragments are kept as tuples, dictionaries are created only when
+# the fragments are written, see append_object_to_json.
+Fragment = collections.namedtuple(
+    'Fragment', ['smiles', 'index', 'type', 'size'])
+
+CountedFragment = collections.namedtuple(
+    'CountedFragment', Fragment._fields + ('count',))
+
 # region Path fragments
 
 atom_code = {
@@ -105,7 +176,18 @@ def get_atom_code(atom, branch_subtract):
     return code
 
 
-def score_path(molecule, path, size):
+def score_path(molecule, path, size, atom_codes=None):
+    """Return index of the path fragment.
+
+    :param molecule:
+    :param path: Indexes of atoms on the path.
+    :param size:
+    :param atom_codes: Optional dictionary used to cache the atom codes
+        between calls for the same molecule.
+    :return:
+    """
+    if atom_codes is None:
+        atom_codes = {}
     codes = [None] * size
     for i in range(size):
         if i == 0 or i == (size - 1):
@@ -113,7 +195,11 @@ def score_path(molecule, path, size):
         else:
             sub = 2
         # We use this branch airways as we do not use custom atomCodes.
-        codes[i] = get_atom_code(molecule.GetAtomWithIdx(path[i]), sub)
+        key = (path[i], sub)
+        if key not in atom_codes:
+            atom_codes[key] = get_atom_code(
+                molecule.GetAtomWithIdx(path[i]), sub)
+        codes[i] = atom_codes[key]
 
     # We scan the vector for both sides, we want to make sure that
     # the begging is less or equal to the end.
@@ -138,20 +224,62 @@ def score_path(molecule, path, size):
     return accum
 
 
-def extract_path_fragments(molecule, size, options):
+# Default limit of path matches for every size, the RDKit default.
+# Paths of large molecules above the limit are dropped, use
+# --max-path-matches to raise it.
+_MAX_PATH_MATCHES = 1000
+
+# SMARTS patterns of paths by size.
+_path_patterns = {}
+
+
+def find_paths(molecule, sizes, max_matches=_MAX_PATH_MATCHES):
+    """Return atom paths of all given sizes.
+
+    For every size the paths are the unique matches of '*~*~...~*' SMARTS
+    pattern of given size, i.e. one path for every set of atoms. Every size
+    is matched on its own, as paths that can not be extended are not part
+    of any longer path. The patterns are compiled only once.
+    :param molecule:
+    :param sizes: List of path sizes in atoms.
+    :param max_matches: Maximum number of paths of every size.
+    :return: Dictionary with list of paths for every size.
+    """
+    paths = {}
+    for size in sizes:
+        if size not in _path_patterns:
+            _path_patterns[size] = rdkit.Chem.MolFromSmarts(
+                '*' + ('~*' * (size - 1)))
+        paths[size] = list(molecule.GetSubstructMatches(
+            _path_patterns[size], maxMatches=max_matches))
+    return paths
+
+
+def extract_path_fragments(molecule, size, options, paths=None,
+                           atom_codes=None):
+    """Extract and return path fragments.
+
+    :param molecule:
+    :param size:
+    :param options:
+    :param paths: Optional paths of given size, see find_paths.
+    :param atom_codes: Optional atom codes cache, see score_path.
+    :return:
+    """
     output = []
-    pattern = rdkit.Chem.MolFromSmarts('*' + ('~*' * (size - 1)))
-    for atoms in molecule.GetSubstructMatches(pattern):
+    if paths is None:
+        paths = find_paths(molecule, [size], options.get(
+            'max_path_matches', _MAX_PATH_MATCHES))[size]
+    if atom_codes is None:
+        atom_codes = {}
+    for atoms in paths:
         smiles = rdkit.Chem.MolFragmentToSmiles(
             molecule, atomsToUse=list(atoms),
             kekuleSmiles=options['kekule'],
             isomericSmiles=options['isomeric'])
-        output.append({
-            'smiles': smiles,
-            'index': score_path(molecule, atoms, size),
-            'type': 'TT',
-            'size': size
-        })
+        output.append(Fragment(sys.intern(smiles),
+                               score_path(molecule, atoms, size, atom_codes),
+                               'TT', size))
     return output
 
 
@@ -159,49 +287,75 @@ def extract_path_fragments(molecule, size, options):
 
 # region Circular fragments
 
-def extract_neighbourhood_fragments(molecule, size, options):
+def get_bond_atoms(molecule):
+    """Return list with (begin atom, end atom) for every bond."""
+    return [(bond.GetBeginAtomIdx(), bond.GetEndAtomIdx())
+            for bond in molecule.GetBonds()]
+
+
+def extract_neighbourhood_fragments(molecule, size, options, info=None,
+                                    bond_atoms=None):
     """Extract and return circular fragments.
 
+    If options['representative'] is true only the first environment
+    of every identifier is converted to SMILES and returned as
+    CountedFragment with number of environments with the identifier.
+    The number is taken from the bit info, so the other environments
+    are not assembled at all.
     :param molecule:
     :param size:
     :param options:
+    :param info: Optional Morgan fingerprint bit info computed with radius
+        at least size.
+    :param bond_atoms: Optional output of get_bond_atoms.
     :return:
     """
     output = []
-    info = {}
-    AllChem.GetMorganFingerprint(molecule, radius=size, bitInfo=info)
+    if info is None:
+        info = {}
+        AllChem.GetMorganFingerprint(molecule, radius=size, bitInfo=info)
+    if bond_atoms is None:
+        bond_atoms = get_bond_atoms(molecule)
+    representative = options.get('representative', False)
     for element in info:
-        for item in info[element]:
-            # item = [rooted atom, radius]
-            if item[1] < size:
-                continue
+        # item = [rooted atom, radius], environments of radius zero
+        # contain no bonds.
+        roots = [item[0] for item in info[element]
+                 if item[1] == size and size > 0]
+        if len(roots) == 0:
+            continue
+        # The occurrences are counted from the bit info, the environment
+        # is assembled only for the representative.
+        count = len(roots)
+        if representative:
+            roots = roots[:1]
+        for root in roots:
             # assemble fragments into atom
             env = rdkit.Chem.FindAtomEnvironmentOfRadiusN(
-                molecule, item[1], item[0])
+                molecule, size, root)
+            # check if we have some atoms
+            if len(env) == 0:
+                continue
             atoms = set()
             for bidx in env:
-                atoms.add(molecule.GetBondWithIdx(bidx).GetBeginAtomIdx())
-                atoms.add(molecule.GetBondWithIdx(bidx).GetEndAtomIdx())
-            # check if we have some atoms
-            if len(atoms) > 0:
-                try:
-                    # kekuleSmiles - we may lost some information
-                    # about aromatic atoms, but if we do not kekulize
-                    # we can get invalid smiles
-                    smiles = rdkit.Chem.MolFragmentToSmiles(
-                        molecule, atomsToUse=list(atoms), bondsToUse=env,
-                        rootedAtAtom=item[0], kekuleSmiles=options['kekule'],
-                        isomericSmiles=options['isomeric'])
-                except Exception:
-                    logging.exception('Invalid fragment detected.')
-                    logging.info('Molecule: %s', molecule.GetProp('_Name'))
-                    logging.info('Atoms: %s', ','.join([str(x) for x in atoms]))
-                output.append({
-                    'smiles': smiles,
-                    'index': element,
-                    'type': 'ECFP',
-                    'size': size
-                })
+                atoms.update(bond_atoms[bidx])
+            try:
+                # kekuleSmiles - we may lost some information
+                # about aromatic atoms, but if we do not kekulize
+                # we can get invalid smiles
+                smiles = rdkit.Chem.MolFragmentToSmiles(
+                    molecule, atomsToUse=list(atoms), bondsToUse=env,
+                    rootedAtAtom=root, kekuleSmiles=options['kekule'],
+                    isomericSmiles=options['isomeric'])
+            except Exception:
+                logging.exception('Invalid fragment detected.')
+                logging.info('Molecule: %s', molecule.GetProp('_Name'))
+                logging.info('Atoms: %s', ','.join([str(x) for x in atoms]))
+            fragment = Fragment(sys.intern(smiles), element, 'ECFP', size)
+            if representative:
+                output.append(CountedFragment._make(fragment + (count,)))
+            else:
+                output.append(fragment)
     return output
 
 
@@ -213,19 +367,51 @@ def extract_fragments_from_molecule(molecule, types, options):
     :param molecule:
     :param types: Types of fragments to extract.
     :param options
-    :return:
+    :return: List of Fragment or CountedFragment.
     """
+    # Atom codes and Morgan environments are shared by all sizes.
+    path_sizes = [item['size'] for item in types if item['name'] == 'tt']
+    if len(path_sizes) > 0:
+        paths = find_paths(molecule, path_sizes, options.get(
+            'max_path_matches', _MAX_PATH_MATCHES))
+        atom_codes = {}
+    circular_sizes = [item['size'] for item in types
+                      if item['name'] == 'ecfp']
+    if len(circular_sizes) > 0:
+        info = {}
+        AllChem.GetMorganFingerprint(molecule, radius=max(circular_sizes),
+                                     bitInfo=info)
+        bond_atoms = get_bond_atoms(molecule)
     output = []
     for item in types:
         if item['name'] == 'tt':
             output.extend(extract_path_fragments(
-                molecule, item['size'], options))
+                molecule, item['size'], options, paths[item['size']],
+                atom_codes))
         elif item['name'] == 'ecfp':
             output.extend(extract_neighbourhood_fragments(
-                molecule, item['size'], options))
+                molecule, item['size'], options, info, bond_atoms))
     return output
 
 
+def aggregate_fragments(fragments):
+    """Return distinct fragments with number of their occurrences.
+
+    The fragments are returned in order of their first occurrence.
+    :param fragments: Output of extract_fragments_from_molecule.
+    :return: List of CountedFragment.
+    """
+    counts = collections.OrderedDict()
+    for fragment in fragments:
+        if isinstance(fragment, CountedFragment):
+            key = Fragment._make(fragment[:-1])
+            counts[key] = counts.get(key, 0) + fragment.count
+        else:
+            counts[fragment] = counts.get(fragment, 0) + 1
+    return [CountedFragment._make(fragment + (count,))
+            for fragment, count in counts.items()]
+
+
 def _read_configuration():
     """Get and return application settings.
 
@@ -238,12 +424,26 @@ def _read_configuration():
     parser.add_argument('-o', type=str, dest='output', required=True)
     parser.add_argument('-f', type=str, dest='fragments', required=False)
     parser.add_argument('-t', type=str, dest='input_type', default='sdf')
+    parser.add_argument('-p', type=int, dest='processes', default=1)
+    parser.add_argument('--deduplicate', type=str, dest='deduplicate',
+                        choices=['memory', 'disk'], required=False)
+    parser.add_argument('--aggregate', dest='aggregate',
+                        action='store_true', required=False)
+    parser.add_argument('--representative', dest='representative',
+                        action='store_true', required=False)
+    parser.add_argument('--encoder', type=str, dest='encoder',
+                        choices=sorted(_json_encoders.keys()),
+                        default='json')
     parser.add_argument('--recursive', dest='recursive', action='store_true',
                         required=False)
     parser.add_argument('--kekule', dest='kekule',
                         action='store_true', required=False)
     parser.add_argument('--isomeric', dest='isomeric',
                         action='store_true', required=False)
+    parser.add_argument('--max-path-matches', type=int,
+                        dest='max_path_matches', default=_MAX_PATH_MATCHES)
+    instrumentation.add_arguments(parser)
+    sharding.add_arguments(parser)
 
     configuration = vars(parser.parse_args());
 
@@ -267,37 +467,283 @@ def _read_configuration():
     return configuration
 
 
-def load_sdf(path):
-    """Generate molecules from SDF file.
+def _create_sdf_supplier(path, processes):
+    """Return molecule supplier for given uncompressed SDF file.
 
+    For more processes the multithreaded supplier is used if available,
+    in such case the order of molecules may differ from the order in
+    the file.
     :param path:
-    :param types:
+    :param processes:
+    :return:
     """
-    logging.info('Loading (SDF): %s' % path)
-    for molecule in rdkit.Chem.SDMolSupplier(path):
+    if processes > 1 and hasattr(rdkit.Chem, 'MultithreadedSDMolSupplier'):
+        return rdkit.Chem.MultithreadedSDMolSupplier(
+            path, numWriterThreads=processes)
+    return rdkit.Chem.SDMolSupplier(path)
+
+
+def _skip_invalid_molecules(supplier, metrics):
+    """Generate valid molecules from the supplier, log invalid ones.
+
+    :param supplier:
+    :param metrics: Optional instrumentation.Metrics.
+    :return:
+    """
+    for molecule in supplier:
         if molecule is None:
             logging.error('Invalid molecule detected.')
+            if metrics is not None:
+                metrics.increment('invalid_molecules')
             continue
         yield molecule
 
 
-def load_smi(path):
+def _load_sdf_shard(path, shard, metrics):
+    """Generate molecules of given shard from SDF file.
+
+    Uncompressed files are split by split_sdf, records of compressed files
+    are selected by a hash of their content.
+    :param path:
+    :param shard: (i, N)
+    :param metrics: Optional instrumentation.Metrics.
+    :return:
+    """
+    if not path.lower().endswith('.gz'):
+        ranges = split_sdf(path, shard[1])
+        if shard[0] < len(ranges):
+            start, end = ranges[shard[0]]
+            for molecule in load_sdf_range(path, start, end, metrics):
+                yield molecule
+        return
+    lines = []
+    record = []
+    with gzip.open(path, 'rb') as stream:
+        for line in stream:
+            record.append(line)
+            if not line.startswith(b'$$$$'):
+                continue
+            if sharding.is_in_shard(b''.join(record), shard):
+                lines.extend(record)
+            record = []
+            # Parse whole records in blocks.
+            if len(lines) >= _SDF_BLOCK_LINES:
+                for molecule in _parse_sdf_block(lines, metrics):
+                    yield molecule
+                lines = []
+    if len(record) > 0 and sharding.is_in_shard(b''.join(record), shard):
+        lines.extend(record)
+    if len(lines) > 0:
+        for molecule in _parse_sdf_block(lines, metrics):
+            yield molecule
+
+
+def load_sdf(path, metrics=None, processes=1, shard=None):
+    """Generate molecules from SDF file.
+
+    :param path:
+    :param metrics: Optional instrumentation.Metrics.
+    :param processes: Number of parsing threads, 0 for the number of CPUs.
+    :param shard: Optional (i, N), load only molecules of given shard.
+    """
+    logging.info('Loading (SDF): %s' % path)
+    if shard is not None:
+        for molecule in _load_sdf_shard(path, shard, metrics):
+            yield molecule
+        return
+    if path.lower().endswith('.gz'):
+        # Compressed files are read by a forward supplier.
+        with gzip.open(path, 'rb') as stream:
+            for molecule in _skip_invalid_molecules(
+                    rdkit.Chem.ForwardSDMolSupplier(stream), metrics):
+                yield molecule
+        return
+    if processes == 0:
+        processes = os.cpu_count() or 1
+    for molecule in _skip_invalid_molecules(
+            _create_sdf_supplier(path, processes), metrics):
+        yield molecule
+
+
+def split_sdf(path, parts):
+    """Split uncompressed SDF file into byte ranges aligned to records.
+
+    The file is not scanned, only a part of a record around every split
+    point is read.
+    :param path:
+    :param parts: Required number of ranges.
+    :return: List of (start, end) offsets, may be shorter than parts.
+    """
+    size = os.path.getsize(path)
+    boundaries = [0]
+    with open(path, 'rb') as stream:
+        for index in range(1, parts):
+            stream.seek(max(boundaries[-1], size * index // parts))
+            # The first line may be incomplete, so skip it.
+            stream.readline()
+            while True:
+                line = stream.readline()
+                if len(line) == 0 or line.startswith(b'$$$$'):
+                    break
+            position = stream.tell()
+            if boundaries[-1] < position < size:
+                boundaries.append(position)
+    boundaries.append(size)
+    return list(zip(boundaries[:-1], boundaries[1:]))
+
+
+def _parse_sdf_block(lines, metrics):
+    supplier = rdkit.Chem.SDMolSupplier()
+    supplier.SetData(b''.join(lines).decode('utf-8', 'replace'))
+    for molecule in _skip_invalid_molecules(supplier, metrics):
+        yield molecule
+
+
+def load_sdf_range(path, start, end, metrics=None):
+    """Generate molecules from records starting in given byte range.
+
+    Use split_sdf to get offsets of records.
+    :param path: Path to uncompressed SDF file.
+    :param start: Offset of the first record.
+    :param end: Offset after the last record.
+    :param metrics: Optional instrumentation.Metrics.
+    :return:
+    """
+    logging.info('Loading (SDF): %s [%d, %d)' % (path, start, end))
+    with open(path, 'rb', buffering=_BUFFER_SIZE) as stream:
+        stream.seek(start)
+        position = start
+        lines = []
+        while position < end:
+            line = stream.readline()
+            if len(line) == 0:
+                break
+            position += len(line)
+            lines.append(line)
+            # Parse whole records in blocks.
+            if line.startswith(b'$$$$') and len(lines) >= _SDF_BLOCK_LINES:
+                for molecule in _parse_sdf_block(lines, metrics):
+                    yield molecule
+                lines = []
+        if len(lines) > 0:
+            for molecule in _parse_sdf_block(lines, metrics):
+                yield molecule
+
+
+def open_input(path):
+    """Open text file for reading, decompress files with '.gz' extension.
+
+    :param path:
+    :return: Buffered text stream.
+    """
+    if path.lower().endswith('.gz'):
+        return io.TextIOWrapper(io.BufferedReader(
+            gzip.open(path, 'rb'), _BUFFER_SIZE))
+    return open(path, 'r', buffering=_BUFFER_SIZE)
+
+
+def _parse_smiles_line(line):
+    """Return molecule and name for a SMI line, or None for an empty line.
+
+    The molecule is None if the SMILES is not valid.
+    :param line:
+    :return:
+    """
+    columns = line.split(None, 1)
+    if len(columns) == 0:
+        return None
+    if len(columns) == 1:
+        name = columns[0]
+    else:
+        name = columns[1].strip()
+    return rdkit.Chem.MolFromSmiles(columns[0]), name
+
+
+def _parse_smiles_block(lines):
+    """Parse a block of SMI lines in a worker process.
+
+    Molecules are returned in RDKit binary format, which is faster to
+    transfer and restore than SMILES.
+    :param lines:
+    :return: List of (binary molecule or None, name).
+    """
+    result = []
+    for line in lines:
+        parsed = _parse_smiles_line(line)
+        if parsed is None:
+            continue
+        molecule, name = parsed
+        if molecule is None:
+            result.append((None, name))
+        else:
+            result.append((molecule.ToBinary(), name))
+    return result
+
+
+def _read_smiles_parallel(stream, processes):
+    """Generate (molecule, name) for lines parsed by a process pool.
+
+    At most two blocks per process are in flight, the input order is
+    preserved.
+    :param stream:
+    :param processes:
+    :return:
+    """
+    pool = multiprocessing.Pool(processes)
+    try:
+        pending = collections.deque()
+        while True:
+            lines = list(itertools.islice(stream, _SMILES_BLOCK_SIZE))
+            if len(lines) > 0:
+                pending.append(pool.apply_async(
+                    _parse_smiles_block, (lines,)))
+            if len(pending) == 0:
+                break
+            if len(lines) > 0 and len(pending) < 2 * processes:
+                continue
+            for binary, name in pending.popleft().get():
+                if binary is None:
+                    yield None, name
+                else:
+                    yield rdkit.Chem.Mol(binary), name
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def load_smi(path, metrics=None, processes=1, shard=None):
     """Generate molecules from SMI file.
 
     :param path:
+    :param metrics: Optional instrumentation.Metrics.
+    :param processes: Number of parsing processes, 0 for the number of CPUs.
+    :param shard: Optional (i, N), load only lines of given shard.
     :return:
     """
     logging.info('Loading (SMI): %s' % path)
-    with open(path, 'r') as stream:
-        for line in stream:
-            line = line.strip()
-            molecule = rdkit.Chem.MolFromSmiles(line)
+    if processes == 0:
+        processes = os.cpu_count() or 1
+    with open_input(path) as input_stream:
+        if shard is None:
+            stream = input_stream
+        else:
+            stream = (line for line in input_stream
+                      if sharding.is_in_shard(line.strip(), shard))
+        if processes == 1:
+            molecules = (_parse_smiles_line(line) for line in stream)
+        else:
+            molecules = _read_smiles_parallel(stream, processes)
+        for item in molecules:
+            if item is None:
+                continue
+            molecule, name = item
             if molecule is None:
-                logging.error('Invalid molecule detected.')
+                logging.error('Invalid molecule detected: %s', name)
+                if metrics is not None:
+                    metrics.increment('invalid_molecules')
                 continue
-            # Molecules created from SMILES does not have any name,
-            # so we use the SMILES as a name.
-            molecule.SetProp('_Name', line)
+            molecule.SetProp('_Name', name)
             yield molecule
 
 
@@ -317,25 +763,45 @@ def recursive_scan_for_input(path, recursive, extension):
                 result.extend(recursive_scan_for_input(
                     file_path, recursive, extension))
         elif os.path.isfile(file_path) \
-                and file_name.lower().endswith(extension):
+                and file_name.lower().endswith((extension,
+                                                extension + '.gz')):
             result.append(file_path)
     return result
 
 
-def append_object_to_json(output_stream, item, holder):
+def _encode_orjson(value):
+    return orjson.dumps(value).decode('utf-8')
+
+
+# Functions used to encode objects into JSON.
+_json_encoders = {
+    'json': json.dumps
+}
+
+if orjson is not None:
+    _json_encoders['orjson'] = _encode_orjson
+
+
+def append_object_to_json(output_stream, item, holder, encoder='json'):
     """Write given molecule as a JSON into stream.
 
     Optionally put separator before the record based on 'holder'.
+    Fragments given as tuples are converted into objects.
     :param output_stream:
     :param item: Item to append to JSON file.
     :param holder: Object shared by all calls of this method on the same stream.
+    :param encoder: Name of encoder, see _json_encoders property.
     :return:
     """
     if holder['first']:
         holder['first'] = False
     else:
         output_stream.write(',')
-    json.dump(item, output_stream)
+    if 'fragments' in item:
+        item = dict(item)
+        item['fragments'] = [dict(zip(fragment._fields, fragment))
+                             for fragment in item['fragments']]
+    output_stream.write(_json_encoders[encoder](item))
 
 
 def create_parent_directory(path):
@@ -349,13 +815,74 @@ def create_parent_directory(path):
         os.makedirs(dir_name)
 
 
+# Size of buffer used to read input files.
+_BUFFER_SIZE = 1 << 20
+
+# Minimal number of SDF lines parsed at once by load_sdf_range.
+_SDF_BLOCK_LINES = 100000
+
+# Number of SMI lines send to a parsing process at once.
+_SMILES_BLOCK_SIZE = 1000
+
+# Histogram buckets for number of fragments per molecule.
+_fragment_buckets = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000]
+
 _load_functions = {
     'sdf': load_sdf,
     'smi': load_smi
 }
 
 
-def extract_fragments(input_files, input_type, output_file, extraction_options):
+def _open_molecule_index(mode, output_file):
+    """Return (index, directory) used to detect duplicate molecules.
+
+    The index maps canonical SMILES to name of the first molecule.
+    :param mode: None, 'memory' or 'disk'.
+    :param output_file: The disk index is created next to this file.
+    :return: The directory is not None only for the disk index.
+    """
+    if mode is None:
+        return None, None
+    elif mode == 'memory':
+        return {}, None
+    elif mode == 'disk':
+        directory = tempfile.mkdtemp(
+            prefix='molecules-', dir=os.path.dirname(output_file) or '.')
+        return dbm.open(os.path.join(directory, 'index'), 'n'), directory
+    else:
+        raise ValueError('Invalid deduplication mode: ' + mode)
+
+
+def _close_molecule_index(index, directory):
+    if directory is None:
+        return
+    index.close()
+    shutil.rmtree(directory)
+
+
+def _find_duplicate(index, smiles, name):
+    """Return name of the first molecule with given SMILES or None.
+
+    If there is no such molecule the given one is added to the index.
+    :param index: See _open_molecule_index.
+    :param smiles: Canonical SMILES.
+    :param name:
+    :return:
+    """
+    if index is None:
+        return None
+    if smiles in index:
+        first = index[smiles]
+        # The dbm database store bytes.
+        if isinstance(first, bytes):
+            first = first.decode('utf-8')
+        return first
+    index[smiles] = name
+    return None
+
+
+def extract_fragments(input_files, input_type, output_file, extraction_options,
+                      metrics=None):
     """Extract fragments from molecules and write them to output JSON file.
 
     The extraction_options['fragments'] must be a list with objects describing
@@ -364,35 +891,73 @@ def extract_fragments(input_files, input_type, output_file, extraction_options):
     :param input_files: List of files with molecules.
     :param input_type: Type of input see _load_functions property.
     :param output_file: Path to output JSON file.
-    :param extraction_options: See usage in _main for more information.
+    :param extraction_options: See usage in _main for more information,
+        optional 'shard' (i, N) selects molecules to process, the output
+        file is not changed.
+    :param metrics: Optional instrumentation.Metrics.
     :return: Object with summary about computation.
     """
+    if metrics is None:
+        metrics = instrumentation.Metrics('extract_fragments')
     # The write_molecule_json need some static info.
     holder = {'first': True}
     # Count some statistics.
     total_fragments = 0
+    total_duplicates = 0
     #
     create_parent_directory(output_file)
-    with open(output_file, 'w') as output_stream:
-        output_stream.write('[')
-        for path in input_files:
-            for molecule in _load_functions[input_type](path):
-                item = {
-                    'name': molecule.GetProp('_Name'),
-                    'smiles': rdkit.Chem.MolToSmiles(molecule),
-                    'fragments': extract_fragments_from_molecule(
-                        molecule, extraction_options['fragments'],
-                        extraction_options)
-                }
-                total_fragments += len(item['fragments'])
-                # Append to output.
-                append_object_to_json(output_stream, item, holder)
-        output_stream.write(']')
+    index, index_directory = _open_molecule_index(
+        extraction_options.get('deduplicate'), output_file)
+    try:
+        with open(output_file, 'w') as output_stream:
+            output_stream.write('[')
+            for path in input_files:
+                for molecule in _load_functions[input_type](
+                        path, metrics, extraction_options.get('processes', 1),
+                        extraction_options.get('shard')):
+                    with metrics.timer('extraction'):
+                        item = {
+                            'name': molecule.GetProp('_Name'),
+                            'smiles': rdkit.Chem.MolToSmiles(molecule)
+                        }
+                        duplicate = _find_duplicate(
+                            index, item['smiles'], item['name'])
+                        if duplicate is None:
+                            item['fragments'] = \
+                                extract_fragments_from_molecule(
+                                    molecule, extraction_options['fragments'],
+                                    extraction_options)
+                            if extraction_options.get('aggregate', False):
+                                item['fragments'] = aggregate_fragments(
+                                    item['fragments'])
+                    if duplicate is None:
+                        total_fragments += len(item['fragments'])
+                        metrics.increment('fragments', len(item['fragments']))
+                        metrics.observe('fragments_per_molecule',
+                                        len(item['fragments']),
+                                        _fragment_buckets)
+                    else:
+                        item['duplicate'] = duplicate
+                        total_duplicates += 1
+                        metrics.increment('duplicates')
+                    # Append to output.
+                    with metrics.timer('write'):
+                        append_object_to_json(
+                            output_stream, item, holder,
+                            extraction_options.get('encoder', 'json'))
+                    metrics.increment('molecules')
+                    metrics.tick()
+                metrics.increment('files')
+            output_stream.write(']')
+    finally:
+        _close_molecule_index(index, index_directory)
     # Log nad return summary.
     logging.info('Report')
     logging.info('\tfragments total: %d', total_fragments)
+    logging.info('\tduplicate molecules: %d', total_duplicates)
     return {
-        'total_fragments': total_fragments
+        'total_fragments': total_fragments,
+        'total_duplicates': total_duplicates
     }
 
 
@@ -413,11 +978,23 @@ def _main():
     extraction_options = {
         'kekule': configuration['kekule'],
         'isomeric': configuration['isomeric'],
-        'fragments': configuration['fragments']
+        'max_path_matches': configuration['max_path_matches'],
+        'fragments': configuration['fragments'],
+        'processes': configuration['processes'],
+        'deduplicate': configuration['deduplicate'],
+        'aggregate': configuration['aggregate'],
+        'representative': configuration['representative'],
+        'encoder': configuration['encoder'],
+        'shard': configuration['shard']
     }
     #
+    metrics = instrumentation.create_metrics('extract_fragments',
+                                             configuration)
     extract_fragments(input_files, configuration['input_type'],
-                      configuration['output'], extraction_options)
+                      sharding.get_shard_path(configuration['output'],
+                                              configuration['shard']),
+                      extraction_options, metrics)
+    metrics.close()
 
 
 if __name__ == '__main__':
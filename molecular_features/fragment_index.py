@@ -0,0 +1,379 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Inverted index from fragments to molecules.
+
+Usage:
+    python fragment_index.py build
+        -i {path to JSON with molecules, output of extract_fragments}
+        -o {path prefix of the index files}
+        --key {optional, 'smiles' or 'index', what identifies a fragment.
+               Default is 'smiles'}
+    python fragment_index.py query
+        -x {path prefix of the index files}
+        -i {path to JSON with query molecules, output of extract_fragments}
+        -o {path to output JSON file}
+        -k {optional, number of most similar molecules. Default is 10}
+        --contains {report molecules with all fragments of the query,
+                    instead of the most similar molecules}
+
+The index consists of following files:
+    {prefix}.json : key type, molecule names, fragment keys, duplicates
+    {prefix}.offsets.npy : start of posting list for every fragment key
+    {prefix}.postings.npy : sorted molecule ids of all posting lists
+    {prefix}.sizes.npy : number of distinct fragments of every molecule
+The npy files are memory mapped when the index is loaded.
+
+Molecules written by extract_fragments as duplicates are not in posting
+lists, they are reported together with the molecule they duplicate.
+The similarity is Tanimoto coefficient on sets of fragment keys.
+
+This file can also be used as a python script for import, in such case
+please use the build_index method and the FragmentIndex class.
+"""
+
+import os
+import sys
+import argparse
+import array
+import logging
+import json
+import numpy
+
+# Modules shared by the script directories.
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             os.pardir, 'common'))
+import json_stream
+
+__author__ = 'Petr Škoda'
+__license__ = 'X11'
+__email__ = 'skoda@ksi.mff.cuni.cz'
+
+
+def create_parent_directory(path):
+    """Create directory if it does not exists.
+
+    :param path:
+    :return:
+    """
+    dir_name = os.path.dirname(path)
+    if not os.path.exists(dir_name) and not dir_name == "":
+        os.makedirs(dir_name)
+
+
+def _read_configuration():
+    """Get and return application settings.
+
+    :return:
+    """
+    parser = argparse.ArgumentParser(
+        description='Build and query inverted fragment index. '
+                    'See file header for more details.')
+    subparsers = parser.add_subparsers(dest='command')
+    build_parser = subparsers.add_parser('build')
+    build_parser.add_argument('-i', type=str, dest='input', required=True)
+    build_parser.add_argument('-o', type=str, dest='output', required=True)
+    build_parser.add_argument('--key', type=str, dest='key',
+                              choices=['smiles', 'index'], default='smiles')
+    query_parser = subparsers.add_parser('query')
+    query_parser.add_argument('-x', type=str, dest='index', required=True)
+    query_parser.add_argument('-i', type=str, dest='input', required=True)
+    query_parser.add_argument('-o', type=str, dest='output', required=True)
+    query_parser.add_argument('-k', type=int, dest='k', default=10)
+    query_parser.add_argument('--contains', dest='contains',
+                              action='store_true', required=False)
+    configuration = vars(parser.parse_args())
+    if configuration['command'] is None:
+        parser.error('missing command, use build or query')
+    return configuration
+
+
+def fragment_key(fragment, key):
+    """Return key identifying given fragment in the index.
+
+    :param fragment: Fragment object from extract_fragments output.
+    :param key: 'smiles' or 'index'.
+    :return:
+    """
+    if key == 'smiles':
+        return fragment['smiles']
+    else:
+        return '%s.%d.%d' % (fragment['type'], fragment['size'],
+                             fragment['index'])
+
+
+def molecule_keys(molecule, key):
+    """Return set of fragment keys of given molecule."""
+    return set(fragment_key(fragment, key)
+               for fragment in molecule.get('fragments', []))
+
+
+def build_index(input_file, output_prefix, key='smiles'):
+    """Build index for molecules in given extract_fragments output.
+
+    The input is streamed, only the fragment keys are kept in memory.
+    :param input_file:
+    :param output_prefix: Path prefix of the index files.
+    :param key: What identifies a fragment, see fragment_key.
+    :return: Summary object.
+    """
+    names = []
+    name_to_id = {}
+    duplicates = {}
+    vocabulary = {}
+    # Pairs (fragment id, molecule id) in order of molecules.
+    pair_fragments = array.array('I')
+    pair_molecules = array.array('I')
+    sizes = array.array('I')
+    with open(input_file, 'r') as stream:
+        for molecule in json_stream.read_json_array_stream(stream):
+            molecule_id = len(names)
+            names.append(molecule['name'])
+            if 'duplicate' in molecule:
+                first_id = name_to_id[molecule['duplicate']]
+                duplicates.setdefault(first_id, []).append(molecule_id)
+                sizes.append(sizes[first_id])
+                continue
+            name_to_id.setdefault(molecule['name'], molecule_id)
+            keys = molecule_keys(molecule, key)
+            for item in keys:
+                pair_fragments.append(
+                    vocabulary.setdefault(item, len(vocabulary)))
+                pair_molecules.append(molecule_id)
+            sizes.append(len(keys))
+    # Sort pairs by fragments, the sort is stable so the posting lists
+    # stay sorted by molecules.
+    pair_fragments = numpy.frombuffer(pair_fragments, dtype=numpy.uint32)
+    pair_molecules = numpy.frombuffer(pair_molecules, dtype=numpy.uint32)
+    order = numpy.argsort(pair_fragments, kind='stable')
+    postings = pair_molecules[order]
+    offsets = numpy.zeros(len(vocabulary) + 1, dtype=numpy.int64)
+    numpy.cumsum(numpy.bincount(pair_fragments, minlength=len(vocabulary)),
+                 out=offsets[1:])
+    # Write files.
+    create_parent_directory(output_prefix)
+    numpy.save(output_prefix + '.offsets.npy', offsets)
+    numpy.save(output_prefix + '.postings.npy', postings)
+    numpy.save(output_prefix + '.sizes.npy',
+               numpy.frombuffer(sizes, dtype=numpy.uint32))
+    keys = [None] * len(vocabulary)
+    for item, fragment_id in vocabulary.items():
+        keys[fragment_id] = item
+    with open(output_prefix + '.json', 'w') as stream:
+        json.dump({
+            'key': key,
+            'molecules': names,
+            'fragments': keys,
+            'duplicates': [[first_id, ids]
+                           for first_id, ids in sorted(duplicates.items())]
+        }, stream)
+    logging.info('Indexed %d molecules with %d fragments',
+                 len(names), len(vocabulary))
+    return {
+        'molecules': len(names),
+        'fragments': len(vocabulary),
+        'postings': len(postings)
+    }
+
+
+class FragmentIndex(object):
+    """Read only access to index created by build_index.
+
+    :param prefix: Path prefix of the index files.
+    """
+
+    def __init__(self, prefix):
+        with open(prefix + '.json', 'r') as stream:
+            metadata = json.load(stream)
+        self.key = metadata['key']
+        self.names = metadata['molecules']
+        self.fragments = {item: fragment_id for fragment_id, item
+                          in enumerate(metadata['fragments'])}
+        self.duplicates = {first_id: ids
+                           for first_id, ids in metadata['duplicates']}
+        self.offsets = numpy.load(prefix + '.offsets.npy', mmap_mode='r')
+        self.postings_array = numpy.load(prefix + '.postings.npy',
+                                         mmap_mode='r')
+        self.sizes = numpy.load(prefix + '.sizes.npy', mmap_mode='r')
+        self._counts = None
+
+    def postings(self, item):
+        """Return sorted ids of molecules with given fragment key."""
+        if item not in self.fragments:
+            return numpy.zeros(0, dtype=numpy.uint32)
+        fragment_id = self.fragments[item]
+        return self.postings_array[
+               self.offsets[fragment_id]:self.offsets[fragment_id + 1]]
+
+    def expand(self, molecule_ids):
+        """Return given ids with ids of their duplicates."""
+        result = []
+        for molecule_id in molecule_ids:
+            result.append(int(molecule_id))
+            result.extend(self.duplicates.get(int(molecule_id), []))
+        return result
+
+    def containing(self, keys):
+        """Return ids of molecules with all given fragment keys.
+
+        Every molecule contains the empty set of fragments, so for no keys
+        all molecules are returned.
+        :param keys: Iterable of fragment keys.
+        :return: Sorted list of molecule ids.
+        """
+        lists = sorted([self.postings(item) for item in set(keys)], key=len)
+        if len(lists) == 0:
+            return list(range(len(self.names)))
+        result = numpy.asarray(lists[0])
+        # Start with the shortest lists, stop once there is no match.
+        for postings in lists[1:]:
+            if len(result) == 0:
+                break
+            result = numpy.intersect1d(result, postings, assume_unique=True)
+        return sorted(self.expand(result))
+
+    def similar(self, keys, k=10):
+        """Return k molecules most similar to the given fragment keys.
+
+        Posting lists are merged from the shortest one. Once the k-th best
+        lower bound of similarity is greater than the best similarity
+        of a molecule in none of the merged lists, the remaining lists are
+        used only to update the counts of already found molecules.
+        The method is not thread safe.
+        :param keys: Iterable of fragment keys.
+        :param k:
+        :return: List of (molecule id, similarity) ordered by similarity.
+        """
+        keys = set(keys)
+        query_size = len(keys)
+        if query_size == 0:
+            return []
+        lists = sorted([self.postings(item) for item in keys], key=len)
+        # Counts of shared fragments for all molecules, only the counts
+        # of candidates are non-zero.
+        if self._counts is None:
+            self._counts = numpy.zeros(len(self.sizes), dtype=numpy.int32)
+        counts = self._counts
+        found = []
+        candidates = numpy.zeros(0, dtype=numpy.uint32)
+        merged = 0
+        while merged < len(lists):
+            postings = numpy.asarray(lists[merged])
+            counts[postings] += 1
+            found.append(postings[counts[postings] == 1])
+            merged += 1
+            # Molecules in none of the merged lists share at most
+            # the remaining fragments with the query.
+            # The similarity of a candidate is at most merged / query_size,
+            # so there is no need to check before half of the lists.
+            if 2 * merged <= query_size:
+                continue
+            bound = (query_size - merged) / query_size
+            candidates = numpy.concatenate(found)
+            found = [candidates]
+            if len(candidates) >= k and self._kth_similarity(
+                    candidates, counts[candidates], query_size, k) > bound:
+                break
+        candidates = numpy.concatenate(found)
+        candidates.sort()
+        # Add remaining lists, long lists are only searched for candidates.
+        searched = []
+        for postings in lists[merged:]:
+            if len(postings) > len(candidates) * 8:
+                searched.append(postings)
+            else:
+                counts[postings] += 1
+        candidate_counts = counts[candidates]
+        for postings in lists[merged:]:
+            if len(postings) <= len(candidates) * 8:
+                counts[postings] = 0
+        counts[candidates] = 0
+        for postings in searched:
+            positions = numpy.searchsorted(postings, candidates)
+            positions[positions == len(postings)] = 0
+            candidate_counts += postings[positions] == candidates
+        similarity = self._similarity(candidates, candidate_counts,
+                                      query_size)
+        if len(similarity) > k:
+            best = numpy.argpartition(-similarity, k - 1)[:k]
+        else:
+            best = numpy.arange(len(similarity))
+        best = best[numpy.lexsort((candidates[best], -similarity[best]))]
+        result = []
+        for index in best:
+            for molecule_id in self.expand([candidates[index]]):
+                result.append((molecule_id, float(similarity[index])))
+        return result[:k]
+
+    def _similarity(self, candidates, counts, query_size):
+        sizes = numpy.asarray(self.sizes[candidates], dtype=numpy.int64)
+        return counts / (query_size + sizes - counts)
+
+    def _kth_similarity(self, candidates, counts, query_size, k):
+        similarity = self._similarity(candidates, counts, query_size)
+        return numpy.partition(similarity, len(similarity) - k)[
+            len(similarity) - k]
+
+
+def query_index(index_prefix, input_file, output_file, k=10,
+                contains=False):
+    """Query the index with molecules from extract_fragments output.
+
+    The query molecules are streamed and the results are written as soon
+    as they are computed.
+    :param index_prefix:
+    :param input_file:
+    :param output_file: Output JSON file with results for every molecule.
+    :param k: Number of most similar molecules.
+    :param contains: If true report all molecules with all fragments of
+        the query molecule.
+    :return:
+    """
+    index = FragmentIndex(index_prefix)
+    keys_by_name = {}
+    create_parent_directory(output_file)
+    with open(input_file, 'r') as input_stream, \
+            open(output_file, 'w') as output_stream:
+        output_stream.write('[')
+        counter = 0
+        for molecule in json_stream.read_json_array_stream(input_stream):
+            if 'duplicate' in molecule:
+                keys = keys_by_name[molecule['duplicate']]
+            else:
+                keys = molecule_keys(molecule, index.key)
+                keys_by_name.setdefault(molecule['name'], keys)
+            if contains:
+                matches = [{'name': index.names[molecule_id]}
+                           for molecule_id in index.containing(keys)]
+            else:
+                matches = [{'name': index.names[molecule_id],
+                            'similarity': similarity}
+                           for molecule_id, similarity
+                           in index.similar(keys, k)]
+            result = json.dumps({
+                'name': molecule['name'],
+                'matches': matches
+            }, indent=2)
+            # Same layout as json.dump of the whole list with indent=2.
+            output_stream.write(',\n  ' if counter > 0 else '\n  ')
+            output_stream.write(result.replace('\n', '\n  '))
+            counter += 1
+        output_stream.write('\n]' if counter > 0 else ']')
+
+
+def _main():
+    logging.basicConfig(
+        level=logging.DEBUG,
+        format='%(asctime)s [%(levelname)s] %(module)s - %(message)s',
+        datefmt='%H:%M:%S')
+    configuration = _read_configuration()
+    if configuration['command'] == 'build':
+        build_index(configuration['input'], configuration['output'],
+                    configuration['key'])
+    else:
+        query_index(configuration['index'], configuration['input'],
+                    configuration['output'], configuration['k'],
+                    configuration['contains'])
+
+
+if __name__ == '__main__':
+    _main()
@@ -8,6 +8,18 @@ Usage:
         -o {path to output csv file}
         -p {path to the PaDEL directory that contains PaDEL-Descriptor.jar}
         -f Compute for fragments else for molecules.
+        --canonical Compute descriptors once for all SMILES with the same
+                    canonical SMILES.
+        --min-support {optional, compute only for SMILES present in at least
+                       given number of molecules. Default is 1}
+        --sketch-width {optional, approximate the support by count-min
+                        sketch with given width, use for huge vocabularies}
+        --metrics {optional, JSON Lines file to append metrics to}
+        --metrics-interval {metrics emission interval in seconds}
+        --prometheus {optional, Prometheus text file to write metrics to}
+        --shard {optional, compute only shard i of N given as i/N,
+                 0 <= i < N, the output file name contains the shard,
+                 see common/sharding.py}
 
 
 This file can also be used as a python script for import, in such case
@@ -15,11 +27,19 @@ please use the compute_descriptors method.
 """
 
 import os
+import sys
 import argparse
+import csv
 import logging
-import json
 import subprocess
 
+# Modules shared by the script directories.
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             os.pardir, 'common'))
+import instrumentation
+import sharding
+import vocabulary
+
 __author__ = 'Petr Škoda'
 __license__ = 'X11'
 __email__ = 'skoda@ksi.mff.cuni.cz'
@@ -54,57 +74,118 @@ def _read_configuration():
     parser.add_argument('-f', dest='fragments',
                         help='use fragments instead of molecules',
                         action='store_true', required=False)
+    parser.add_argument('--canonical', dest='canonical',
+                        help='compute once for every canonical SMILES',
+                        action='store_true', required=False)
+    parser.add_argument('--min-support', type=int, dest='min_support',
+                        help='minimal number of molecules with SMILES',
+                        default=1)
+    parser.add_argument('--sketch-width', type=int, dest='sketch_width',
+                        help='width of count-min sketch for support',
+                        required=False)
+    instrumentation.add_arguments(parser)
+    sharding.add_arguments(parser)
 
     return vars(parser.parse_args())
 
 
-def compute_descriptors(input_file, output_file, use_fragments, padel_path):
+def _expand_output(output_file, groups):
+    """Replace every row of PaDEL output with rows for all SMILES in group.
+
+    :param output_file:
+    :param groups: Dictionary name -> list of SMILES.
+    :return:
+    """
+    temp_file = output_file + '.tmp'
+    with open(output_file, 'r', newline='') as input_stream, \
+            open(temp_file, 'w', newline='') as output_stream:
+        reader = csv.reader(input_stream)
+        writer = csv.writer(output_stream)
+        writer.writerow(next(reader))
+        for row in reader:
+            for smiles in groups.get(row[0], [row[0]]):
+                writer.writerow([smiles] + row[1:])
+    os.replace(temp_file, output_file)
+
+
+def compute_descriptors(input_file, output_file, use_fragments, padel_path,
+                        metrics=None, canonical=False, min_support=1,
+                        sketch_width=None, shard=None):
     """Compute descriptors for molecules/fragments in given input file.
 
     :param input_file:
     :param output_file:
     :param use_fragments: If true use fragments instead of molecules.
     :param padel_path: Path to PaDel.
-    :return: Nothing.
+    :param metrics: Optional instrumentation.Metrics.
+    :param canonical: If true compute descriptors once for all SMILES with
+        the same canonical SMILES and write them for every SMILES.
+    :param min_support: Compute descriptors only for SMILES present in at
+        least given number of molecules.
+    :param sketch_width: If not None approximate the number of molecules
+        with count-min sketch of given width, see vocabulary.
+    :param shard: Optional (i, N), compute only for groups of SMILES
+        in given shard, the support is computed from all molecules.
+    :return: Summary object.
     """
-    with open(input_file, 'r') as stream:
-        data = json.load(stream)
+    if metrics is None:
+        metrics = instrumentation.Metrics('padel_descriptors')
     create_parent_directory(output_file)
-    # Gather data.
-    smiles_set = set()
-    if use_fragments:
-        for molecule in data:
-            for fragment in molecule['fragments']:
-                if not fragment['smiles'] in smiles_set:
-                    smiles_set.add(fragment['smiles'])
+    # Gather data, the input is streamed.
+    with metrics.timer('load'):
+        smiles_set, number_of_rare = vocabulary.collect_smiles(
+            input_file, use_fragments, min_support, sketch_width)
+    if number_of_rare is None:
+        logging.info('Skipped SMILES present in less than %d molecules '
+                     'by approximate support', min_support)
+    elif min_support > 1:
+        logging.info('Skipped %d SMILES present in less than %d molecules',
+                     number_of_rare, min_support)
+        metrics.increment('rare', number_of_rare)
+    # Group SMILES with the same canonical SMILES.
+    if canonical:
+        with metrics.timer('canonicalization'):
+            groups = vocabulary.group_by_canonical_smiles(smiles_set)
     else:
-        for molecule in data:
-            if not molecule['smiles'] in smiles_set:
-                smiles_set.add(molecule['smiles'])
+        groups = {smiles: [smiles] for smiles in smiles_set}
+    if shard is not None:
+        groups = {key: group for key, group in groups.items()
+                  if sharding.is_in_shard(key, shard)}
+    total = sum(len(group) for group in groups.values())
     # Prepare data for PaDEL.
-    padel_input = os.path.dirname(output_file) + '/PaDEL-temp.smi'
+    # Shards may run in the same directory at once.
+    padel_input = output_file + '.PaDEL-temp.smi'
     with open(padel_input, 'w') as stream:
-        for smiles in smiles_set:
+        for smiles in groups:
             stream.write(smiles)
             stream.write('\t')
             stream.write(smiles)
             stream.write('\n')
     # Execute PaDEL.
     logging.info('Executing PaDEL ...')
-    thread = subprocess.Popen(
-        ['java', '-jar',
-         padel_path + '/PaDEL-Descriptor.jar',
-         '-threads', '2',
-         '-2d',
-         '-dir', padel_input,
-         '-file', output_file],
-        shell=True)
-    thread.wait()
+    with metrics.timer('padel'):
+        thread = subprocess.Popen(
+            ['java', '-jar',
+             padel_path + '/PaDEL-Descriptor.jar',
+             '-threads', '2',
+             '-2d',
+             '-dir', padel_input,
+             '-file', output_file],
+            shell=True)
+        thread.wait()
+    metrics.increment('molecules', len(groups))
     logging.info('Executing PaDEL ... done')
     os.remove(padel_input)
+    if canonical:
+        _expand_output(output_file, groups)
     # Return summary.
+    logging.info('Computed for %d of %d SMILES, saved %d',
+                 len(groups), total, total - len(groups))
     return {
-        'total': len(smiles_set)
+        'total': total,
+        'computed': len(groups),
+        'saved': total - len(groups),
+        'rare': number_of_rare
     }
 
 def _main():
@@ -115,8 +196,17 @@ def _main():
     configuration = _read_configuration()
     #
     use_fragments = 'fragments' in configuration and configuration['fragments']
-    compute_descriptors(configuration['input'], configuration['output'],
-                        use_fragments, configuration['padel'])
+    metrics = instrumentation.create_metrics('padel_descriptors',
+                                             configuration)
+    compute_descriptors(configuration['input'],
+                        sharding.get_shard_path(configuration['output'],
+                                                configuration['shard']),
+                        use_fragments, configuration['padel'], metrics,
+                        configuration['canonical'],
+                        configuration['min_support'],
+                        configuration['sketch_width'],
+                        configuration['shard'])
+    metrics.close()
 
 
 if __name__ == '__main__':
@@ -8,19 +8,38 @@ Usage:
         -o {path to output CSV file}
         --fragments Use fragments else use molecules.
                     Default is to use molecules.
+        --canonical Compute descriptors once for all SMILES with the same
+                    canonical SMILES.
+        --min-support {optional, compute only for SMILES present in at least
+                       given number of molecules. Default is 1}
+        --sketch-width {optional, approximate the support by count-min
+                        sketch with given width, use for huge vocabularies}
+        --metrics {optional, JSON Lines file to append metrics to}
+        --metrics-interval {metrics emission interval in seconds}
+        --prometheus {optional, Prometheus text file to write metrics to}
+        --shard {optional, compute only shard i of N given as i/N,
+                 0 <= i < N, the output file name contains the shard,
+                 see common/sharding.py}
 
 This file can be also imported as a python script. In such case please
 use the extract_fragments method.
 """
 
 import os
+import sys
 import argparse
 import logging
-import json
 import rdkit
 import rdkit.Chem
 from rdkit.Chem import Descriptors
 
+# Modules shared by the script directories.
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             os.pardir, 'common'))
+import instrumentation
+import sharding
+import vocabulary
+
 __author__ = 'Petr Škoda'
 __license__ = 'X11'
 __email__ = 'skoda@ksi.mff.cuni.cz'
@@ -448,34 +467,65 @@ def _read_configuration():
     parser.add_argument('--fragments', dest='fragments',
                         help='use fragments instead of molecules',
                         action='store_true', required=False)
+    parser.add_argument('--canonical', dest='canonical',
+                        help='compute once for every canonical SMILES',
+                        action='store_true', required=False)
+    parser.add_argument('--min-support', type=int, dest='min_support',
+                        help='minimal number of molecules with SMILES',
+                        default=1)
+    parser.add_argument('--sketch-width', type=int, dest='sketch_width',
+                        help='width of count-min sketch for support',
+                        required=False)
+    instrumentation.add_arguments(parser)
+    sharding.add_arguments(parser)
 
     return vars(parser.parse_args())
 
 
 def compute_descriptors(input_file, output_file, use_fragments,
-                        features_to_use=[]):
+                        features_to_use=[], metrics=None, canonical=False,
+                        min_support=1, sketch_width=None, shard=None):
     """Compute descriptors for molecules/fragments in given input file.
 
     :param input_file:
     :param output_file:
     :param use_fragments: If true use fragments instead of molecules.
     :param features_to_use: Empty to use all, else names of features to use.
+    :param metrics: Optional instrumentation.Metrics.
+    :param canonical: If true compute descriptors once for all SMILES with
+        the same canonical SMILES and write them for every SMILES.
+    :param min_support: Compute descriptors only for SMILES present in at
+        least given number of molecules.
+    :param sketch_width: If not None approximate the number of molecules
+        with count-min sketch of given width, see vocabulary.
+    :param shard: Optional (i, N), compute only for groups of SMILES
+        in given shard, the support is computed from all molecules.
     :return: Summary object.
     """
-    with open(input_file, 'r') as stream:
-        data = json.load(stream)
+    if metrics is None:
+        metrics = instrumentation.Metrics('rdkit_descriptors')
     create_parent_directory(output_file)
-    # Gather data.
-    smiles_set = set()
-    if use_fragments:
-        for molecule in data:
-            for fragment in molecule['fragments']:
-                if not fragment['smiles'] in smiles_set:
-                    smiles_set.add(fragment['smiles'])
+    # Gather data, the input is streamed.
+    with metrics.timer('load'):
+        smiles_set, number_of_rare = vocabulary.collect_smiles(
+            input_file, use_fragments, min_support, sketch_width)
+    if number_of_rare is None:
+        logging.info('Skipped SMILES present in less than %d molecules '
+                     'by approximate support', min_support)
+    elif min_support > 1:
+        logging.info('Skipped %d SMILES present in less than %d molecules',
+                     number_of_rare, min_support)
+        metrics.increment('rare', number_of_rare)
+    # Group SMILES with the same canonical SMILES.
+    if canonical:
+        with metrics.timer('canonicalization'):
+            groups = vocabulary.group_by_canonical_smiles(smiles_set)
     else:
-        for molecule in data:
-            if not molecule['smiles'] in smiles_set:
-                smiles_set.add(molecule['smiles'])
+        groups = {smiles: [smiles] for smiles in smiles_set}
+    if shard is not None:
+        groups = {key: group for key, group in groups.items()
+                  if sharding.is_in_shard(key, shard)}
+    total = sum(len(group) for group in groups.values())
     # Pick features to use.
     if features_to_use == [] or features_to_use is None:
         used_features_names = _names
@@ -492,32 +542,42 @@ def compute_descriptors(input_file, output_file, use_fragments,
         stream.write(','.join(used_features_names))
         stream.write('\n')
         counter = 0
-        counter_step = int(len(smiles_set) / 10)
-        for smiles in smiles_set:
+        counter_step = max(1, int(len(groups) / 10))
+        for key, group in groups.items():
             if counter % counter_step == 0:
-                logging.info('%d/%d', counter, len(smiles_set))
+                logging.info('%d/%d', counter, len(groups))
             counter += 1
-            # SMILES.
-            stream.write('"')
-            stream.write(smiles)
-            stream.write('",')
             # Construct molecule, compute and write properties.
-            molecule = rdkit.Chem.MolFromSmiles(str(smiles), sanitize=False)
-            # Do not kekulize molecule.
-            rdkit.Chem.SanitizeMol(molecule, sanitizeOps=sanitize_operation)
-            #
+            molecule = rdkit.Chem.MolFromSmiles(str(key), sanitize=False)
             if molecule is None:
-                logging.error('Invalid molecule detected: %s', smiles)
+                logging.error('Invalid molecule detected: %s', key)
                 number_of_invalid += 1
+                metrics.increment('invalid_molecules')
                 continue
-            stream.write(
-                ','.join([str(fnc(molecule)) for fnc in used_features_fnc]))
-            stream.write('\n')
+            # Do not kekulize molecule.
+            rdkit.Chem.SanitizeMol(molecule, sanitizeOps=sanitize_operation)
+            #
+            with metrics.timer('descriptors'):
+                values = ','.join([str(fnc(molecule))
+                                   for fnc in used_features_fnc])
+            for smiles in group:
+                stream.write('"')
+                stream.write(smiles)
+                stream.write('",')
+                stream.write(values)
+                stream.write('\n')
+            metrics.increment('molecules')
+            metrics.tick()
     # Log nad return summary.
-    logging.info('Invalid molecules: %d/%d', number_of_invalid, len(smiles_set))
+    logging.info('Invalid molecules: %d/%d', number_of_invalid, len(groups))
+    logging.info('Computed for %d of %d SMILES, saved %d',
+                 len(groups), total, total - len(groups))
     return {
         'number_of_invalid': number_of_invalid,
-        'total': len(smiles_set)
+        'total': total,
+        'computed': len(groups),
+        'saved': total - len(groups),
+        'rare': number_of_rare
     }
 
 
@@ -529,8 +589,17 @@ def _main():
     configuration = _read_configuration()
     #
     use_fragments = 'fragments' in configuration and configuration['fragments']
-    compute_descriptors(configuration['input'], configuration['output'],
-                        use_fragments)
+    metrics = instrumentation.create_metrics('rdkit_descriptors',
+                                             configuration)
+    compute_descriptors(configuration['input'],
+                        sharding.get_shard_path(configuration['output'],
+                                                configuration['shard']),
+                        use_fragments, metrics=metrics,
+                        canonical=configuration['canonical'],
+                        min_support=configuration['min_support'],
+                        sketch_width=configuration['sketch_width'],
+                        shard=configuration['shard'])
+    metrics.close()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,199 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Utilities for the vocabulary of SMILES used by descriptor scripts.
+
+The same chemical fragment can be written by extract_fragments under
+several SMILES, for example rooted at different atoms or in kekule and
+aromatic form. Use group_by_canonical_smiles to compute descriptors only
+once for every such fragment.
+
+Most fragments occur in only a few molecules. Use create_support_counter
+to count number of molecules with every SMILES, for large vocabularies
+the counts can be approximated by a count-min sketch of fixed size.
+The input is streamed by collect_smiles, with the sketch only SMILES
+with enough support are kept in memory. Molecules written by
+extract_fragments --deduplicate as duplicates have no fragments, their
+support is credited to the fragments of the referenced molecule.
+"""
+
+import array
+import collections
+import hashlib
+import os
+import sys
+import rdkit
+import rdkit.Chem
+
+# Modules shared by the script directories.
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             os.pardir, 'common'))
+import json_stream
+
+__author__ = 'Petr Škoda'
+__license__ = 'X11'
+__email__ = 'skoda@ksi.mff.cuni.cz'
+
+# Fragments may not be kekulizable, so do not kekulize them.
+_sanitize_operation = rdkit.Chem.SanitizeFlags.SANITIZE_ALL ^ \
+                      rdkit.Chem.SanitizeFlags.SANITIZE_KEKULIZE
+
+
+def canonical_smiles(smiles):
+    """Return canonical SMILES, or given SMILES if it can not be parsed.
+
+    :param smiles:
+    :return:
+    """
+    molecule = rdkit.Chem.MolFromSmiles(str(smiles), sanitize=False)
+    if molecule is None:
+        return smiles
+    try:
+        rdkit.Chem.SanitizeMol(molecule, sanitizeOps=_sanitize_operation)
+    except Exception:
+        return smiles
+    return rdkit.Chem.MolToSmiles(molecule)
+
+
+def group_by_canonical_smiles(smiles_set):
+    """Group SMILES by their canonical SMILES.
+
+    :param smiles_set: Iterable of SMILES.
+    :return: Dictionary canonical SMILES -> list of SMILES.
+    """
+    result = {}
+    for smiles in smiles_set:
+        result.setdefault(canonical_smiles(smiles), []).append(smiles)
+    return result
+
+
+class CountMinSketch(object):
+    """Approximate counter with fixed memory.
+
+    The counts are never underestimated, the overestimate is at most
+    2 * total / width with probability 1 - 0.5 ** depth. The indexes are
+    derived from MD5 of the key, so they are the same in every process.
+    :param width: Number of counters in a row.
+    :param depth: Number of rows.
+    """
+
+    def __init__(self, width, depth=4):
+        self.width = width
+        self.depth = depth
+        self.tables = [array.array('I', [0]) * width for _ in range(depth)]
+
+    def _indexes(self, key):
+        digest = hashlib.md5(key.encode('utf-8')).digest()
+        # Double hashing, see Kirsch and Mitzenmacher.
+        first = int.from_bytes(digest[:8], 'little')
+        second = int.from_bytes(digest[8:], 'little') | 1
+        return [(first + row * second) % self.width
+                for row in range(self.depth)]
+
+    def update(self, keys):
+        """Add to the counts of given keys, as collections.Counter.update.
+
+        :param keys: Iterable of keys to add one to, or mapping from
+            key to the number to add.
+        :return:
+        """
+        if hasattr(keys, 'items'):
+            items = keys.items()
+        else:
+            items = ((key, 1) for key in keys)
+        for key, count in items:
+            for table, index in zip(self.tables, self._indexes(key)):
+                table[index] += count
+
+    def __getitem__(self, key):
+        return min(table[index] for table, index
+                   in zip(self.tables, self._indexes(key)))
+
+
+def create_support_counter(sketch_width=None):
+    """Return counter with update(keys) method and [key] access.
+
+    :param sketch_width: If None count exactly, else use CountMinSketch
+        with given width.
+    :return:
+    """
+    if sketch_width is None:
+        return collections.Counter()
+    else:
+        return CountMinSketch(sketch_width)
+
+
+def _read_records(input_file, use_fragments):
+    """Generate (name, duplicate, set of SMILES) for every molecule.
+
+    :param input_file: Output of extract_fragments.
+    :param use_fragments: If true use fragments instead of molecules.
+    :return: The duplicate is the name of the referenced molecule or None.
+    """
+    with open(input_file, 'r') as stream:
+        for molecule in json_stream.read_json_array_stream(stream):
+            duplicate = molecule.get('duplicate', None)
+            if use_fragments:
+                # Duplicate molecules have no fragments.
+                smiles = set(fragment['smiles']
+                             for fragment in molecule.get('fragments', []))
+            else:
+                smiles = {molecule['smiles']}
+            yield molecule['name'], duplicate, smiles
+
+
+def _count_support(input_file, use_fragments, support):
+    """Add number of molecules with every SMILES to the support counter.
+
+    Duplicate molecules are counted for the fragments of the referenced
+    molecule, this needs one more pass over the input if there are any.
+    :param input_file:
+    :param use_fragments:
+    :param support: See create_support_counter.
+    :return:
+    """
+    duplicates = collections.Counter()
+    for _, duplicate, record in _read_records(input_file, use_fragments):
+        support.update(record)
+        if duplicate is not None:
+            duplicates[duplicate] += 1
+    if not use_fragments or len(duplicates) == 0:
+        return
+    for name, duplicate, record in _read_records(input_file, use_fragments):
+        if duplicate is None and name in duplicates:
+            support.update(dict.fromkeys(record, duplicates[name]))
+
+
+def collect_smiles(input_file, use_fragments, min_support=1,
+                   sketch_width=None):
+    """Return SMILES of molecules or fragments present in given number
+    of molecules.
+
+    The input is streamed. With the sketch it is read once more, the support
+    is counted first and then only SMILES with estimated support at least
+    min_support are collected, so the rare SMILES are never kept in memory.
+    Duplicate molecules count for the fragments of the referenced molecule,
+    see _count_support.
+    :param input_file: Output of extract_fragments.
+    :param use_fragments: If true use fragments instead of molecules.
+    :param min_support: Minimal number of molecules with the SMILES.
+    :param sketch_width: See create_support_counter.
+    :return: (set of SMILES, number of SMILES removed for low support),
+        the number is None with the sketch as the rare SMILES are not
+        collected.
+    """
+    if min_support <= 1:
+        smiles_set = set()
+        for _, _, record in _read_records(input_file, use_fragments):
+            smiles_set.update(record)
+        return smiles_set, 0
+    support = create_support_counter(sketch_width)
+    _count_support(input_file, use_fragments, support)
+    if sketch_width is None:
+        result = set(smiles for smiles, count in support.items()
+                     if count >= min_support)
+        return result, len(support) - len(result)
+    result = set()
+    for _, _, record in _read_records(input_file, use_fragments):
+        result.update(smiles for smiles in record
+                      if support[smiles] >= min_support)
+    return result, None
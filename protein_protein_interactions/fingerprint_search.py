@@ -0,0 +1,329 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Similarity search over bit-packed vertex pair fingerprints.
+
+Usage:
+    python fingerprint_search.py
+        -d {packed fingerprints to search in, graph_vertex_pairs -f packed}
+        -q {packed query fingerprints, computed with the same configuration}
+        -o {path to output JSON file}
+        -k {optional, number of most similar fingerprints, default 10}
+        -t {optional, report all fingerprints with similarity at least
+            given threshold instead of the k most similar}
+        -m {optional, 'tanimoto' or 'dice', default 'tanimoto'}
+        -p {optional, number of threads, 0 for the number of CPUs,
+            default 1}
+        --block {optional, number of fingerprints compared at once,
+                 default 65536}
+        --no-pruning {compare the query with every fingerprint}
+
+The fingerprints are memory mapped and viewed as a matrix of uint64 words.
+Similarities are computed from popcounts of the words for a block of
+fingerprints at once. The number of set bits bounds the similarity:
+    tanimoto(a, b) <= min(|a|, |b|) / max(|a|, |b|)
+    dice(a, b) <= 2 * min(|a|, |b|) / (|a| + |b|)
+so the fingerprints are visited in order of their bit count, starting
+with the ones closest to the query, and the search stops once the bound
+is below the threshold or below the k-th best similarity. Similarity of
+two empty fingerprints is zero. Queries are distributed between threads,
+numpy releases the GIL for the block operations.
+
+The output contains for every query its id and list of matches, each with
+id and similarity, ordered by decreasing similarity.
+
+This file can also be used as a python script for import, in such case
+please use the FingerprintDatabase class.
+"""
+
+import argparse
+import concurrent.futures
+import json
+import logging
+import numpy
+import os
+
+__author__ = 'Petr Škoda'
+__license__ = 'X11'
+__email__ = 'skoda@ksi.mff.cuni.cz'
+
+# Number of fingerprints compared at once.
+_BLOCK_SIZE = 1 << 16
+
+# Size of the first block in pruned search.
+_INITIAL_STEP = 1 << 10
+
+_metrics = ['tanimoto', 'dice']
+
+if hasattr(numpy, 'bitwise_count'):
+    def popcount(words):
+        """Return number of set bits in every row of uint64 matrix."""
+        return numpy.bitwise_count(words).sum(axis=-1, dtype=numpy.int64)
+else:
+    _byte_counts = numpy.array([bin(value).count('1')
+                                for value in range(256)], dtype=numpy.uint8)
+
+    def popcount(words):
+        """Return number of set bits in every row of uint64 matrix."""
+        return _byte_counts[words.view(numpy.uint8)].sum(
+            axis=-1, dtype=numpy.int64)
+
+
+def load_packed(path):
+    """Load fingerprints written by graph_vertex_pairs.write_packed.
+
+    :param path:
+    :return: (memory mapped uint64 matrix, list of ids)
+    """
+    packed = numpy.load(path, mmap_mode='r')
+    if packed.shape[0] == 0:
+        words = numpy.zeros((0, 0), dtype=numpy.uint64)
+    else:
+        words = packed.view(numpy.uint64)
+    with open(path + '.ids', 'r') as stream:
+        ids = [line.rstrip('\n') for line in stream]
+    if not len(ids) == words.shape[0]:
+        raise Exception('Number of ids does not match number of rows: ' +
+                        path)
+    return words, ids
+
+
+def similarity(common, query_count, counts, metric):
+    """Return similarity for given counts of common and set bits.
+
+    :param common: Counts of bits set in both fingerprints.
+    :param query_count: Number of bits set in the query.
+    :param counts: Counts of bits set in the other fingerprints.
+    :param metric: 'tanimoto' or 'dice'.
+    :return:
+    """
+    if metric == 'tanimoto':
+        denominator = query_count + counts - common
+    else:
+        denominator = (query_count + counts) / 2
+    return numpy.divide(common, denominator,
+                        out=numpy.zeros(len(common), dtype=numpy.float64),
+                        where=denominator > 0)
+
+
+def similarity_bound(query_count, count, metric):
+    """Return upper bound of similarity for given numbers of set bits."""
+    if query_count == 0 or count == 0:
+        return 0.0
+    if metric == 'tanimoto':
+        return min(query_count, count) / max(query_count, count)
+    else:
+        return 2 * min(query_count, count) / (query_count + count)
+
+
+def count_range(query_count, cutoff, metric):
+    """Return range of bit counts with similarity bound at least cutoff.
+
+    :param query_count: Number of bits set in the query.
+    :param cutoff: Minimal similarity, zero or less for no restriction.
+    :param metric: 'tanimoto' or 'dice'.
+    :return: (minimal count, maximal count), maximal count is None
+        for no limit.
+    """
+    if cutoff <= 0:
+        return 0, None
+    if metric == 'tanimoto':
+        low, high = query_count * cutoff, query_count / cutoff
+    else:
+        low = query_count * cutoff / (2 - cutoff)
+        high = query_count * (2 - cutoff) / cutoff
+    # Allow for rounding errors, the similarity is checked anyway.
+    return int(numpy.floor(low * (1 - 1e-9))), int(numpy.ceil(high))
+
+
+class FingerprintDatabase(object):
+    """Fingerprints prepared for similarity search.
+
+    :param words: Matrix of uint64, one fingerprint in every row.
+    :param ids: Optional ids of the fingerprints.
+    :param block_size: Number of fingerprints compared at once.
+    """
+
+    def __init__(self, words, ids=None, block_size=_BLOCK_SIZE):
+        self.words = words
+        self.ids = ids
+        self.block_size = block_size
+        self.counts = numpy.zeros(words.shape[0], dtype=numpy.int64)
+        for start in range(0, words.shape[0], block_size):
+            self.counts[start:start + block_size] = \
+                popcount(words[start:start + block_size])
+        # Order of the fingerprints by the number of set bits.
+        self.order = numpy.argsort(self.counts, kind='stable')
+        self.sorted_counts = self.counts[self.order]
+
+    @staticmethod
+    def load(path, block_size=_BLOCK_SIZE):
+        words, ids = load_packed(path)
+        return FingerprintDatabase(words, ids, block_size)
+
+    def _compare(self, query, query_count, rows, metric):
+        block = self.words[rows]
+        common = popcount(numpy.bitwise_and(block, query))
+        return similarity(common, query_count, self.counts[rows], metric)
+
+    def _full_scan(self, query, query_count, metric):
+        for start in range(0, self.words.shape[0], self.block_size):
+            rows = numpy.arange(start, min(start + self.block_size,
+                                           self.words.shape[0]))
+            yield rows, self._compare(query, query_count, rows, metric)
+
+    def _pruned_scan(self, query, query_count, metric, cutoff):
+        """Generate blocks in order of decreasing similarity bound.
+
+        Blocks start small and grow up to block_size, so the cutoff can
+        rise before most of the fingerprints are visited.
+        :param cutoff: Function returning the current minimal similarity,
+            fingerprints with smaller bound are not visited.
+        """
+        size = len(self.sorted_counts)
+        right = int(numpy.searchsorted(self.sorted_counts, query_count))
+        left = right
+        step = min(_INITIAL_STEP, self.block_size)
+        while True:
+            low, high = count_range(query_count, cutoff(), metric)
+            first = int(numpy.searchsorted(
+                self.sorted_counts, low, side='left'))
+            if high is None:
+                last = size
+            else:
+                last = int(numpy.searchsorted(
+                    self.sorted_counts, high, side='right'))
+            left_bound = -1.0
+            if left > first:
+                left_bound = similarity_bound(
+                    query_count, self.sorted_counts[left - 1], metric)
+            right_bound = -1.0
+            if right < last:
+                right_bound = similarity_bound(
+                    query_count, self.sorted_counts[right], metric)
+            if left_bound < 0 and right_bound < 0:
+                break
+            if right_bound >= left_bound:
+                start, end = right, min(right + step, last)
+                right = end
+            else:
+                start, end = max(left - step, first), left
+                left = start
+            step = min(2 * step, self.block_size)
+            # Read the rows in order of storage.
+            rows = numpy.sort(self.order[start:end])
+            yield rows, self._compare(query, query_count, rows, metric)
+
+    def search(self, query, k=10, threshold=None, metric='tanimoto',
+               prune=True):
+        """Return fingerprints most similar to the query.
+
+        :param query: Query fingerprint as uint64 vector.
+        :param k: Number of fingerprints to return, ignored if threshold
+            is given.
+        :param threshold: If not None return all fingerprints with
+            at least given similarity.
+        :param metric: 'tanimoto' or 'dice'.
+        :param prune: Use the bit count bounds to skip fingerprints.
+        :return: List of (row, similarity) ordered by decreasing similarity
+            and increasing row.
+        """
+        query = numpy.asarray(query, dtype=numpy.uint64)
+        query_count = int(popcount(query.reshape(1, -1))[0])
+        best_rows = numpy.zeros(0, dtype=numpy.int64)
+        best_values = numpy.zeros(0, dtype=numpy.float64)
+        state = {'cutoff': 0.0 if threshold is None else threshold}
+        if prune:
+            blocks = self._pruned_scan(query, query_count, metric,
+                                       lambda: state['cutoff'])
+        else:
+            blocks = self._full_scan(query, query_count, metric)
+        for rows, values in blocks:
+            if threshold is None:
+                mask = values > 0
+            else:
+                mask = values >= threshold
+            best_rows = numpy.concatenate([best_rows, rows[mask]])
+            best_values = numpy.concatenate([best_values, values[mask]])
+            if threshold is None and len(best_values) >= k > 0:
+                keep = numpy.argpartition(-best_values, k - 1)[:k]
+                state['cutoff'] = best_values[keep].min()
+                # Keep the ties, they may have smaller row.
+                keep = best_values >= state['cutoff']
+                best_rows = best_rows[keep]
+                best_values = best_values[keep]
+        order = numpy.lexsort((best_rows, -best_values))
+        if threshold is None:
+            order = order[:k]
+        return [(int(best_rows[index]), float(best_values[index]))
+                for index in order]
+
+    def search_many(self, queries, k=10, threshold=None, metric='tanimoto',
+                    prune=True, threads=1):
+        """Search for every row of queries matrix, see search.
+
+        :param threads: Number of threads, 0 for the number of CPUs.
+        :return: List of search results.
+        """
+        if threads == 0:
+            threads = os.cpu_count() or 1
+
+        def search(query):
+            return self.search(query, k, threshold, metric, prune)
+
+        if threads == 1:
+            return [search(query) for query in queries]
+        with concurrent.futures.ThreadPoolExecutor(threads) as executor:
+            return list(executor.map(search, queries))
+
+
+def _read_configuration():
+    """Get and return application settings.
+
+    :return:
+    """
+    parser = argparse.ArgumentParser(
+        description='Search for similar vertex pair fingerprints. '
+                    'See file header for more details.')
+    parser.add_argument('-d', type=str, dest='database', required=True)
+    parser.add_argument('-q', type=str, dest='query', required=True)
+    parser.add_argument('-o', type=str, dest='output', required=True)
+    parser.add_argument('-k', type=int, dest='k', default=10)
+    parser.add_argument('-t', type=float, dest='threshold', required=False)
+    parser.add_argument('-m', type=str, dest='metric', default='tanimoto',
+                        choices=_metrics)
+    parser.add_argument('-p', type=int, dest='threads', default=1)
+    parser.add_argument('--block', type=int, dest='block',
+                        default=_BLOCK_SIZE)
+    parser.add_argument('--no-pruning', dest='prune', action='store_false')
+    return vars(parser.parse_args())
+
+
+def _main():
+    logging.basicConfig(
+        level=logging.DEBUG,
+        format='%(asctime)s [%(levelname)s] %(module)s - %(message)s',
+        datefmt='%H:%M:%S')
+    configuration = _read_configuration()
+    database = FingerprintDatabase.load(configuration['database'],
+                                        configuration['block'])
+    queries, query_ids = load_packed(configuration['query'])
+    if not queries.shape[1] == database.words.shape[1]:
+        logging.error('Query and database fingerprints differ in size.')
+        exit(1)
+    logging.info('Searching %d queries in %d fingerprints',
+                 len(query_ids), len(database.ids))
+    results = database.search_many(
+        queries, configuration['k'], configuration['threshold'],
+        configuration['metric'], configuration['prune'],
+        configuration['threads'])
+    with open(configuration['output'], 'w') as stream:
+        json.dump([{
+            'id': query_id,
+            'matches': [{'id': database.ids[row], 'similarity': value}
+                        for row, value in result]
+        } for query_id, result in zip(query_ids, results)], stream, indent=2)
+    logging.info('done')
+
+
+if __name__ == '__main__':
+    _main()
@@ -0,0 +1,183 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Benchmark fingerprint_search on random packed fingerprints.
+
+Usage:
+    python fingerprint_search_benchmark.py
+        -n {number of fingerprints in database, default 100000}
+        -b {number of bits in fingerprint, default 1024}
+        -q {number of queries, default 100}
+        -k {number of most similar fingerprints, default 10}
+        -t {similarity threshold for threshold queries, default 0.7}
+        -p {comma separated numbers of threads, default 1}
+        -s {random seed, default 0}
+        -o {optional path to output JSON report}
+
+Every fingerprint has a random density of set bits, so the bit counts
+vary as for interfaces of different size. The fingerprints are written
+by graph_vertex_pairs.write_packed into a temporary file and loaded back
+memory mapped. The queries are database fingerprints with some bits
+flipped. Top-k and threshold queries are timed with and without pruning
+for every number of threads. The report contains seconds and queries per
+second for every run.
+"""
+
+import argparse
+import json
+import logging
+import os
+import shutil
+import tempfile
+import time
+
+import numpy
+
+import fingerprint_search
+import graph_vertex_pairs
+
+__author__ = 'Petr Škoda'
+__license__ = 'X11'
+__email__ = 'skoda@ksi.mff.cuni.cz'
+
+# Range of densities of set bits in the fingerprints.
+_DENSITY = (0.01, 0.25)
+
+# Probability of flipping a bit in a query.
+_NOISE = 0.02
+
+
+def generate_fingerprints(count, bits, seed):
+    """Generate and return list of (id, fingerprint).
+
+    :param count:
+    :param bits:
+    :param seed:
+    :return:
+    """
+    rand = numpy.random.RandomState(seed)
+    result = []
+    for index in range(count):
+        density = rand.uniform(*_DENSITY)
+        value = (rand.random_sample(bits) < density).astype(numpy.uint8)
+        result.append(('fingerprint-' + str(index), value))
+    return result
+
+
+def generate_queries(fingerprints, count, seed):
+    """Return packed uint64 matrix of noisy copies of given fingerprints.
+
+    :param fingerprints: List of (id, fingerprint).
+    :param count:
+    :param seed:
+    :return:
+    """
+    rand = numpy.random.RandomState(seed + 1)
+    queries = []
+    for index in rand.randint(0, len(fingerprints), size=count):
+        value = fingerprints[index][1]
+        flip = rand.random_sample(len(value)) < _NOISE
+        value = numpy.bitwise_xor(value, flip.astype(numpy.uint8))
+        packed = numpy.packbits(value)
+        columns = ((len(packed) + 7) // 8) * 8
+        queries.append(numpy.concatenate([
+            packed, numpy.zeros(columns - len(packed), dtype=numpy.uint8)]))
+    return numpy.array(queries).view(numpy.uint64)
+
+
+def run_benchmark(database, queries, k, threshold, threads):
+    """Time top-k and threshold queries.
+
+    :param database: Instance of FingerprintDatabase.
+    :param queries: Matrix of uint64 query fingerprints.
+    :param k:
+    :param threshold:
+    :param threads: List of numbers of threads.
+    :return: Report object.
+    """
+    report = {}
+    for thread_count in threads:
+        for prune in [True, False]:
+            for mode in ['top_k', 'threshold']:
+                start = time.perf_counter()
+                if mode == 'top_k':
+                    results = database.search_many(
+                        queries, k=k, prune=prune, threads=thread_count)
+                else:
+                    results = database.search_many(
+                        queries, threshold=threshold, prune=prune,
+                        threads=thread_count)
+                seconds = time.perf_counter() - start
+                name = '{}_{}_threads_{}'.format(
+                    mode, 'pruned' if prune else 'full', thread_count)
+                report[name] = {
+                    'seconds': seconds,
+                    'queries_per_second':
+                        len(queries) / seconds if seconds > 0 else None,
+                    'matches': sum(len(result) for result in results)
+                }
+    return report
+
+
+def _read_configuration():
+    """Get and return application settings.
+
+    :return:
+    """
+    parser = argparse.ArgumentParser(
+        description='Benchmark similarity search on random fingerprints.'
+                    ' See file header for more details.')
+    parser.add_argument('-n', type=int, dest='count', default=100000)
+    parser.add_argument('-b', type=int, dest='bits', default=1024)
+    parser.add_argument('-q', type=int, dest='queries', default=100)
+    parser.add_argument('-k', type=int, dest='k', default=10)
+    parser.add_argument('-t', type=float, dest='threshold', default=0.7)
+    parser.add_argument('-p', type=str, dest='threads', default='1')
+    parser.add_argument('-s', type=int, dest='seed', default=0)
+    parser.add_argument('-o', type=str, dest='output', required=False)
+    return vars(parser.parse_args())
+
+
+def _main():
+    logging.basicConfig(
+        level=logging.DEBUG,
+        format='%(asctime)s [%(levelname)s] %(module)s - %(message)s',
+        datefmt='%H:%M:%S')
+    configuration = _read_configuration()
+    threads = [int(value) for value in configuration['threads'].split(',')]
+    #
+    fingerprints = generate_fingerprints(configuration['count'],
+                                         configuration['bits'],
+                                         configuration['seed'])
+    queries = generate_queries(fingerprints, configuration['queries'],
+                               configuration['seed'])
+    directory = tempfile.mkdtemp()
+    try:
+        path = os.path.join(directory, 'database.npy')
+        graph_vertex_pairs.write_packed(path, fingerprints)
+        del fingerprints
+        start = time.perf_counter()
+        database = fingerprint_search.FingerprintDatabase.load(path)
+        load_seconds = time.perf_counter() - start
+        report = {
+            'load_seconds': load_seconds,
+            'runs': run_benchmark(database, queries, configuration['k'],
+                                  configuration['threshold'], threads)
+        }
+        del database
+    finally:
+        shutil.rmtree(directory)
+    report['parameters'] = configuration
+    # Log and write report.
+    logging.info('Report')
+    logging.info('\tload: %.3f s', report['load_seconds'])
+    for name, value in sorted(report['runs'].items()):
+        logging.info('\t%s: %.3f s, %s queries/s', name, value['seconds'],
+                     '-' if value['queries_per_second'] is None
+                     else '%.1f' % value['queries_per_second'])
+    if configuration['output'] is not None:
+        with open(configuration['output'], 'w') as stream:
+            json.dump(report, stream, indent=2)
+
+
+if __name__ == '__main__':
+    _main()
@@ -0,0 +1,502 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Binary cache of graphs for repeated graph_vertex_pairs runs.
+
+Usage:
+    python graph_cache.py
+        -i {input JSON array or JSON Lines file with graphs}
+        -o {path prefix of the cache files}
+
+The cache consists of following files:
+    {prefix}.json : graph ids and description of the property columns
+    {prefix}.offsets.npy : start of vertices and edges of every graph
+    {prefix}.edges.npy : int32 matrix with positions of the 'from' and 'to'
+        vertices in the graph, one row for every edge
+    {prefix}.vertex.{column}.npy : values of a vertex property
+    {prefix}.edge.{column}.npy : values of an edge property
+    {prefix}.vertex.{column}.flags.npy, {prefix}.edge.{column}.flags.npy :
+        optional int8 flags of numeric property values
+Every property is stored in a column with a value for every vertex or
+edge of all graphs. Properties with only integer values are stored as
+int64 arrays, properties with float values as float64 arrays, including
+integers mixed with floats, e.g. coordinates written as 12 instead of
+12.0. Other properties, e.g. strings, are stored as small int codes into
+a list of categories stored in {prefix}.json, -1 for a missing value.
+Categories are collected only for such properties, so numeric columns do
+not keep their values in memory. If a numeric property is missing for
+some items or mixes integers with floats, its flags are -1 for a missing
+value, 1 for an integer and 0 otherwise, so the values are read back
+with their original type.
+
+The npy files are memory mapped when the cache is loaded, so a graph
+can be read by its id without reading the other graphs, see GraphCache.
+Graphs read from the cache are equal to the graphs in the input file.
+
+This file can also be used as a python script for import, in such case
+please use the write_cache method and the GraphCache class.
+"""
+
+import argparse
+import json
+import logging
+import numpy
+import numpy.lib.format
+import os
+import sys
+
+# Modules shared by the script directories.
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             os.pardir, 'common'))
+from json_stream import read_json_array_stream
+
+__author__ = 'Petr Škoda'
+__license__ = 'X11'
+__email__ = 'skoda@ksi.mff.cuni.cz'
+
+# Properties stored in the edges.npy file.
+_EDGE_VERTICES = ['from', 'to']
+
+
+def create_parent_directory(path):
+    """Create directory if it does not exists.
+
+    :param path:
+    :return:
+    """
+    dir_name = os.path.dirname(path)
+    if not os.path.exists(dir_name) and not dir_name == "":
+        os.makedirs(dir_name)
+
+
+def _read_configuration():
+    """Get and return application settings.
+
+    :return:
+    """
+    parser = argparse.ArgumentParser(
+        description='Convert graphs into binary cache. '
+                    'See file header for more details.')
+    parser.add_argument('-i', type=str, dest='input', required=True)
+    parser.add_argument('-o', type=str, dest='output', required=True)
+    return vars(parser.parse_args())
+
+
+# Integers with greater absolute value can not be stored in float64 or
+# int64 columns without loss.
+_MAX_FLOAT_INT = 1 << 53
+_MAX_INT = (1 << 63) - 1
+
+
+def _value_kind(value):
+    # Bool is a subclass of int, but it must be stored as a category.
+    if isinstance(value, bool):
+        return 'category'
+    elif isinstance(value, int):
+        return 'int'
+    elif isinstance(value, float):
+        return 'float'
+    else:
+        return 'category'
+
+
+class _ColumnSchema(object):
+    """Collect type and categories of a property.
+
+    Integers mixed with floats make a float column with flags. Categories
+    are collected only once the column is known to be categorical. If
+    a numeric column becomes categorical, the values seen before are
+    missing in the categories and the column is marked as incomplete,
+    see _collect_categories.
+    :param name:
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.kind = None
+        self.categories = {}
+        self.count = 0
+        self.incomplete = False
+        # True if there are integers in a float column.
+        self.integers = False
+        # Maximal absolute value of integers.
+        self.max_int = 0
+        self.flags = False
+
+    def add(self, value):
+        kind = _value_kind(value)
+        if kind == 'int':
+            self.max_int = max(self.max_int, abs(value))
+        if self.kind is None:
+            self.kind = kind
+        elif self.kind == 'category' or self.kind == kind:
+            pass
+        elif kind == 'category':
+            self.kind = 'category'
+            self.incomplete = True
+        else:
+            # Integers mixed with floats.
+            self.kind = 'float'
+            self.integers = True
+        self.count += 1
+        if self.kind == 'category':
+            self.add_category(value)
+
+    def add_category(self, value):
+        key = json.dumps(value)
+        if key not in self.categories:
+            self.categories[key] = len(self.categories)
+
+    def finish(self, items_count):
+        if (self.kind == 'int' and self.max_int > _MAX_INT) or \
+                (self.integers and self.max_int > _MAX_FLOAT_INT):
+            self.kind = 'category'
+            self.incomplete = True
+        if self.incomplete:
+            self.categories = {}
+        if not self.kind == 'category':
+            # Property missing for some items.
+            self.flags = self.integers or self.count < items_count
+
+    def dtype(self):
+        if self.kind == 'int':
+            return numpy.int64
+        elif self.kind == 'float':
+            return numpy.float64
+        elif len(self.categories) < (1 << 7):
+            return numpy.int8
+        elif len(self.categories) < (1 << 15):
+            return numpy.int16
+        else:
+            return numpy.int32
+
+    def encode(self, item):
+        if self.name not in item:
+            return -1 if self.kind == 'category' else 0
+        value = item[self.name]
+        if self.kind == 'category':
+            return self.categories[json.dumps(value)]
+        else:
+            return value
+
+    def encode_flag(self, item):
+        if self.name not in item:
+            return -1
+        elif self.kind == 'float' and isinstance(item[self.name], int):
+            return 1
+        else:
+            return 0
+
+    def describe(self, file_name, flags_file_name=None):
+        result = {
+            'name': self.name,
+            'kind': self.kind,
+            'file': file_name
+        }
+        if self.kind == 'category':
+            result['categories'] = [
+                json.loads(key) for key in self.categories.keys()]
+        if flags_file_name is not None:
+            result['flags'] = flags_file_name
+        return result
+
+
+def _collect_schema(graphs):
+    """Return ids, counts and column schemas of given graphs."""
+    ids = []
+    vertex_columns = {}
+    edge_columns = {}
+    vertex_count = 0
+    edge_count = 0
+    for graph in graphs:
+        ids.append(graph['ID'])
+        for vertex in graph['Vertices']:
+            for key, value in vertex.items():
+                if key not in vertex_columns:
+                    vertex_columns[key] = _ColumnSchema(key)
+                vertex_columns[key].add(value)
+        for edge in graph['Edges']:
+            for key, value in edge.items():
+                if key in _EDGE_VERTICES:
+                    continue
+                if key not in edge_columns:
+                    edge_columns[key] = _ColumnSchema(key)
+                edge_columns[key].add(value)
+        vertex_count += len(graph['Vertices'])
+        edge_count += len(graph['Edges'])
+    for column in vertex_columns.values():
+        column.finish(vertex_count)
+    for column in edge_columns.values():
+        column.finish(edge_count)
+    return ids, vertex_count, edge_count, \
+           list(vertex_columns.values()), list(edge_columns.values())
+
+
+def _collect_categories(graphs, vertex_columns, edge_columns):
+    """Collect categories of incomplete columns, see _ColumnSchema."""
+    vertex_columns = [column for column in vertex_columns
+                      if column.incomplete]
+    edge_columns = [column for column in edge_columns if column.incomplete]
+    for graph in graphs:
+        for columns, items in [(vertex_columns, graph['Vertices']),
+                               (edge_columns, graph['Edges'])]:
+            for column in columns:
+                for item in items:
+                    if column.name in item:
+                        column.add_category(item[column.name])
+    for column in vertex_columns + edge_columns:
+        column.incomplete = False
+
+
+def _open_array(path, dtype, shape):
+    """Create npy file and return it as a writable memory mapped array."""
+    if numpy.prod(shape) == 0:
+        # Empty file can not be memory mapped.
+        array = numpy.zeros(shape, dtype=dtype)
+        numpy.save(path, array)
+        return array
+    return numpy.lib.format.open_memmap(
+        path, mode='w+', dtype=dtype, shape=shape)
+
+
+def _open_columns(output_prefix, name, columns, count):
+    """Create arrays for given columns.
+
+    :param output_prefix:
+    :param name: 'vertex' or 'edge'.
+    :param columns: List of _ColumnSchema.
+    :param count: Number of items.
+    :return: (list of (column, values, flags or None), descriptions)
+    """
+    arrays = []
+    description = []
+    for index, column in enumerate(columns):
+        file_name = name + '.' + str(index) + '.npy'
+        values = _open_array(output_prefix + '.' + file_name,
+                             column.dtype(), (count,))
+        flags = None
+        flags_file_name = None
+        if column.flags:
+            flags_file_name = name + '.' + str(index) + '.flags.npy'
+            flags = _open_array(output_prefix + '.' + flags_file_name,
+                                numpy.int8, (count,))
+        arrays.append((column, values, flags))
+        description.append(column.describe(file_name, flags_file_name))
+    return arrays, description
+
+
+def _write_columns(arrays, items, offset):
+    """Write values of given items into the column arrays."""
+    for column, values, flags in arrays:
+        values[offset:offset + len(items)] = \
+            [column.encode(item) for item in items]
+        if flags is not None:
+            flags[offset:offset + len(items)] = \
+                [column.encode_flag(item) for item in items]
+
+
+def write_cache(input_file, output_prefix):
+    """Convert graphs from JSON file into the binary cache.
+
+    The input is read twice, first to collect property types and
+    categories and then to write the values. If a numeric property turns
+    out to be categorical, the input is read once more to collect its
+    categories.
+    :param input_file: JSON array or JSON Lines file with graphs.
+    :param output_prefix:
+    :return: Number of graphs.
+    """
+    create_parent_directory(output_prefix)
+    with open(input_file, 'r') as input_stream:
+        ids, vertex_count, edge_count, vertex_columns, edge_columns = \
+            _collect_schema(read_json_array_stream(input_stream))
+    if not len(set(ids)) == len(ids):
+        raise Exception('Graph ids are not unique.')
+    if any(column.incomplete for column in vertex_columns + edge_columns):
+        with open(input_file, 'r') as input_stream:
+            _collect_categories(read_json_array_stream(input_stream),
+                                vertex_columns, edge_columns)
+    logging.info('Graphs: %d, vertices: %d, edges: %d',
+                 len(ids), vertex_count, edge_count)
+    #
+    offsets = _open_array(output_prefix + '.offsets.npy', numpy.int64,
+                          (len(ids) + 1, 2))
+    edges = _open_array(output_prefix + '.edges.npy', numpy.int32,
+                        (edge_count, 2))
+    vertex_arrays, vertex_description = _open_columns(
+        output_prefix, 'vertex', vertex_columns, vertex_count)
+    edge_arrays, edge_description = _open_columns(
+        output_prefix, 'edge', edge_columns, edge_count)
+    #
+    vertex_offset = 0
+    edge_offset = 0
+    with open(input_file, 'r') as input_stream:
+        graphs = read_json_array_stream(input_stream)
+        for graph_index, graph in enumerate(graphs):
+            offsets[graph_index] = (vertex_offset, edge_offset)
+            vertices = graph['Vertices']
+            positions = {}
+            for position, vertex in enumerate(vertices):
+                positions.setdefault(vertex['id'], position)
+            _write_columns(vertex_arrays, vertices, vertex_offset)
+            for position, edge in enumerate(graph['Edges']):
+                try:
+                    edges[edge_offset + position] = \
+                        [positions[edge[key]] for key in _EDGE_VERTICES]
+                except KeyError:
+                    raise Exception('Edge with unknown vertex in graph: ' +
+                                    str(graph['ID']))
+            _write_columns(edge_arrays, graph['Edges'], edge_offset)
+            vertex_offset += len(vertices)
+            edge_offset += len(graph['Edges'])
+        offsets[len(ids)] = (vertex_offset, edge_offset)
+    column_arrays = [array for _, values, flags
+                     in vertex_arrays + edge_arrays
+                     for array in [values, flags] if array is not None]
+    for array in [offsets, edges] + column_arrays:
+        if isinstance(array, numpy.memmap):
+            array.flush()
+    del offsets, edges, vertex_arrays, edge_arrays, column_arrays
+    with open(output_prefix + '.json', 'w') as output_stream:
+        json.dump({
+            'ids': ids,
+            'vertex': vertex_description,
+            'edge': edge_description
+        }, output_stream)
+    return len(ids)
+
+
+class GraphCache(object):
+    """Graphs stored by write_cache, the arrays are memory mapped.
+
+    :param prefix: Path prefix of the cache files.
+    """
+
+    def __init__(self, prefix):
+        with open(prefix + '.json', 'r') as stream:
+            description = json.load(stream)
+        self.ids = description['ids']
+        self.indexes = {id: index for index, id in enumerate(self.ids)}
+        self.offsets = numpy.load(prefix + '.offsets.npy', mmap_mode='r')
+        self.edges = numpy.load(prefix + '.edges.npy', mmap_mode='r')
+        self.vertex_columns = self._load_columns(
+            prefix, description['vertex'])
+        self.edge_columns = self._load_columns(prefix, description['edge'])
+
+    @staticmethod
+    def _load_columns(prefix, description):
+        result = []
+        for item in description:
+            values = numpy.load(prefix + '.' + item['file'], mmap_mode='r')
+            flags = None
+            if 'flags' in item:
+                flags = numpy.load(prefix + '.' + item['flags'],
+                                   mmap_mode='r')
+            result.append((item['name'], values, item.get('categories'),
+                           flags))
+        return result
+
+    def __len__(self):
+        return len(self.ids)
+
+    def index(self, id):
+        """Return position of the graph with given ID."""
+        return self.indexes[id]
+
+    def arrays(self, index):
+        """Return arrays of the graph on given position without copying.
+
+        :param index:
+        :return: Dictionary with 'edges' matrix, 'vertex' and 'edge'
+            dictionaries with values of every property. Categorical
+            properties contain codes into the categories. The 'vertex_flags'
+            and 'edge_flags' dictionaries contain flags of numeric
+            properties that have them, see the file header.
+        """
+        vertex_start, edge_start = self.offsets[index]
+        vertex_end, edge_end = self.offsets[index + 1]
+        return {
+            'edges': self.edges[edge_start:edge_end],
+            'vertex': {name: values[vertex_start:vertex_end]
+                       for name, values, _, _ in self.vertex_columns},
+            'edge': {name: values[edge_start:edge_end]
+                     for name, values, _, _ in self.edge_columns},
+            'vertex_flags': {name: flags[vertex_start:vertex_end]
+                             for name, _, _, flags in self.vertex_columns
+                             if flags is not None},
+            'edge_flags': {name: flags[edge_start:edge_end]
+                           for name, _, _, flags in self.edge_columns
+                           if flags is not None}
+        }
+
+    @staticmethod
+    def _decode(columns, start, end):
+        """Return list of items with values from given columns."""
+        items = [{} for _ in range(end - start)]
+        for name, values, categories, flags in columns:
+            values = values[start:end].tolist()
+            if flags is not None:
+                for item, value, flag in zip(
+                        items, values, flags[start:end].tolist()):
+                    if flag == 1:
+                        item[name] = int(value)
+                    elif flag == 0:
+                        item[name] = value
+                continue
+            if categories is None:
+                for item, value in zip(items, values):
+                    item[name] = value
+                continue
+            for item, value in zip(items, values):
+                if value >= 0:
+                    item[name] = categories[value]
+        return items
+
+    def graph(self, index):
+        """Return graph on given position in the graph_vertex_pairs format.
+
+        :param index:
+        :return:
+        """
+        vertex_start, edge_start = self.offsets[index].tolist()
+        vertex_end, edge_end = self.offsets[index + 1].tolist()
+        vertices = self._decode(self.vertex_columns, vertex_start,
+                                vertex_end)
+        edges = self._decode(self.edge_columns, edge_start, edge_end)
+        for edge, positions in zip(
+                edges, self.edges[edge_start:edge_end].tolist()):
+            for key, position in zip(_EDGE_VERTICES, positions):
+                edge[key] = vertices[position]['id']
+        return {
+            'ID': self.ids[index],
+            'Vertices': vertices,
+            'Edges': edges
+        }
+
+    def graph_by_id(self, id):
+        return self.graph(self.index(id))
+
+    def read(self, start=0, end=None):
+        """Return generator of graphs on positions from start to end.
+
+        :param start:
+        :param end: Position after the last graph, None for all graphs.
+        :return:
+        """
+        if end is None:
+            end = len(self.ids)
+        for index in range(start, end):
+            yield self.graph(index)
+
+
+def _main():
+    logging.basicConfig(
+        level=logging.DEBUG,
+        format='%(asctime)s [%(levelname)s] %(module)s - %(message)s',
+        datefmt='%H:%M:%S')
+    configuration = _read_configuration()
+    count = write_cache(configuration['input'], configuration['output'])
+    logging.info('done %d', count)
+
+
+if __name__ == '__main__':
+    _main()
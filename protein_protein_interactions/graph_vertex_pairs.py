@@ -5,49 +5,54 @@
 """
 
 import argparse
+import collections
+import itertools
 import json
 import logging
+import multiprocessing
 import numpy
 import math
+import os
+import sys
+import queue
+import threading
+import time
+
+# Modules shared by the script directories.
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             os.pardir, 'common'))
+import graph_cache
+import instrumentation
+import sharding
+from json_stream import read_json_array_stream
+import vertex_pairs_kernel
 
 __author__ = 'Petr Škoda'
 __license__ = 'X11'
 __email__ = 'skoda@ksi.mff.cuni.cz'
 
+# Supported fingerprint modes, see create_fingerprint.
+_modes = ['binary', 'count', 'unfolded']
 
-def read_json_array_stream(stream):
-    """Read JSON objects from array.
+# Backends computing edge codes, see initialize_conversion_configuration.
+_backends = ['auto', 'python', 'numba']
 
-    The text data must not contains control characters '{' or '}' in string.
-    :param stream:
-    :return:
-    """
-    # Read till the beginning of the array ie. first '['
-    while True:
-        char = stream.read(1)
-        if char == '[':
-            break
-        if char == '':
-            return
-    #
-    buffer = ''
-    braces = 0
-    while True:
-        char = stream.read(1)
-        if char == '':
-            return
-        # Skip separators between objects.
-        if char == ',' and braces == 0:
-            continue
-        # Store characters.
-        buffer += char
-        if char == '{':
-            braces += 1
-        elif char == '}':
-            braces -= 1
-            if braces == 0:
-                yield json.loads(buffer)
-                buffer = ''
+# Edge template types and compute methods with symmetric values.
+_symmetric_edge_types = ['distance', 'compute', 'property', 'mapping',
+                         'binning']
+_symmetric_methods = ['euclidean_distance']
+
+# Vertex pair indexes are stored in int64, see compute_pair_indexes.
+_INDEX_BITS = 63
+
+# Size of NPY header written by write_packed, must be a multiple of 64.
+_NPY_HEADER_SIZE = 128
+
+# Number of fingerprints buffered for every output by write_multiple.
+_QUEUE_SIZE = 64
+
+# Conversion configuration of a worker process, set by _initialize_worker.
+_worker_configuration = None
 
 
 def read_configuration():
@@ -58,17 +63,55 @@ def read_configuration():
     parser = argparse.ArgumentParser(
         description='computes fingerprints for given graphs')
     parser.add_argument('-i', type=str, dest='input',
-                        help='input SDF file', required=True)
-    parser.add_argument('-c', type=str, dest='configuration',
-                        help='configuration JSON file', required=True)
+                        help='input JSON array or JSON Lines file',
+                        required=True)
+    parser.add_argument('--cache', dest='cache', action='store_true',
+                        help='input is a path prefix of a graph cache '
+                             'created by graph_cache.py')
+    parser.add_argument('-c', type=str, dest='configuration', nargs='+',
+                        help='configuration JSON files, a file can contain '
+                             'an array of configurations', required=True)
     parser.add_argument('-o', type=str, dest='output',
-                        help='output SDF file', required=True)
+                        help='output file, for several configurations '
+                             'the configuration name or index is inserted '
+                             'before the extension', required=True)
+    parser.add_argument('-f', type=str, dest='format', default='json',
+                        choices=sorted(_write_functions.keys()),
+                        help='output format, see write_* functions')
+    parser.add_argument('-m', type=str, dest='mode', default=None,
+                        choices=_modes,
+                        help='fingerprint mode, overrides the configuration')
+    parser.add_argument('--statistics', dest='statistics',
+                        action='store_true',
+                        help='log number of unique indexes and collisions')
+    parser.add_argument('-p', type=int, dest='processes', default=1,
+                        help='number of worker processes, use 0 for '
+                             'the number of CPUs')
+    parser.add_argument('--batch', type=int, dest='batch', default=16,
+                        help='number of graphs send to a worker at once')
+    parser.add_argument('--backend', type=str, dest='backend',
+                        default='auto', choices=_backends,
+                        help='computation of edge codes, see '
+                             'initialize_conversion_configuration')
+    instrumentation.add_arguments(parser)
+    sharding.add_arguments(parser)
     args = vars(parser.parse_args())
     #
     output = {
         'input': args['input'],
+        'cache': args['cache'],
         'configuration': args['configuration'],
-        'output': args['output']
+        'output': args['output'],
+        'format': args['format'],
+        'mode': args['mode'],
+        'statistics': args['statistics'],
+        'processes': args['processes'],
+        'batch': args['batch'],
+        'backend': args['backend'],
+        'shard': args['shard'],
+        'metrics': args['metrics'],
+        'metrics_interval': args['metrics_interval'],
+        'prometheus': args['prometheus']
     }
     return output
 
@@ -214,9 +257,17 @@ def get_edge_code(left_index, right_index, vertices, edges, configuration,
         elif item['type'] == 'compute':
             # Computed property.
             if item['method'] == 'euclidean_distance':
+                if 'coordinates' in molecule:
+                    points = get_coordinates(molecule, vertices,
+                                             item['source'])
+                    components = zip(points[left_index],
+                                     points[right_index])
+                else:
+                    components = ((float(left[key]), float(right[key]))
+                                  for key in item['source'])
                 value = 0
-                for key in item['source']:
-                    value += pow(float(left[key]) - float(right[key]), 2)
+                for x, y in components:
+                    value += pow(x - y, 2)
                 value = math.sqrt(value)
             else:
                 raise Exception('Unknown method: ' + item['method'])
@@ -243,55 +294,753 @@ def get_edge_code(left_index, right_index, vertices, edges, configuration,
     return result % configuration['edge_max']
 
 
-def process_graph(graph, configuration):
-    # print(json.dumps(graph, indent=2))
+def create_fingerprint(indexes, configuration, statistics=None,
+                       counts=None):
+    """Create fingerprint from vertex pair indexes.
+
+    Fingerprint type depends on configuration['fingerprint']['mode']:
+        - binary : uint8 array with ones on folded indexes
+        - count : uint32 array with number of pairs per folded index
+        - unfolded : dictionary from unfolded index to the number of pairs
+    If statistics is not None the number of pairs, unique indexes, unique
+    folded indexes and collisions caused by the folding are added to it.
+    :param indexes: Numpy int64 array with vertex pair indexes.
+    :param configuration:
+    :param statistics: Optional dictionary to add statistics into.
+    :param counts: Optional numpy array with number of pairs for each index,
+        if not given every index represents one pair.
+    :return:
+    """
+    fingerprint_size = configuration['fingerprint']['size']
+    mode = configuration['fingerprint']['mode']
+    if counts is None:
+        counts = numpy.ones(len(indexes), dtype=numpy.int64)
+    folded = indexes % fingerprint_size
+    if mode == 'binary':
+        fingerprint = numpy.zeros(fingerprint_size, dtype=numpy.uint8)
+        fingerprint[folded] = 1
+    elif mode == 'count':
+        fingerprint = numpy.bincount(
+            folded, weights=counts,
+            minlength=fingerprint_size).astype(numpy.uint32)
+    elif mode == 'unfolded':
+        unique, inverse = numpy.unique(indexes, return_inverse=True)
+        unique_counts = numpy.bincount(inverse.ravel(), weights=counts,
+                                       minlength=len(unique))
+        fingerprint = dict(zip(unique.tolist(),
+                               unique_counts.astype(numpy.int64).tolist()))
+    else:
+        raise Exception('Unknown fingerprint mode: ' + mode)
+    if statistics is not None:
+        unique_count = len(numpy.unique(indexes))
+        folded_count = len(numpy.unique(folded))
+        add_statistics(statistics, {
+            'graphs': 1,
+            'pairs': int(counts.sum()),
+            'unique': unique_count,
+            'folded': folded_count,
+            'collisions': unique_count - folded_count
+        })
+    return fingerprint
+
+
+def add_statistics(target, source):
+    """Add values from source statistics to target statistics.
+
+    :param target: Dictionary or list of dictionaries.
+    :param source: Statistics of the same type as target.
+    :return:
+    """
+    if isinstance(target, list):
+        for target_item, source_item in zip(target, source):
+            add_statistics(target_item, source_item)
+        return
+    for key, value in source.items():
+        target[key] = target.get(key, 0) + value
+
+
+def create_statistics(configuration):
+    """Return empty statistics for given configuration or configurations.
+
+    :param configuration:
+    :return:
+    """
+    if isinstance(configuration, list):
+        return [{} for _ in configuration]
+    return {}
+
+
+def find_neighbour_pairs(coordinates, radius):
+    """Find ordered pairs of vertices closer than the radius.
+
+    Vertices are assigned to cubic cells with edge of the radius, so only
+    vertices in the same or adjacent cells are compared and the cost
+    depends on the local density instead of the number of vertices.
+    :param coordinates: Numpy array with a row of coordinates per vertex.
+    :param radius:
+    :return: Numpy arrays with left and right vertex positions.
+    """
+    cells = {}
+    for position, cell in enumerate(
+            numpy.floor(coordinates / radius).astype(numpy.int64).tolist()):
+        cells.setdefault(tuple(cell), []).append(position)
+    dimension = coordinates.shape[1]
+    offsets = list(itertools.product((-1, 0, 1), repeat=dimension))
+    left_result = [numpy.zeros(0, dtype=numpy.int64)]
+    right_result = [numpy.zeros(0, dtype=numpy.int64)]
+    for cell, members in cells.items():
+        neighbours = []
+        for offset in offsets:
+            neighbour = tuple(x + y for x, y in zip(cell, offset))
+            neighbours.extend(cells.get(neighbour, []))
+        members = numpy.array(members, dtype=numpy.int64)
+        neighbours = numpy.array(neighbours, dtype=numpy.int64)
+        delta = coordinates[members][:, None, :] - \
+                coordinates[neighbours][None, :, :]
+        close = (delta ** 2).sum(axis=2) < radius * radius
+        close &= members[:, None] != neighbours[None, :]
+        left, right = numpy.nonzero(close)
+        left_result.append(members[left])
+        right_result.append(neighbours[right])
+    return numpy.concatenate(left_result), numpy.concatenate(right_result)
+
+
+def _aggregate_far_pairs(codes, near_left, near_right, configuration):
+    """Return indexes and counts for vertex pairs not closer than the radius.
+
+    All such pairs with the same vertex codes are represented by a single
+    index with the edge code configuration['neighbours']['far_edge'].
+    The counts are computed from a histogram of vertex codes, so the cost
+    does not depend on the number of far pairs.
+    :param codes: Numpy array with vertex codes.
+    :param near_left: Positions of left vertices in the near pairs.
+    :param near_right: Positions of right vertices in the near pairs.
+    :param configuration:
+    :return: Numpy arrays with indexes and counts.
+    """
+    unique, code_counts = numpy.unique(codes, return_counts=True)
+    # Number of all ordered pairs for every pair of unique codes.
+    counts = numpy.outer(code_counts, code_counts) - numpy.diag(code_counts)
+    # Subtract the near pairs.
+    near = numpy.searchsorted(unique, codes[near_left]) * len(unique) + \
+           numpy.searchsorted(unique, codes[near_right])
+    counts = counts.ravel() - numpy.bincount(near,
+                                             minlength=len(unique) ** 2)
+    left, right = numpy.divmod(numpy.flatnonzero(counts), len(unique))
+    edge_code = configuration['neighbours']['far_edge'] % \
+                configuration['edge_max']
+    vertex_size = configuration['fingerprint']['vertex_size']
+    edge_size = configuration['fingerprint']['edge_size']
+    indexes = (unique[left] << (vertex_size + edge_size)) + \
+              (edge_code << vertex_size) + unique[right]
+    return indexes, counts[counts > 0]
+
+
+def compute_vertex_codes(ids, vertices, configuration, info):
+    """Return numpy array with codes of given vertices.
+
+    :param ids: List of vertex ids.
+    :param vertices: Vertices by id.
+    :param configuration:
+    :param info: Global descriptors of the graph.
+    :return:
+    """
+    return numpy.array(
+        [get_vertex_code(id, vertices, configuration, info) for id in ids],
+        dtype=numpy.int64)
+
+
+def compute_pair_indexes(ids, vertices, edges, codes, info, configuration):
+    """Return indexes of vertex pairs and optionally their counts.
+
+    If the configuration contains 'neighbours' only pairs of vertices
+    closer than the neighbours radius are enumerated, the other pairs are
+    skipped or aggregated, see initialize_conversion_configuration.
+    For symmetric edge templates only unordered pairs are evaluated and
+    indexes for both orders are created from a single edge code.
+    If configuration['kernel'] is set the edge codes are computed by
+    vertex_pairs_kernel, see initialize_conversion_configuration.
+    :param ids: List of vertex ids.
+    :param vertices: Vertices by id.
+    :param edges:
+    :param codes: Vertex codes in order of ids, see compute_vertex_codes.
+    :param info: Global descriptors of the graph.
+    :param configuration:
+    :return: Numpy array with indexes and numpy array with counts or None.
+    """
+    left, right = _find_close_pairs(ids, vertices, info, configuration)
+    #
+    indexes = None
+    if configuration.get('kernel') is not None:
+        indexes = _compute_kernel_indexes(
+            ids, vertices, codes, info, configuration, left, right)
+    if indexes is None:
+        indexes = _compute_python_indexes(
+            ids, vertices, edges, codes, info, configuration, left, right)
+    if left is None or configuration['neighbours']['far'] == 'skip':
+        return indexes, None
+    far_indexes, far_counts = _aggregate_far_pairs(
+        codes, left, right, configuration)
+    return numpy.concatenate((indexes, far_indexes)), \
+           numpy.concatenate((numpy.ones(len(indexes), dtype=numpy.int64),
+                              far_counts))
+
+
+def _find_close_pairs(ids, vertices, info, configuration):
+    """Return positions of close vertex pairs, see compute_pair_indexes.
+
+    :param ids: List of vertex ids.
+    :param vertices: Vertices by id.
+    :param info: Global descriptors of the graph.
+    :param configuration:
+    :return: Numpy arrays with positions of left and right vertices,
+        or (None, None) for all pairs.
+    """
+    if 'neighbours' not in configuration:
+        return None, None
+    neighbours = configuration['neighbours']
+    coordinates = _get_coordinate_matrix(
+        ids, vertices, neighbours['source'], info)
+    return find_neighbour_pairs(coordinates, neighbours['radius'])
+
+
+def _get_coordinate_matrix(ids, vertices, source, info):
+    """Return numpy matrix with coordinates of vertices in order of ids.
+
+    :param ids: List of vertex ids.
+    :param vertices: Vertices by id.
+    :param source: List of coordinate properties.
+    :param info: Global descriptors of the graph.
+    :return:
+    """
+    if 'coordinates' in info:
+        points = get_coordinates(info, vertices, source)
+        coordinates = [points[id] for id in ids]
+    else:
+        coordinates = [[float(vertices[id][key]) for key in source]
+                       for id in ids]
+    return numpy.array(coordinates, dtype=numpy.float64).reshape(
+        len(ids), len(source))
+
+
+def _compute_python_indexes(ids, vertices, edges, codes, info,
+                            configuration, left, right):
+    """Return indexes of vertex pairs computed by get_edge_code.
 
+    :param left: Positions of left vertices of close pairs or None for
+        all pairs.
+    :param right: Positions of right vertices of close pairs or None.
+    :return: Numpy array with indexes.
+    """
+    edge_size = configuration['fingerprint']['edge_size']
+    vertex_size = configuration['fingerprint']['vertex_size']
+    symmetric = configuration['fingerprint']['symmetric']
+    if left is not None:
+        if symmetric:
+            pairs = [(x, y) for x, y in zip(left.tolist(), right.tolist())
+                     if x < y]
+        else:
+            pairs = zip(left.tolist(), right.tolist())
+    else:
+        if symmetric:
+            pairs = itertools.combinations(range(len(ids)), 2)
+        else:
+            pairs = itertools.permutations(range(len(ids)), 2)
+    indexes = []
+    for left_position, right_position in pairs:
+        edge_code = get_edge_code(ids[left_position], ids[right_position],
+                                  vertices, edges, configuration, info)
+        left_code = int(codes[left_position])
+        right_code = int(codes[right_position])
+        # Construct value.
+        indexes.append((left_code << (vertex_size + edge_size)) +
+                       (edge_code << vertex_size) + right_code)
+        if symmetric:
+            # Value for the (right, left) pair has the same edge code.
+            indexes.append((right_code << (vertex_size + edge_size)) +
+                           (edge_code << vertex_size) + left_code)
+    return numpy.array(indexes, dtype=numpy.int64)
+
+
+def _get_distance_matrix(ids, info):
+    """Return numpy matrix with distances of vertices, -1 for no path.
+
+    The matrix is stored in info, so it is shared by all configurations.
+    :param ids: List of vertex ids.
+    :param info: Global descriptors of the graph.
+    :return:
+    """
+    if 'distance_matrix' not in info:
+        distance = info['distance']
+        info['distance_matrix'] = numpy.array(
+            [[-1 if distance[x][y] is None else distance[x][y] for y in ids]
+             for x in ids], dtype=numpy.int64).reshape(len(ids), len(ids))
+    return info['distance_matrix']
+
+
+def _compute_kernel_indexes(ids, vertices, codes, info, configuration,
+                            left, right):
+    """Return indexes of vertex pairs computed by vertex_pairs_kernel.
+
+    :param left: Positions of left vertices of close pairs or None for
+        all pairs.
+    :param right: Positions of right vertices of close pairs or None.
+    :return: Numpy array with indexes or None if the kernel failed.
+    """
+    program = configuration['kernel']
+    edge_size = configuration['fingerprint']['edge_size']
+    vertex_size = configuration['fingerprint']['vertex_size']
+    symmetric = configuration['fingerprint']['symmetric']
+    if left is not None:
+        if symmetric:
+            mask = left < right
+            left, right = left[mask], right[mask]
+    elif symmetric:
+        left, right = numpy.triu_indices(len(ids), 1)
+    else:
+        left, right = numpy.nonzero(
+            ~numpy.eye(len(ids), dtype=numpy.bool_))
+    left = left.astype(numpy.int64)
+    right = right.astype(numpy.int64)
+    coordinates = _get_coordinate_matrix(
+        ids, vertices, program['source'] or [], info)
+    edge_codes = vertex_pairs_kernel.compute_edge_codes(
+        program, left, right, _get_distance_matrix(ids, info), coordinates)
+    if edge_codes is None:
+        return None
+    left_codes = codes[left]
+    right_codes = codes[right]
+    indexes = (left_codes << (vertex_size + edge_size)) + \
+              (edge_codes << vertex_size) + right_codes
+    if symmetric:
+        # Value for the (right, left) pair has the same edge code.
+        reverse = (right_codes << (vertex_size + edge_size)) + \
+                  (edge_codes << vertex_size) + left_codes
+        indexes = numpy.column_stack((indexes, reverse)).ravel()
+    return indexes
+
+
+def prepare_graph(graph):
+    """Compute and return state of a graph shared by all configurations.
+
+    The state contains vertices by id, edges, list of vertex ids and
+    global descriptors of the graph, i.e. the distance matrix and a cache
+    of vertex coordinates, see get_coordinates.
+    :param graph:
+    :return:
+    """
     vertices = {}
     for item in graph['Vertices']:
         vertices[item['id']] = item
     edges = graph['Edges']
-    #
-    fingerprint_size = configuration['fingerprint']['size']
+    return {
+        'vertices': vertices,
+        'edges': edges,
+        'ids': list(vertices.keys()),
+        'info': {
+            'distance': warshall(vertices.keys(), edges),
+            'coordinates': {}
+        }
+    }
+
+
+def get_coordinates(info, vertices, source):
+    """Return coordinates of vertices as tuples of floats by vertex id.
+
+    The coordinates are computed only once for given source properties
+    and stored in info['coordinates'].
+    :param info: Global descriptors of the graph, see prepare_graph.
+    :param vertices: Vertices by id.
+    :param source: List of coordinate properties.
+    :return:
+    """
+    key = tuple(source)
+    cache = info['coordinates']
+    if key not in cache:
+        cache[key] = {
+            id: tuple(float(vertex[name]) for name in source)
+            for id, vertex in vertices.items()}
+    return cache[key]
+
+
+def compute_fingerprint(state, configuration, statistics=None):
+    """Compute and return fingerprint for a graph prepared by prepare_graph.
+
+    :param state: See prepare_graph.
+    :param configuration: Initialized conversion configuration.
+    :param statistics: Optional dictionary, see create_fingerprint.
+    :return: Fingerprint, see create_fingerprint.
+    """
+    ids = state['ids']
+    codes = compute_vertex_codes(ids, state['vertices'], configuration,
+                                 state['info'])
+    indexes, counts = compute_pair_indexes(
+        ids, state['vertices'], state['edges'], codes, state['info'],
+        configuration)
+    return create_fingerprint(indexes, configuration, statistics, counts)
+
+
+def process_graph(graph, configuration, statistics=None, timings=None):
+    """Compute and return fingerprint for given graph.
+
+    If configuration is a list, return list with a fingerprint for every
+    configuration. The graph is parsed and the distance matrix and
+    coordinates are computed only once for all configurations.
+    :param graph:
+    :param configuration: Initialized conversion configuration or a list
+        of them.
+    :param statistics: Optional dictionary, see create_fingerprint, or
+        list of dictionaries, one for every configuration.
+    :param timings: Optional list, (stage, seconds) of the 'prepare' and
+        'fingerprint' stages are appended to it.
+    :return: Fingerprint, see create_fingerprint, or list of them.
+    """
+    start = time.perf_counter()
+    state = prepare_graph(graph)
+    prepared = time.perf_counter()
+    result = _compute_fingerprints(state, configuration, statistics)
+    if timings is not None:
+        timings.append(('prepare', prepared - start))
+        timings.append(('fingerprint', time.perf_counter() - prepared))
+    return result
+
+
+def _compute_fingerprints(state, configuration, statistics):
+    if not isinstance(configuration, list):
+        return compute_fingerprint(state, configuration, statistics)
+    if statistics is None:
+        statistics = [None] * len(configuration)
+    result = []
+    for item, item_statistics in zip(configuration, statistics):
+        # Named values are stored into vertices and edges, so every
+        # configuration works with its own copy as in a separate run.
+        item_state = dict(state)
+        item_state['vertices'] = {
+            id: dict(vertex) for id, vertex in state['vertices'].items()}
+        item_state['edges'] = [dict(edge) for edge in state['edges']]
+        result.append(compute_fingerprint(item_state, item, item_statistics))
+    return result
+
+
+def _get_pair_index(left, right, state, configuration):
+    """Return index of the ordered vertex pair or None if it is not used.
+
+    :param left:
+    :param right:
+    :param state: See create_graph_state.
+    :param configuration:
+    :return:
+    """
+    vertices = state['vertices']
+    if 'neighbours' in configuration:
+        neighbours = configuration['neighbours']
+        distance = 0
+        for key in neighbours['source']:
+            distance += pow(float(vertices[left][key]) -
+                            float(vertices[right][key]), 2)
+        if distance >= neighbours['radius'] * neighbours['radius']:
+            return None
     edge_size = configuration['fingerprint']['edge_size']
     vertex_size = configuration['fingerprint']['vertex_size']
-    # Compute global descriptors.
-    info = {
-        'distance': warshall(vertices.keys(), edges)
+    edge_code = get_edge_code(left, right, vertices, state['edges'],
+                              configuration, state['info'])
+    return (state['codes'][left] << (vertex_size + edge_size)) + \
+           (edge_code << vertex_size) + state['codes'][right]
+
+
+def create_graph_state(graph, configuration):
+    """Compute and return state of a reference graph for update_graph_state.
+
+    The state contains vertices, edges, distance matrix, vertex codes and
+    counts of the unfolded indexes. Use create_fingerprint(
+    numpy.array(list(counts.keys())), configuration, None,
+    numpy.array(list(counts.values()))) to get the fingerprint.
+    :param graph:
+    :param configuration: Initialized conversion configuration.
+    :return:
+    """
+    if 'neighbours' in configuration and \
+            configuration['neighbours']['far'] == 'aggregate':
+        raise Exception('Aggregated far pairs are not supported.')
+    vertices = {}
+    for item in graph['Vertices']:
+        vertices[item['id']] = item
+    state = {
+        'vertices': vertices,
+        'edges': graph['Edges'],
+        'info': {
+            'distance': warshall(vertices.keys(), graph['Edges'])
+        },
+        'codes': {},
+        'counts': collections.Counter()
     }
-    # COMMENT OUT THIS AND USAGE TO IMPROVE PERFORMANCE
-    indexes_count = 0
-    indexes = set()
-    indexes_hashed = set()
-    #
-    fingerprint = numpy.zeros(fingerprint_size)
-    for left in vertices.keys():
-        for right in vertices.keys():
-            if left == right:
+    for id in vertices.keys():
+        state['codes'][id] = get_vertex_code(id, vertices, configuration,
+                                             state['info'])
+    for left, right in itertools.permutations(vertices.keys(), 2):
+        index = _get_pair_index(left, right, state, configuration)
+        if index is not None:
+            state['counts'][index] += 1
+    return state
+
+
+def _add_edge_distances(distance, left, right):
+    """Return distance matrix updated by adding an edge.
+
+    Only rows that change are copied, the other rows are shared with the
+    given matrix.
+    :param distance: Distance matrix, see warshall.
+    :param left:
+    :param right:
+    :return: New distance matrix.
+    """
+    def add(x, y):
+        if x is None or y is None:
+            return None
+        return x + y + 1
+
+    result = dict(distance)
+    for i in distance.keys():
+        row = None
+        for j in distance.keys():
+            value = distance[i][j]
+            for candidate in (add(distance[i][left], distance[right][j]),
+                              add(distance[i][right], distance[left][j])):
+                if candidate is not None and \
+                        (value is None or candidate < value):
+                    value = candidate
+            if value == distance[i][j]:
                 continue
-            # Add properties.
-            left_code = get_vertex_code(left, vertices, configuration, info)
-            right_code = get_vertex_code(right, vertices, configuration, info)
-            edge_code = get_edge_code(right, vertices, configuration, info)
-            # Construct value.
-            value = (left_code << (vertex_size + edge_size)) + \
-                    (edge_code << vertex_size) + right_code
-            # print('Index ', value, '(', value % fingerprint_size, ')',
-            #       ' ~', bin(value))
-            #
-            indexes_count += 1
-            indexes.add(value)
-            indexes_hashed.add(value % fingerprint_size)
-            # Store into the fingerprint.
-            fingerprint[value % fingerprint_size] = 1
-    # UNCOMMENT THIS TO SEE THE NUMBER OF UNIQUE AND HASHED FRAGMENTS
-    # print('> size:', indexes_count, 'uniq:', len(indexes), 'hashed:',
-    #       len(indexes_hashed), 'nodes:', len(vertices.keys()))
-    # print('\t', indexes)
-    # print('\t', indexes_hashed)
-    return fingerprint
+            if row is None:
+                row = dict(distance[i])
+                result[i] = row
+            row[j] = value
+    return result
+
+
+def _get_edge_key(edge):
+    """Return key of an edge that does not depend on its direction."""
+    return frozenset((edge['from'], edge['to']))
+
+
+def _remove_edge_distances(distance, edges, removed_edges, removed_vertices):
+    """Return distance matrix updated by removing edges and vertices.
+
+    Only rows of vertices with a removed edge on one of their shortest
+    paths can change, these rows are recomputed by breadth-first search
+    over the remaining edges. The other rows are shared with the given
+    matrix, only the removed vertices are deleted from them.
+    :param distance: Distance matrix, see warshall.
+    :param edges: Remaining edges.
+    :param removed_edges: Removed edges as (from, to), the edges of removed
+        vertices must be included.
+    :param removed_vertices: Set of ids of removed vertices.
+    :return: New distance matrix.
+    """
+    affected = set()
+    for left, right in removed_edges:
+        if left not in distance or right not in distance:
+            continue
+        for i, row in distance.items():
+            if row[left] is not None and row[right] is not None and \
+                    abs(row[left] - row[right]) == 1:
+                affected.add(i)
+    affected.difference_update(removed_vertices)
+    neighbours = {id: [] for id in distance if id not in removed_vertices}
+    if len(affected) > 0:
+        for edge in edges:
+            if edge['from'] in neighbours and edge['to'] in neighbours:
+                neighbours[edge['from']].append(edge['to'])
+                neighbours[edge['to']].append(edge['from'])
+    result = {}
+    for i, row in distance.items():
+        if i in removed_vertices:
+            continue
+        if i in affected:
+            row = dict.fromkeys(neighbours.keys())
+            row[i] = 0
+            layer = [i]
+            while len(layer) > 0:
+                next_layer = []
+                for x in layer:
+                    for y in neighbours[x]:
+                        if row[y] is None:
+                            row[y] = row[x] + 1
+                            next_layer.append(y)
+                layer = next_layer
+        elif len(removed_vertices) > 0:
+            row = {j: value for j, value in row.items()
+                   if j not in removed_vertices}
+        result[i] = row
+    return result
+
+
+def _add_vertex_distances(distance, ids):
+    """Return distance matrix with new isolated vertices.
+
+    :param distance: Distance matrix, see warshall.
+    :param ids: Ids of new vertices.
+    :return: New distance matrix.
+    """
+    result = {}
+    for i, row in distance.items():
+        row = dict(row)
+        row.update(dict.fromkeys(ids))
+        result[i] = row
+    for i in ids:
+        result[i] = dict.fromkeys(result.keys())
+        result[i][i] = 0
+    return result
+
+
+def update_graph_state(state, configuration, changed_vertices=(),
+                       removed_vertices=(), added_edges=(), removed_edges=(),
+                       statistics=None):
+    """Return fingerprint and state of a graph derived from the given state.
+
+    Only pairs containing a changed vertex or with a changed distance or
+    edge are evaluated, and the given state is not modified, so it can be
+    used as a reference for many derived graphs. Vertex changes are
+    proportional to the number of vertices. Added edges update the
+    distance matrix in quadratic time. Removed edges and vertices require
+    a breadth-first search only from the vertices with a removed edge on
+    a shortest path, see _remove_edge_distances. Edges are undirected,
+    a removed edge matches a stored edge in either direction.
+    :param state: See create_graph_state.
+    :param configuration: Configuration used to create the state.
+    :param changed_vertices: New or modified vertices, the vertices replace
+        vertices with the same 'id'.
+    :param removed_vertices: Ids of removed vertices.
+    :param added_edges: Edges to add.
+    :param removed_edges: Edges to remove, compared by 'from' and 'to'
+        in any order.
+    :param statistics: Optional dictionary, see create_fingerprint.
+    :return: (fingerprint, state)
+    """
+    vertices = dict(state['vertices'])
+    for vertex in changed_vertices:
+        vertices[vertex['id']] = dict(vertex)
+    for id in removed_vertices:
+        del vertices[id]
+    removed_keys = set(_get_edge_key(edge) for edge in removed_edges)
+    edges = [edge for edge in state['edges']
+             if _get_edge_key(edge) not in removed_keys]
+    # Update distances, edges of removed vertices are removed as well.
+    distance = state['info']['distance']
+    removed_ids = set(removed_vertices)
+    removed_pairs = [(edge['from'], edge['to']) for edge in state['edges']
+                     if _get_edge_key(edge) in removed_keys or
+                     edge['from'] in removed_ids or edge['to'] in removed_ids]
+    if len(removed_pairs) > 0 or len(removed_ids) > 0:
+        distance = _remove_edge_distances(distance, edges, removed_pairs,
+                                          removed_ids)
+    new_ids = [vertex['id'] for vertex in changed_vertices
+               if vertex['id'] not in distance]
+    if len(new_ids) > 0:
+        distance = _add_vertex_distances(distance, new_ids)
+    edges.extend(dict(edge) for edge in added_edges)
+    for edge in added_edges:
+        distance = _add_edge_distances(distance, edge['from'], edge['to'])
+    new_state = {
+        'vertices': vertices,
+        'edges': edges,
+        'info': {
+            'distance': distance
+        },
+        'codes': dict(state['codes']),
+        'counts': None
+    }
+    # Collect affected vertex pairs.
+    changed = set(vertex['id'] for vertex in changed_vertices)
+    changed.update(removed_vertices)
+    for id in changed:
+        if id in vertices:
+            new_state['codes'][id] = get_vertex_code(
+                id, vertices, configuration, new_state['info'])
+        else:
+            del new_state['codes'][id]
+    pairs = set()
+    for id in changed:
+        for other in set(state['vertices'].keys()) | set(vertices.keys()):
+            if not id == other:
+                pairs.add((id, other))
+                pairs.add((other, id))
+    for edge in itertools.chain(added_edges, removed_edges):
+        pairs.add((edge['from'], edge['to']))
+        pairs.add((edge['to'], edge['from']))
+    old_distance = state['info']['distance']
+    if distance is not old_distance:
+        for left, row in distance.items():
+            if left not in old_distance:
+                continue
+            if row is old_distance[left]:
+                continue
+            for right, value in row.items():
+                if right in old_distance[left] and \
+                        not value == old_distance[left][right]:
+                    pairs.add((left, right))
+    # Update counts of the affected pairs.
+    counts = collections.Counter(state['counts'])
+    for left, right in pairs:
+        if left in state['vertices'] and right in state['vertices']:
+            index = _get_pair_index(left, right, state, configuration)
+            if index is not None:
+                counts[index] -= 1
+        if left in vertices and right in vertices:
+            index = _get_pair_index(left, right, new_state, configuration)
+            if index is not None:
+                counts[index] += 1
+    new_state['counts'] = +counts
+    fingerprint = create_fingerprint(
+        numpy.array(list(new_state['counts'].keys()), dtype=numpy.int64),
+        configuration, statistics,
+        numpy.array(list(new_state['counts'].values()), dtype=numpy.int64))
+    return fingerprint, new_state
+
+
+def is_symmetric(configuration):
+    """Return true if the edge code does not depend on the order of vertices.
+
+    The topological and euclidean distances are symmetric, and edge
+    properties are symmetric as find_edge ignores the edge direction.
+    :param configuration:
+    :return:
+    """
+    for item in configuration['fingerprint']['edge']:
+        if item['type'] not in _symmetric_edge_types:
+            return False
+        if item['type'] == 'compute' and \
+                item['method'] not in _symmetric_methods:
+            return False
+    return True
 
 
 def initialize_conversion_configuration(configuration):
+    """Prepare configuration for computation of fingerprints.
+
+    Unless configuration['fingerprint']['symmetric'] is given it is
+    detected by is_symmetric.
+
+    Optional configuration['neighbours'] object enables enumeration of
+    close vertex pairs only:
+        - radius : pairs with euclidean distance lower than radius are used
+        - source : coordinates properties, default is ["x", "y", "z"]
+        - far : "skip" to ignore other pairs, or "aggregate" to represent
+          them by a single index for each pair of vertex codes
+        - far_edge : edge code used by "aggregate", default is 0
+
+    Optional configuration['backend'] selects computation of edge codes:
+        - python : get_edge_code for every pair
+        - numba : vertex_pairs_kernel, Numba must be installed, unsupported
+          edge templates fall back to python
+        - auto : numba if installed, default
+    The kernel tables are stored in configuration['kernel'].
+
+    The vertex pair index consists of two vertex codes and an edge code,
+    configurations where it does not fit into int64 are rejected.
+    :param configuration:
+    :return:
+    """
     vertex_size = 0
     for item in configuration['fingerprint']['vertex']:
         if 'size' not in item:
@@ -310,6 +1059,413 @@ def initialize_conversion_configuration(configuration):
     configuration['fingerprint']['edge_size'] = edge_size
     configuration['edge_max'] = 1 << edge_size
 
+    if 2 * vertex_size + edge_size >= _INDEX_BITS:
+        raise Exception(
+            'Vertex pair index does not fit into int64, the sum of sizes '
+            'of two vertex codes and edge code must be less than %d, '
+            'got %d.' % (_INDEX_BITS, 2 * vertex_size + edge_size))
+
+    if 'symmetric' not in configuration['fingerprint']:
+        configuration['fingerprint']['symmetric'] = \
+            is_symmetric(configuration)
+
+    if 'mode' not in configuration['fingerprint']:
+        configuration['fingerprint']['mode'] = 'binary'
+    if configuration['fingerprint']['mode'] not in _modes:
+        raise Exception('Unknown fingerprint mode: ' +
+                        configuration['fingerprint']['mode'])
+
+    if 'neighbours' in configuration:
+        neighbours = configuration['neighbours']
+        neighbours.setdefault('source', ['x', 'y', 'z'])
+        neighbours.setdefault('far', 'skip')
+        neighbours.setdefault('far_edge', 0)
+        if neighbours['far'] not in ['skip', 'aggregate']:
+            raise Exception('Unknown far pairs handling: ' +
+                            neighbours['far'])
+
+    backend = configuration.setdefault('backend', 'auto')
+    if backend not in _backends:
+        raise Exception('Unknown backend: ' + backend)
+    configuration['kernel'] = None
+    if backend == 'python':
+        return
+    if not vertex_pairs_kernel.is_available():
+        if backend == 'numba':
+            raise Exception('Numba is not installed.')
+        return
+    configuration['kernel'] = vertex_pairs_kernel.compile_edge_program(
+        configuration)
+    if configuration['kernel'] is None and backend == 'numba':
+        logging.warning('Edge templates are not supported by the kernel, '
+                        'using Python backend.')
+
+
+def _initialize_worker(configuration):
+    """Store conversion configuration for the worker process.
+
+    The configuration is transferred only once per worker and not with
+    every task.
+    :param configuration:
+    :return:
+    """
+    global _worker_configuration
+    _worker_configuration = configuration
+
+
+def _process_batch(graphs, collect_statistics):
+    """Compute fingerprints for a batch of graphs in a worker process.
+
+    :param graphs:
+    :param collect_statistics: If true collect statistics for the batch.
+    :return: List of (id, fingerprint), statistics or None and list of
+        stage timings, see process_graph.
+    """
+    if collect_statistics:
+        statistics = create_statistics(_worker_configuration)
+    else:
+        statistics = None
+    timings = []
+    fingerprints = [
+        (graph['ID'],
+         process_graph(graph, _worker_configuration, statistics, timings))
+        for graph in graphs]
+    return fingerprints, statistics, timings
+
+
+def _observe_timings(metrics, timings):
+    """Add stage timings into 'stage_seconds' histograms of the metrics."""
+    if metrics is None:
+        return
+    for stage, seconds in timings:
+        metrics.observe(stage + '_seconds', seconds)
+
+
+def _time_stage(iterable, metrics, stage):
+    """Generate items, time of every item is observed as the stage.
+
+    :param iterable:
+    :param metrics: Optional instrumentation.Metrics.
+    :param stage:
+    :return:
+    """
+    iterator = iter(iterable)
+    while True:
+        start = time.perf_counter()
+        try:
+            item = next(iterator)
+        except StopIteration:
+            return
+        _observe_timings(metrics, [(stage, time.perf_counter() - start)])
+        yield item
+
+
+def _read_batches(graphs, batch_size):
+    batch = []
+    for graph in graphs:
+        batch.append(graph)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if len(batch) > 0:
+        yield batch
+
+
+def process_graphs(graphs, configuration, processes=1, batch_size=16,
+                   statistics=None, metrics=None):
+    """Compute fingerprints for given graphs, preserve the input order.
+
+    With more than one process the graphs are send to a process pool
+    in batches. At most two batches per process are in flight, so the input
+    is consumed only as fast as the fingerprints are consumed.
+    :param graphs: Iterable of graphs.
+    :param configuration: Initialized conversion configuration or a list
+        of them, see process_graph.
+    :param processes: Number of processes, 0 for the number of CPUs.
+    :param batch_size: Number of graphs in a single task.
+    :param statistics: Optional statistics, see process_graph.
+    :param metrics: Optional instrumentation.Metrics, the 'prepare' and
+        'fingerprint' stages of every graph are observed as latencies.
+    :return: Generator of (id, fingerprint or list of fingerprints).
+    """
+    if processes == 0:
+        processes = os.cpu_count() or 1
+    if processes == 1:
+        for graph in graphs:
+            timings = []
+            fingerprint = process_graph(graph, configuration, statistics,
+                                        timings)
+            _observe_timings(metrics, timings)
+            yield graph['ID'], fingerprint
+        return
+    pool = multiprocessing.Pool(processes, initializer=_initialize_worker,
+                                initargs=(configuration,))
+
+    def collect(result):
+        fingerprints, batch_statistics, timings = result.get()
+        if statistics is not None:
+            add_statistics(statistics, batch_statistics)
+        _observe_timings(metrics, timings)
+        return fingerprints
+
+    try:
+        pending = collections.deque()
+        for batch in _read_batches(graphs, batch_size):
+            pending.append(pool.apply_async(
+                _process_batch, (batch, statistics is not None)))
+            if len(pending) < 2 * processes:
+                continue
+            for item in collect(pending.popleft()):
+                yield item
+        while len(pending) > 0:
+            for item in collect(pending.popleft()):
+                yield item
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def _log_progress(fingerprints, metrics):
+    counter = 0
+    for item in fingerprints:
+        # The consumer writes the item before the generator resumes.
+        start = time.perf_counter()
+        yield item
+        _observe_timings(metrics, [('write', time.perf_counter() - start)])
+        counter += 1
+        metrics.increment('graphs')
+        metrics.tick()
+        if counter % 1000 == 0:
+            logging.info(counter)
+
+
+def write_json(path, fingerprints):
+    """Write fingerprints as JSON array with all values.
+
+    Unfolded fingerprints are written as JSON objects.
+    :param path:
+    :param fingerprints: Iterable of (id, fingerprint).
+    :return: Number of written fingerprints.
+    """
+    counter = 0
+    with open(path, 'w') as output_stream:
+        output_stream.write('[\n')
+        for id, value in fingerprints:
+            if counter == 0:
+                output_stream.write(' {\n')
+            else:
+                output_stream.write(',{\n')
+            output_stream.write('  "id":"' + str(id) + '",\n')
+            output_stream.write('  "value": ')
+            if isinstance(value, dict):
+                json.dump(value, output_stream)
+            else:
+                output_stream.write('[')
+                output_stream.write(','.join(map(str, value.tolist())))
+                output_stream.write(']')
+            output_stream.write('\n')
+            output_stream.write(' }\n')
+            counter += 1
+        output_stream.write(']')
+    return counter
+
+
+def write_sparse(path, fingerprints):
+    """Write fingerprints as JSON array with indexes of non-zero values.
+
+    For count fingerprints the values are stored in the 'count' list.
+    Unfolded fingerprints are written as JSON objects.
+    :param path:
+    :param fingerprints: Iterable of (id, fingerprint).
+    :return: Number of written fingerprints.
+    """
+    counter = 0
+    with open(path, 'w') as output_stream:
+        output_stream.write('[\n')
+        for id, value in fingerprints:
+            if counter > 0:
+                output_stream.write(',\n')
+            if isinstance(value, dict):
+                item = {'id': str(id), 'value': value}
+            else:
+                non_zero = numpy.flatnonzero(value)
+                item = {'id': str(id), 'value': non_zero.tolist()}
+                if value.dtype != numpy.uint8:
+                    item['count'] = value[non_zero].tolist()
+            json.dump(item, output_stream)
+            counter += 1
+        output_stream.write('\n]')
+    return counter
+
+
+def _write_npy_header(stream, rows, columns):
+    """Write header of two dimensional uint8 NPY file.
+
+    The header has always the same size, so it can be rewritten once
+    the number of rows is known.
+    :param stream:
+    :param rows:
+    :param columns:
+    :return:
+    """
+    header = "{'descr': '|u1', 'fortran_order': False, " \
+             "'shape': (%d, %d), }" % (rows, columns)
+    header = header.ljust(_NPY_HEADER_SIZE - 11) + '\n'
+    stream.write(b'\x93NUMPY\x01\x00')
+    stream.write(len(header).to_bytes(2, 'little'))
+    stream.write(header.encode('latin1'))
+
+
+def write_packed(path, fingerprints):
+    """Write bit-packed fingerprints into NPY file and ids into text file.
+
+    The NPY file contains uint8 matrix with a fingerprint packed by
+    numpy.packbits in every row. The rows are padded with zero bytes to
+    a multiple of eight bytes, so the matrix can be viewed as uint64.
+    Use numpy.load(path, mmap_mode='r') to read the fingerprints. Ids are
+    stored in path + '.ids', one id per line in order of the rows.
+    :param path:
+    :param fingerprints: Iterable of (id, fingerprint).
+    :return: Number of written fingerprints.
+    """
+    counter = 0
+    columns = 0
+    with open(path, 'wb') as output_stream, \
+            open(path + '.ids', 'w') as ids_stream:
+        # Reserve space for the header.
+        _write_npy_header(output_stream, 0, 0)
+        for id, value in fingerprints:
+            if isinstance(value, dict) or value.dtype != numpy.uint8:
+                raise Exception('Only binary fingerprints can be packed.')
+            packed = numpy.packbits(value)
+            columns = ((len(packed) + 7) // 8) * 8
+            output_stream.write(packed.tobytes())
+            output_stream.write(bytes(columns - len(packed)))
+            ids_stream.write(str(id))
+            ids_stream.write('\n')
+            counter += 1
+        output_stream.seek(0)
+        _write_npy_header(output_stream, counter, columns)
+    return counter
+
+
+_write_functions = {
+    'json': write_json,
+    'sparse': write_sparse,
+    'packed': write_packed
+}
+
+
+def write_multiple(write_function, paths, fingerprints):
+    """Write fingerprints computed for several configurations.
+
+    Every output is written by the write_function in its own thread, so
+    the fingerprints are consumed only once and at most _QUEUE_SIZE
+    fingerprints per output are kept in memory.
+    :param write_function: One of the write_* functions.
+    :param paths: Output path for every configuration.
+    :param fingerprints: Iterable of (id, list of fingerprints).
+    :return: Number of written fingerprints for every path.
+    """
+    queues = [queue.Queue(_QUEUE_SIZE) for _ in paths]
+    counters = [0] * len(paths)
+    errors = []
+
+    def read(input_queue):
+        while True:
+            item = input_queue.get()
+            if item is None:
+                return
+            yield item
+
+    def write(index):
+        items = read(queues[index])
+        try:
+            counters[index] = write_function(paths[index], items)
+        except Exception as error:
+            errors.append(error)
+        # Consume the rest of the input, so the producer is not blocked.
+        for _ in items:
+            pass
+
+    threads = [threading.Thread(target=write, args=(index,))
+               for index in range(len(paths))]
+    for thread in threads:
+        thread.start()
+    try:
+        for id, values in fingerprints:
+            if len(errors) > 0:
+                break
+            for output_queue, value in zip(queues, values):
+                output_queue.put((id, value))
+    finally:
+        for output_queue in queues:
+            output_queue.put(None)
+        for thread in threads:
+            thread.join()
+    if len(errors) > 0:
+        raise errors[0]
+    return counters
+
+
+def get_output_path(path, name):
+    """Return output path for one of several configurations.
+
+    The name is inserted before the extension of the path.
+    :param path:
+    :param name: Configuration 'name' or its index.
+    :return:
+    """
+    root, extension = os.path.splitext(path)
+    return root + '.' + name + extension
+
+
+def load_conversion_configurations(paths):
+    """Load configurations from JSON files.
+
+    Every file contains a configuration object or an array of them.
+    :param paths:
+    :return: List of configurations.
+    """
+    result = []
+    for path in paths:
+        with open(path, 'r') as input_stream:
+            content = json.load(input_stream)
+        if isinstance(content, list):
+            result.extend(content)
+        else:
+            result.append(content)
+    return result
+
+
+def _read_graphs(path, cache, shard=None):
+    """Return generator of graphs from JSON file or graph cache.
+
+    :param path: Path to the JSON file or prefix of the cache.
+    :param cache: True if the path is a cache prefix.
+    :param shard: Optional (i, N), return only graphs with ID in the shard.
+    :return:
+    """
+    if cache:
+        graphs = graph_cache.GraphCache(path)
+        for index, id in enumerate(graphs.ids):
+            # Select by ID before the graph is decoded.
+            if sharding.is_in_shard(str(id), shard):
+                yield graphs.graph(index)
+        return
+    with open(path, 'r') as input_stream:
+        for graph in read_json_array_stream(input_stream):
+            if sharding.is_in_shard(str(graph['ID']), shard):
+                yield graph
+
+
+def _log_statistics(statistics, metrics, prefix=''):
+    for key in sorted(statistics.keys()):
+        logging.info('\t%s: %d', key, statistics[key])
+        if not key == 'graphs':
+            metrics.increment(prefix + key, statistics[key])
+
 
 def main():
     # Initialize logging.
@@ -321,44 +1477,66 @@ def main():
 
     configuration = read_configuration()
 
-    with open(configuration['configuration'], 'r') as input_stream:
-        conversion_configuration = json.load(input_stream)
-
-    initialize_conversion_configuration(conversion_configuration)
+    conversion_configurations = load_conversion_configurations(
+        configuration['configuration'])
+    for conversion_configuration in conversion_configurations:
+        if configuration['mode'] is not None:
+            conversion_configuration['fingerprint']['mode'] = \
+                configuration['mode']
+        conversion_configuration['backend'] = configuration['backend']
+        initialize_conversion_configuration(conversion_configuration)
+        if configuration['format'] == 'packed' and \
+                not conversion_configuration['fingerprint']['mode'] == \
+                'binary':
+            logging.error('Only binary fingerprints can be packed.')
+            exit(1)
+    if len(conversion_configurations) == 1:
+        conversion_configuration = conversion_configurations[0]
+        names = None
+    else:
+        conversion_configuration = conversion_configurations
+        names = [str(item.get('name', index)) for index, item
+                 in enumerate(conversion_configurations)]
+        if not len(set(names)) == len(names):
+            logging.error('Configuration names must be unique.')
+            exit(1)
+        logging.info('Computing %d configurations', len(names))
     #
-    counter = 0
-    with open(configuration['output'], 'w') as output_stream:
-        with open(configuration['input'], 'r') as input_stream:
-            output_stream.write('[\n')
-            first = True
-            for graph in read_json_array_stream(input_stream):
-                #
-                id = graph['ID']
-                value = process_graph(graph, conversion_configuration)
-                # Write output.
-                if first:
-                    first = False
-                    output_stream.write(' {\n')
-                else:
-                    output_stream.write(',{\n')
-                output_stream.write('  "id":"' + str(id) + '",\n')
-                output_stream.write('  "value": [')
-                output_stream.write(str(int(value[0])))
-                for x in value[1:]:
-                    output_stream.write(',')
-                    output_stream.write(str(int(x)))
-                output_stream.write(']\n')
-                output_stream.write(' }\n')
-                # Progress
-                counter += 1
-                if counter % 1000 == 0:
-                    logging.info(counter)
-                    break
-            #
-            output_stream.write(']')
-            print(output_stream.getvalue())
-            output_stream.close()
+    if configuration['statistics']:
+        statistics = create_statistics(conversion_configuration)
+    else:
+        statistics = None
+    metrics = instrumentation.create_metrics('graph_vertex_pairs',
+                                             configuration)
+    write_function = _write_functions[configuration['format']]
+    # Latencies of the read, prepare, fingerprint and write stages are
+    # observed for every graph.
+    graphs = _time_stage(
+        _read_graphs(configuration['input'], configuration['cache'],
+                     configuration['shard']), metrics, 'read')
+    fingerprints = _log_progress(process_graphs(
+        graphs, conversion_configuration, configuration['processes'],
+        configuration['batch'], statistics, metrics), metrics)
+    output = sharding.get_shard_path(configuration['output'],
+                                     configuration['shard'])
+    if names is None:
+        counter = write_function(output, fingerprints)
+    else:
+        counter = write_multiple(
+            write_function,
+            [get_output_path(output, name) for name in names],
+            fingerprints)[0]
 
+    if statistics is not None:
+        if names is None:
+            logging.info('Statistics')
+            _log_statistics(statistics, metrics)
+        else:
+            for index, item in enumerate(statistics):
+                logging.info('Statistics %s', names[index])
+                _log_statistics(item, metrics,
+                                'configuration_%d_' % index)
+    metrics.close()
     logging.info('done %d', counter)
 
 
@@ -0,0 +1,484 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Benchmark graph_vertex_pairs on synthetic residue graphs.
+
+Usage:
+    python graph_vertex_pairs_benchmark.py
+        -n {number of graphs, default 100}
+        -v {number of vertices per graph, default 50}
+        -d {average vertex degree, default 3}
+        --coordinates {'uniform', 'gaussian' or 'chain', default 'chain'}
+        -c {configuration, default examples/vp_example.json}
+        -s {random seed, default 0}
+        -o {optional path to output JSON report}
+        --check-kernel {compare vertex_pairs_kernel with the Python
+                        implementation instead of the benchmark}
+        --require-numba {with --check-kernel fail if Numba is not
+                         installed}
+
+The graphs use the same schema as graph_vertex_pairs input, i.e. 'ID',
+'Vertices' with 'id', 'aa', 'rasa10', 'x', 'y', 'z' and 'Edges' with
+'from' and 'to'. Every stage is timed separately:
+    - parse : read_json_array_stream over the serialized graphs
+    - distances : warshall
+    - vertex_codes : get_vertex_code for all vertices
+    - pairs : compute_pair_indexes and create_fingerprint
+    - pairs_kernel : the same with edge codes computed by
+      vertex_pairs_kernel, only if the configuration is supported
+    - serialization : every write_* function into a temporary file
+The report contains seconds and graphs per second for every stage and
+the peak resident set size of the process. The 'kernel' object reports
+whether the kernel was compiled by Numba and whether the configuration
+is supported. If the kernel fingerprints differ from the fingerprints
+computed in Python the benchmark fails.
+
+With --check-kernel the vertex pair indexes computed by the kernel are
+compared with the Python implementation for the configuration and
+an edge program with bins and mapping that fail for distant vertices,
+each with and without neighbours cut-off and as symmetric and
+non-symmetric. Besides the generated graphs the check uses graphs with
+a disconnected vertex, a distant vertex, a missing coordinate and
+an unmapped vertex property. Both implementations must return the same
+indexes or both must fail, otherwise the check fails. Without Numba
+the kernel runs as a plain Python function, use --require-numba to make
+sure the compiled kernel is checked.
+"""
+
+import argparse
+import copy
+import io
+import json
+import logging
+import os
+import random
+import shutil
+import tempfile
+import time
+
+import graph_vertex_pairs
+import numpy
+import vertex_pairs_kernel
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+__author__ = 'Petr Škoda'
+__license__ = 'X11'
+__email__ = 'skoda@ksi.mff.cuni.cz'
+
+_amino_acids = 'ACDEFGHIKLMNPQRSTVWY'
+
+_write_functions = [
+    ('json', graph_vertex_pairs.write_json),
+    ('sparse', graph_vertex_pairs.write_sparse),
+    ('packed', graph_vertex_pairs.write_packed)
+]
+
+# Distance of consecutive residues in the 'chain' coordinates.
+_CHAIN_STEP = 3.8
+
+# Radius of the neighbours cut-off used by check_kernel.
+_CHECK_RADIUS = 10.0
+
+# Edge templates used by check_kernel, the bins and the mapping have
+# no value for distant vertices.
+_check_edge_templates = [
+    {'type': 'distance', 'size': 2},
+    {'type': 'compute', 'method': 'euclidean_distance',
+     'source': ['x', 'y', 'z'], 'name': 'distance'},
+    {'type': 'binning', 'property': 'distance', 'name': 'distance-bin',
+     'bins': [{'from': 0, 'to': 20, 'value': 1},
+              {'from': 20, 'to': 40, 'value': 2},
+              {'from': 40, 'to': 1000, 'value': 3}]},
+    {'type': 'mapping', 'property': 'distance-bin', 'map': {'1': 1, '2': 2},
+     'size': 2},
+    {'type': 'property', 'property': 'distance-bin', 'format': 'gray',
+     'size': 2}
+]
+
+
+def _generate_coordinates(count, distribution, rand):
+    if distribution == 'uniform':
+        # Box with approximately constant density.
+        side = pow(count, 1.0 / 3.0) * _CHAIN_STEP
+        return [[rand.uniform(0, side) for _ in range(3)]
+                for _ in range(count)]
+    elif distribution == 'gaussian':
+        return [[rand.gauss(0, _CHAIN_STEP * 2) for _ in range(3)]
+                for _ in range(count)]
+    elif distribution == 'chain':
+        result = []
+        position = [0.0, 0.0, 0.0]
+        for _ in range(count):
+            direction = [rand.gauss(0, 1) for _ in range(3)]
+            norm = sum(x * x for x in direction) ** 0.5 or 1.0
+            position = [x + _CHAIN_STEP * y / norm
+                        for x, y in zip(position, direction)]
+            result.append(position)
+        return result
+    else:
+        raise Exception('Unknown coordinates distribution: ' + distribution)
+
+
+def generate_graph(id, vertex_count, degree, distribution, rand):
+    """Generate and return a connected random residue graph.
+
+    Consecutive vertices are always connected, so the graph is connected.
+    Other edges are added with probability giving the required average
+    degree.
+    :param id:
+    :param vertex_count:
+    :param degree: Average vertex degree.
+    :param distribution: Distribution of vertex coordinates.
+    :param rand: Instance of random.Random.
+    :return:
+    """
+    coordinates = _generate_coordinates(vertex_count, distribution, rand)
+    vertices = []
+    for index in range(vertex_count):
+        vertices.append({
+            'id': index,
+            'aa': rand.choice(_amino_acids),
+            'rasa10': rand.randint(0, 10),
+            'x': coordinates[index][0],
+            'y': coordinates[index][1],
+            'z': coordinates[index][2]
+        })
+    probability = max(0.0, (degree - 2.0) / max(1, vertex_count - 1))
+    edges = []
+    for left in range(vertex_count):
+        for right in range(left):
+            if right == left - 1 or rand.random() < probability:
+                edges.append({'from': left, 'to': right})
+    return {
+        'ID': id,
+        'Vertices': vertices,
+        'Edges': edges
+    }
+
+
+def generate_graphs(count, vertex_count, degree, distribution, seed):
+    """Generate list of random graphs, see generate_graph.
+
+    :param count:
+    :param vertex_count:
+    :param degree:
+    :param distribution:
+    :param seed:
+    :return:
+    """
+    rand = random.Random(seed)
+    return [generate_graph('graph-' + str(index), vertex_count, degree,
+                           distribution, rand)
+            for index in range(count)]
+
+
+def _get_peak_memory():
+    """Return peak resident set size in kB or None if not available."""
+    if resource is None:
+        return None
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def run_benchmark(graphs, configuration):
+    """Time all stages of the fingerprint computation.
+
+    :param graphs: List of graphs.
+    :param configuration: Conversion configuration, it is not modified.
+    :return: Report object.
+    """
+    configuration = copy.deepcopy(configuration)
+    configuration['backend'] = 'python'
+    graph_vertex_pairs.initialize_conversion_configuration(configuration)
+    kernel_configuration = dict(configuration)
+    kernel_configuration['kernel'] = \
+        vertex_pairs_kernel.compile_edge_program(configuration)
+    times = {}
+    # Parse.
+    text = json.dumps(graphs)
+    start = time.perf_counter()
+    graphs = list(graph_vertex_pairs.read_json_array_stream(
+        io.StringIO(text)))
+    times['parse'] = time.perf_counter() - start
+    # Distances, vertex codes and pairs.
+    times['distances'] = 0
+    times['vertex_codes'] = 0
+    times['pairs'] = 0
+    if kernel_configuration['kernel'] is not None:
+        times['pairs_kernel'] = 0
+    fingerprints = []
+    for graph in graphs:
+        vertices = {}
+        for item in graph['Vertices']:
+            vertices[item['id']] = item
+        ids = list(vertices.keys())
+        start = time.perf_counter()
+        info = {
+            'distance': graph_vertex_pairs.warshall(
+                vertices.keys(), graph['Edges'])
+        }
+        times['distances'] += time.perf_counter() - start
+        start = time.perf_counter()
+        codes = graph_vertex_pairs.compute_vertex_codes(
+            ids, vertices, configuration, info)
+        times['vertex_codes'] += time.perf_counter() - start
+        start = time.perf_counter()
+        indexes, counts = graph_vertex_pairs.compute_pair_indexes(
+            ids, vertices, graph['Edges'], codes, info, configuration)
+        fingerprint = graph_vertex_pairs.create_fingerprint(
+            indexes, configuration, None, counts)
+        fingerprints.append((graph['ID'], fingerprint))
+        times['pairs'] += time.perf_counter() - start
+        if kernel_configuration['kernel'] is None:
+            continue
+        start = time.perf_counter()
+        indexes, counts = graph_vertex_pairs.compute_pair_indexes(
+            ids, vertices, graph['Edges'], codes, info,
+            kernel_configuration)
+        kernel_fingerprint = graph_vertex_pairs.create_fingerprint(
+            indexes, kernel_configuration, None, counts)
+        times['pairs_kernel'] += time.perf_counter() - start
+        if isinstance(fingerprint, dict):
+            equal = fingerprint == kernel_fingerprint
+        else:
+            equal = numpy.array_equal(fingerprint, kernel_fingerprint)
+        if not equal:
+            raise Exception('Kernel fingerprint differs for graph: ' +
+                            str(graph['ID']))
+    # Serialization.
+    directory = tempfile.mkdtemp()
+    try:
+        for name, function in _write_functions:
+            if name == 'packed' and \
+                    not configuration['fingerprint']['mode'] == 'binary':
+                continue
+            start = time.perf_counter()
+            function(os.path.join(directory, 'output.' + name), fingerprints)
+            times['serialization_' + name] = time.perf_counter() - start
+    finally:
+        shutil.rmtree(directory)
+    #
+    report = {
+        'graphs': len(graphs),
+        'vertices': sum(len(graph['Vertices']) for graph in graphs),
+        'edges': sum(len(graph['Edges']) for graph in graphs),
+        'stages': {},
+        'kernel': {
+            'compiled': vertex_pairs_kernel.is_available(),
+            'supported': kernel_configuration['kernel'] is not None
+        },
+        'peak_memory_kb': _get_peak_memory()
+    }
+    for name, value in times.items():
+        report['stages'][name] = {
+            'seconds': value,
+            'graphs_per_second': len(graphs) / value if value > 0 else None
+        }
+    return report
+
+
+def generate_failing_graphs(vertex_count, degree, distribution, seed):
+    """Return graphs on which evaluation of some vertex pairs fails.
+
+    :param vertex_count:
+    :param degree:
+    :param distribution:
+    :param seed:
+    :return: List of graphs with a disconnected vertex, a distant vertex,
+        a missing coordinate and an unmapped vertex property.
+    """
+    rand = random.Random(seed)
+    vertex_count = max(2, vertex_count)
+    graphs = [generate_graph('check-' + name, vertex_count, degree,
+                             distribution, rand)
+              for name in ['disconnected', 'distant', 'coordinate',
+                           'unmapped']]
+    last = vertex_count - 1
+    graphs[0]['Edges'] = [edge for edge in graphs[0]['Edges']
+                          if last not in [edge['from'], edge['to']]]
+    graphs[1]['Vertices'][last]['x'] += 1000 * _CHAIN_STEP
+    del graphs[2]['Vertices'][last]['x']
+    graphs[3]['Vertices'][last]['aa'] = 'B'
+    return graphs
+
+
+def _create_check_configurations(configuration):
+    """Return (name, configuration) for every configuration to check.
+
+    :param configuration: Conversion configuration, it is not modified.
+    :return:
+    """
+    result = []
+    for edge_name, edge_templates in [
+            ('configuration', configuration['fingerprint']['edge']),
+            ('check', _check_edge_templates)]:
+        for neighbours in [False, True]:
+            for symmetric in [True, False]:
+                item = copy.deepcopy(configuration)
+                item['fingerprint']['edge'] = copy.deepcopy(edge_templates)
+                item['fingerprint']['symmetric'] = symmetric
+                item['backend'] = 'python'
+                item.pop('neighbours', None)
+                if neighbours:
+                    item['neighbours'] = {'radius': _CHECK_RADIUS}
+                graph_vertex_pairs.initialize_conversion_configuration(item)
+                item['kernel'] = \
+                    vertex_pairs_kernel.compile_edge_program(item)
+                name = '%s, neighbours %s, symmetric %s' % (
+                    edge_name, neighbours, symmetric)
+                if item['kernel'] is None:
+                    raise Exception('Edge templates are not supported by '
+                                    'the kernel: ' + name)
+                result.append((name, item))
+    return result
+
+
+def _evaluate(function, *args):
+    """Return ('indexes', result) or ('error', exception type name)."""
+    try:
+        return 'indexes', function(*args)
+    except Exception as error:
+        return 'error', type(error).__name__
+
+
+def check_kernel(graphs, configuration, require_numba=False):
+    """Compare indexes computed by vertex_pairs_kernel and in Python.
+
+    For every configuration, see _create_check_configurations, and graph
+    _compute_kernel_indexes and _compute_python_indexes must return equal
+    indexes, or both fail. The kernel fails either by returning None,
+    in such case graph_vertex_pairs falls back to Python, or by raising
+    the same exception as Python.
+    :param graphs: List of graphs, they are not modified.
+    :param configuration: Conversion configuration, it is not modified.
+    :param require_numba: If true fail if the kernel is not compiled.
+    :return: Report with number of equal, failed and skipped graphs for
+        every configuration. Graphs are skipped if vertex codes or close
+        pairs can not be computed, as this does not depend on the kernel.
+    """
+    if not vertex_pairs_kernel.is_available():
+        if require_numba:
+            raise Exception('Numba is not installed.')
+        logging.warning('Numba is not installed, checking the kernel as '
+                        'a Python function.')
+    report = {}
+    mismatches = []
+    for name, item in _create_check_configurations(configuration):
+        counts = {'equal': 0, 'failed': 0, 'skipped': 0}
+        for graph in graphs:
+            state = graph_vertex_pairs.prepare_graph(copy.deepcopy(graph))
+            ids = state['ids']
+            vertices = state['vertices']
+            info = state['info']
+            try:
+                codes = graph_vertex_pairs.compute_vertex_codes(
+                    ids, vertices, item, info)
+                left, right = graph_vertex_pairs._find_close_pairs(
+                    ids, vertices, info, item)
+            except Exception:
+                counts['skipped'] += 1
+                continue
+            python = _evaluate(
+                graph_vertex_pairs._compute_python_indexes, ids, vertices,
+                state['edges'], codes, info, item, left, right)
+            kernel = _evaluate(
+                graph_vertex_pairs._compute_kernel_indexes, ids, vertices,
+                codes, info, item, left, right)
+            if kernel[0] == 'indexes' and kernel[1] is None:
+                kernel = ('fallback', None)
+            if python[0] == 'indexes' and kernel[0] == 'indexes' and \
+                    numpy.array_equal(python[1], kernel[1]):
+                counts['equal'] += 1
+            elif python[0] == 'error' and \
+                    kernel[0] in ['fallback', 'error'] and \
+                    kernel[1] in [None, python[1]]:
+                counts['failed'] += 1
+            else:
+                mismatches.append('%s, graph %s: python %s, kernel %s' % (
+                    name, graph['ID'],
+                    'indexes' if python[0] == 'indexes' else python[1],
+                    'indexes' if kernel[0] == 'indexes' else
+                    kernel[1] or kernel[0]))
+        report[name] = counts
+    if len(mismatches) > 0:
+        for message in mismatches:
+            logging.error('Kernel mismatch: %s', message)
+        raise Exception('Kernel differs from Python for %d graphs.' %
+                        len(mismatches))
+    return report
+
+
+def _read_configuration():
+    """Get and return application settings.
+
+    :return:
+    """
+    parser = argparse.ArgumentParser(
+        description='Benchmark vertex pair fingerprints on synthetic graphs.'
+                    ' See file header for more details.')
+    parser.add_argument('-n', type=int, dest='count', default=100)
+    parser.add_argument('-v', type=int, dest='vertices', default=50)
+    parser.add_argument('-d', type=float, dest='degree', default=3)
+    parser.add_argument('--coordinates', type=str, dest='coordinates',
+                        default='chain',
+                        choices=['uniform', 'gaussian', 'chain'])
+    parser.add_argument('-c', type=str, dest='configuration',
+                        default=os.path.join(os.path.dirname(__file__),
+                                             'examples', 'vp_example.json'))
+    parser.add_argument('-s', type=int, dest='seed', default=0)
+    parser.add_argument('-o', type=str, dest='output', required=False)
+    parser.add_argument('--check-kernel', dest='check_kernel',
+                        action='store_true', required=False)
+    parser.add_argument('--require-numba', dest='require_numba',
+                        action='store_true', required=False)
+    return vars(parser.parse_args())
+
+
+def _main():
+    logging.basicConfig(
+        level=logging.DEBUG,
+        format='%(asctime)s [%(levelname)s] %(module)s - %(message)s',
+        datefmt='%H:%M:%S')
+    configuration = _read_configuration()
+    with open(configuration['configuration'], 'r') as stream:
+        conversion_configuration = json.load(stream)
+    #
+    graphs = generate_graphs(configuration['count'],
+                             configuration['vertices'],
+                             configuration['degree'],
+                             configuration['coordinates'],
+                             configuration['seed'])
+    if configuration['check_kernel']:
+        graphs += generate_failing_graphs(configuration['vertices'],
+                                          configuration['degree'],
+                                          configuration['coordinates'],
+                                          configuration['seed'])
+        report = check_kernel(graphs, conversion_configuration,
+                              configuration['require_numba'])
+        logging.info('Kernel is equal to Python, compiled %s',
+                     vertex_pairs_kernel.is_available())
+        for name, counts in report.items():
+            logging.info('\t%s: equal %d, failed %d, skipped %d', name,
+                         counts['equal'], counts['failed'],
+                         counts['skipped'])
+        return
+    report = run_benchmark(graphs, conversion_configuration)
+    report['parameters'] = configuration
+    # Log and write report.
+    logging.info('Report')
+    for name, value in sorted(report['stages'].items()):
+        logging.info('\t%s: %.3f s, %s graphs/s', name, value['seconds'],
+                     '-' if value['graphs_per_second'] is None
+                     else '%.1f' % value['graphs_per_second'])
+    logging.info('\tkernel: compiled %s, supported %s',
+                 report['kernel']['compiled'], report['kernel']['supported'])
+    logging.info('\tpeak memory: %s kB', report['peak_memory_kb'])
+    if configuration['output'] is not None:
+        with open(configuration['output'], 'w') as stream:
+            json.dump(report, stream, indent=2)
+
+
+if __name__ == '__main__':
+    _main()
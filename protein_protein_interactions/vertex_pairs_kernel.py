@@ -0,0 +1,241 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Optional compiled computation of edge codes for graph_vertex_pairs.
+
+The edge templates of a configuration are translated by
+compile_edge_program into numeric tables. Function compute_edge_codes
+evaluates the tables for arrays of vertex pairs, it is compiled by Numba
+if it is installed, otherwise it is a plain Python function.
+
+Supported are templates of type:
+    - distance : topological distance
+    - compute : euclidean_distance, all such templates must use the same
+      source properties
+    - property, mapping, binning : of a value stored by a previous
+      template with 'name', mapping requires integer values
+Templates reading properties of the edges are not supported. For
+configurations with other templates compile_edge_program returns None
+and graph_vertex_pairs uses the Python implementation.
+
+If a pair can not be evaluated, e.g. there is no path between the
+vertices or a value is missing in a mapping or bins, compute_edge_codes
+reports the pair and graph_vertex_pairs evaluates the graph in Python,
+so the error is reported in the same way as without the kernel.
+"""
+
+import math
+import numpy
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+__author__ = 'Petr Škoda'
+__license__ = 'X11'
+__email__ = 'skoda@ksi.mff.cuni.cz'
+
+# Operation codes, see compile_edge_program.
+_DISTANCE = 0
+_EUCLIDEAN = 1
+_PROPERTY = 2
+_GRAY = 3
+_MAPPING = 4
+_BINNING = 5
+
+# Columns of the operations table.
+_OPERATION_COLUMNS = ['operation', 'input', 'output', 'start', 'end',
+                      'max', 'shift']
+
+
+def is_available():
+    """Return true if the kernel is compiled by Numba."""
+    return numba is not None
+
+
+def _is_integer(value):
+    return isinstance(value, int) and not isinstance(value, bool)
+
+
+def _is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def compile_edge_program(configuration):
+    """Translate edge templates into tables for compute_edge_codes.
+
+    :param configuration: Initialized conversion configuration.
+    :return: Program as a dictionary or None if the templates are not
+        supported.
+    """
+    operations = []
+    table = []
+    bins = []
+    # Name -> (slot, True for integer values).
+    slots = {}
+    source = None
+    shift = 0
+    for item in configuration['fingerprint']['edge']:
+        start, end = 0, 0
+        if item['type'] == 'distance':
+            operation = _DISTANCE
+            input_slot = -1
+            is_integer = True
+        elif item['type'] == 'compute':
+            if not item.get('method') == 'euclidean_distance':
+                return None
+            if source is not None and not source == item['source']:
+                return None
+            source = list(item['source'])
+            operation = _EUCLIDEAN
+            input_slot = -1
+            is_integer = False
+        elif item['type'] in ['property', 'mapping', 'binning']:
+            if item.get('property') not in slots:
+                return None
+            input_slot, is_integer = slots[item['property']]
+            if item['type'] == 'property':
+                if item.get('format') == 'gray':
+                    if not is_integer:
+                        return None
+                    operation = _GRAY
+                else:
+                    operation = _PROPERTY
+            elif item['type'] == 'mapping':
+                # Mapping use string of the value as a key.
+                if not is_integer:
+                    return None
+                operation = _MAPPING
+                start = len(table)
+                values = []
+                for key, value in item['map'].items():
+                    if not _is_number(value):
+                        return None
+                    try:
+                        if not str(int(key)) == key:
+                            continue
+                    except ValueError:
+                        continue
+                    table.append((int(key), value))
+                    values.append(value)
+                end = len(table)
+                is_integer = all(_is_integer(value) for value in values)
+            else:
+                operation = _BINNING
+                start = len(bins)
+                for bin_definition in item['bins']:
+                    values = [bin_definition['from'], bin_definition['to'],
+                              bin_definition['value']]
+                    if not all(_is_number(value) for value in values):
+                        return None
+                    bins.append(values)
+                end = len(bins)
+                is_integer = all(_is_integer(value[2])
+                                 for value in bins[start:end])
+        else:
+            return None
+        if 'name' in item:
+            output_slot = len(slots)
+            slots[item['name']] = (output_slot, is_integer)
+            operations.append((operation, input_slot, output_slot,
+                               start, end, 0, 0))
+        elif 'size' not in item:
+            return None
+        else:
+            operations.append((operation, input_slot, -1, start, end,
+                               item['max'], shift))
+            shift += item['size']
+    return {
+        'operations': numpy.array(operations, dtype=numpy.int64).reshape(
+            len(operations), len(_OPERATION_COLUMNS)),
+        'keys': numpy.array([key for key, _ in table], dtype=numpy.float64),
+        'values': numpy.array([value for _, value in table],
+                              dtype=numpy.float64),
+        'bins': numpy.array(bins, dtype=numpy.float64).reshape(
+            len(bins), 3),
+        'slots': max(1, len(slots)),
+        'source': source,
+        'edge_max': configuration['edge_max']
+    }
+
+
+def _compute_edge_codes(left, right, distance, coordinates, operations,
+                        keys, values, bins, slots_count, edge_max, result):
+    """Store edge codes of the pairs into result.
+
+    :return: Position of the first pair that can not be evaluated or -1.
+    """
+    slots = numpy.zeros(slots_count, dtype=numpy.float64)
+    for position in range(len(left)):
+        i = left[position]
+        j = right[position]
+        code = 0
+        for index in range(operations.shape[0]):
+            operation = operations[index, 0]
+            if operation == _DISTANCE:
+                if distance[i, j] < 0:
+                    return position
+                value = float(distance[i, j])
+            elif operation == _EUCLIDEAN:
+                value = 0.0
+                for k in range(coordinates.shape[1]):
+                    value += (coordinates[i, k] - coordinates[j, k]) ** 2
+                value = math.sqrt(value)
+            else:
+                value = slots[operations[index, 1]]
+                if operation == _GRAY:
+                    integer = numpy.int64(value)
+                    value = float(integer ^ (integer >> 1))
+                elif operation == _MAPPING:
+                    found = False
+                    for item in range(operations[index, 3],
+                                      operations[index, 4]):
+                        if keys[item] == value:
+                            value = values[item]
+                            found = True
+                            break
+                    if not found:
+                        return position
+                elif operation == _BINNING:
+                    found = False
+                    for item in range(operations[index, 3],
+                                      operations[index, 4]):
+                        if bins[item, 0] <= value < bins[item, 1]:
+                            value = bins[item, 2]
+                            found = True
+                            break
+                    if not found:
+                        return position
+            if operations[index, 2] >= 0:
+                slots[operations[index, 2]] = value
+            else:
+                code += (numpy.int64(value) % operations[index, 5]) << \
+                        operations[index, 6]
+        result[position] = code % edge_max
+    return -1
+
+
+if numba is not None:
+    _compute_edge_codes = numba.njit(cache=True)(_compute_edge_codes)
+
+
+def compute_edge_codes(program, left, right, distance, coordinates):
+    """Return edge codes of given vertex pairs.
+
+    :param program: See compile_edge_program.
+    :param left: Numpy int64 array with positions of left vertices.
+    :param right: Numpy int64 array with positions of right vertices.
+    :param distance: Numpy int64 matrix with topological distances of
+        vertices, -1 if there is no path.
+    :param coordinates: Numpy float64 matrix with coordinates of vertices
+        from program['source'].
+    :return: Numpy int64 array or None if a pair can not be evaluated.
+    """
+    result = numpy.zeros(len(left), dtype=numpy.int64)
+    failed = _compute_edge_codes(
+        left, right, distance, coordinates, program['operations'],
+        program['keys'], program['values'], program['bins'],
+        program['slots'], program['edge_max'], result)
+    if failed >= 0:
+        return None
+    return result